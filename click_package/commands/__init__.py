@@ -25,11 +25,13 @@ all_commands = (
     "contents",
     "desktophook",
     "framework",
+    "gc",
     "hook",
     "info",
     "install",
     "list",
     "pkgdir",
+    "reap",
     "register",
     "unregister",
     "verify",
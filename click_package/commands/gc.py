@@ -0,0 +1,64 @@
+# Copyright (C) 2014 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Remove unregistered Click package versions."""
+
+from __future__ import print_function
+
+from optparse import OptionParser
+import os
+
+from gi.repository import Click
+
+from click_package.json_helpers import json_object_to_python
+
+
+def print_plan(plan):
+    for rereg in plan["reregister"]:
+        print(
+            "Would re-register %s for %s: %s -> %s" %
+            (rereg["package"], rereg["user"], rereg["old-version"],
+             rereg["new-version"]))
+    for inst in plan["remove"]:
+        print(
+            "Would remove %s %s (%d bytes)" %
+            (inst["package"], inst["version"], inst["size"]))
+    for inst in plan["running"]:
+        print(
+            "Would keep %s %s, which is running" %
+            (inst["package"], inst["version"]))
+    print("Would free %d bytes" % plan["size"])
+
+
+def run(argv):
+    parser = OptionParser("%prog gc [options]")
+    parser.add_option(
+        "--root", metavar="PATH", help="look for additional packages in PATH")
+    parser.add_option(
+        "-n", "--dry-run", default=False, action="store_true",
+        help="show what would be done without changing anything")
+    options, _ = parser.parse_args(argv)
+    if os.geteuid() != 0 and not options.dry_run:
+        parser.error(
+            "click gc must be started as root, since it may need to "
+            "remove packages from disk")
+    db = Click.DB()
+    db.read(db_dir=None)
+    if options.root is not None:
+        db.add(options.root)
+    if options.dry_run:
+        print_plan(json_object_to_python(db.get_gc_plan()))
+    else:
+        db.gc()
+    return 0
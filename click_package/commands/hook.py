@@ -30,6 +30,18 @@ per_hook_subcommands = {
     }
 
 
+def make_db(options):
+    db = Click.DB()
+    if options.db_roots:
+        for root in options.db_roots:
+            db.add(root)
+    else:
+        db.read(db_dir=None)
+    if options.root is not None:
+        db.add(options.root)
+    return db
+
+
 def run(argv):
     parser = OptionParser(dedent("""\
         %prog hook [options] SUBCOMMAND [...]
@@ -38,36 +50,69 @@ def run(argv):
 
           install HOOK
           remove HOOK
-          run-system
-          run-user [--user=USER]"""))
+          sync HOOK [--package=PACKAGE ...]
+          run-system [--force] [--jobs=N]
+          run-user [--user=USER] [--force] [--package=PACKAGE ...]"""))
     parser.add_option(
         "--root", metavar="PATH", help="look for additional packages in PATH")
+    parser.add_option(
+        "--db", metavar="PATH", dest="db_roots", action="append",
+        help=(
+            "use the database at PATH instead of the configured databases; "
+            "may be given more than once, lowest priority first"))
     parser.add_option(
         "--user", metavar="USER",
         help=(
             "run user-level hooks for USER (default: current user; only "
             "applicable to run-user)"))
+    parser.add_option(
+        "--package", metavar="PACKAGE", dest="packages", action="append",
+        help=(
+            "only consider PACKAGE; may be given more than once (only "
+            "applicable to sync and run-user)"))
+    parser.add_option(
+        "--force", default=False, action="store_true",
+        help=(
+            "run hooks even if nothing seems to have changed since they "
+            "were last run (only applicable to run-system and run-user)"))
+    parser.add_option(
+        "-j", "--jobs", metavar="N", type="int", default=1,
+        help=(
+            "run up to N system-level hooks at once (default: 1; only "
+            "applicable to run-system)"))
     options, args = parser.parse_args(argv)
     if len(args) < 1:
-        parser.error("need subcommand (install, remove, run-system, run-user)")
+        parser.error(
+            "need subcommand (install, remove, sync, run-system, run-user)")
     subcommand = args[0]
     if subcommand in per_hook_subcommands:
         if len(args) < 2:
             parser.error("need hook name")
-        db = Click.DB()
-        db.read(db_dir=None)
-        if options.root is not None:
-            db.add(options.root)
+        db = make_db(options)
         name = args[1]
         hook = Click.Hook.open(db, name)
         getattr(hook, per_hook_subcommands[subcommand])(user_name=None)
+    elif subcommand == "sync":
+        if len(args) < 2:
+            parser.error("need hook name")
+        db = make_db(options)
+        hook = Click.Hook.open(db, args[1])
+        try:
+            if options.packages:
+                hook.sync_only(None, options.packages)
+            else:
+                hook.sync(user_name=None)
+        except GLib.GError as e:
+            if e.domain == "click-hooks-error-quark":
+                print(e.message, file=sys.stderr)
+                return 1
+            else:
+                raise
     elif subcommand == "run-system":
-        db = Click.DB()
-        db.read(db_dir=None)
-        if options.root is not None:
-            db.add(options.root)
+        db = make_db(options)
         try:
-            Click.run_system_hooks(db)
+            Click.run_system_hooks_full(
+                db, force=options.force, jobs=max(options.jobs, 1))
         except GLib.GError as e:
             if e.domain == "click-hooks-error-quark":
                 print(e.message, file=sys.stderr)
@@ -75,12 +120,14 @@ def run(argv):
             else:
                 raise
     elif subcommand == "run-user":
-        db = Click.DB()
-        db.read(db_dir=None)
-        if options.root is not None:
-            db.add(options.root)
+        db = make_db(options)
         try:
-            Click.run_user_hooks(db, user_name=options.user)
+            if options.packages:
+                Click.run_user_hooks_for_packages(
+                    db, options.user, options.packages)
+            else:
+                Click.run_user_hooks_full(
+                    db, user_name=options.user, force=options.force)
         except GLib.GError as e:
             if e.domain == "click-hooks-error-quark":
                 print(e.message, file=sys.stderr)
@@ -89,6 +136,6 @@ def run(argv):
                 raise
     else:
         parser.error(
-            "unknown subcommand '%s' (known: install, remove, run-system,"
-            "run-user)" % subcommand)
+            "unknown subcommand '%s' (known: install, remove, sync, "
+            "run-system, run-user)" % subcommand)
     return 0
@@ -23,19 +23,68 @@ import sys
 
 from gi.repository import Click
 
-from click_package.json_helpers import json_array_to_python
+from click_package.json_helpers import json_object_to_python
 
 
-def list_packages(options):
+def foreach_package(options, func, fields=None):
     db = Click.DB()
     db.read(db_dir=None)
     if options.root is not None:
         db.add(options.root)
+
+    def callback(manifest):
+        func(json_object_to_python(manifest))
+        return True
+
     if options.all:
-        return json_array_to_python(db.get_manifests(all_versions=True))
+        if fields is None:
+            db.foreach_manifest(True, callback)
+        else:
+            db.foreach_manifest_with_fields(True, fields, callback)
     else:
         registry = Click.User.for_user(db, name=options.user)
-        return json_array_to_python(registry.get_manifests())
+        if fields is None:
+            registry.foreach_manifest(callback)
+        else:
+            registry.foreach_manifest_with_fields(fields, callback)
+
+
+def list_packages(options, fields=None):
+    ret = []
+    foreach_package(options, ret.append, fields=fields)
+    return ret
+
+
+def format_field(value):
+    if value is None:
+        return ""
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+    else:
+        return "%s" % value
+
+
+class ManifestArrayWriter:
+    """Write a JSON array of manifests one element at a time.
+
+    The output is the same as json.dump would produce for the whole list.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.first = True
+
+    def write(self, manifest):
+        element = json.dumps(
+            manifest, ensure_ascii=False, sort_keys=True, indent=4,
+            separators=(",", ": "))
+        self.stream.write("[\n" if self.first else ",\n")
+        self.stream.write(
+            "\n".join("    " + line for line in element.splitlines()))
+        self.first = False
+
+    def close(self):
+        self.stream.write("[]" if self.first else "\n]")
 
 
 def run(argv):
@@ -51,14 +100,26 @@ def run(argv):
     parser.add_option(
         "--manifest", default=False, action="store_true",
         help="format output as a JSON array of manifests")
+    parser.add_option(
+        "--fields", metavar="FIELDS",
+        help="only output the comma-separated manifest FIELDS")
     options, _ = parser.parse_args(argv)
-    json_output = list_packages(options)
+    fields = None
+    if options.fields is not None:
+        fields = [field for field in options.fields.split(",") if field]
+        if not fields:
+            parser.error("--fields requires at least one field name")
     if options.manifest:
-        json.dump(
-            json_output, sys.stdout, ensure_ascii=False, sort_keys=True,
-            indent=4, separators=(",", ": "))
+        writer = ManifestArrayWriter(sys.stdout)
+        foreach_package(options, writer.write, fields=fields)
+        writer.close()
         print()
     else:
-        for manifest in json_output:
-            print("%s\t%s" % (manifest["name"], manifest["version"]))
+        if fields is None:
+            fields = ["name", "version"]
+        foreach_package(
+            options,
+            lambda manifest: print("\t".join(
+                format_field(manifest.get(field)) for field in fields)),
+            fields=fields)
     return 0
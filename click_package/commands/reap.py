@@ -0,0 +1,76 @@
+# Copyright (C) 2014 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Delete removed Click package versions and caches left in the trash."""
+
+from __future__ import print_function
+
+from optparse import OptionParser
+import os
+import sys
+
+from gi.repository import Click, GLib
+
+
+def reap(trash_dir, verbose):
+    reaper = Click.TrashReaper.new(trash_dir)
+    if verbose:
+        def progress(reaper, name):
+            print(
+                "Deleted %s (%d bytes freed so far)" %
+                (os.path.join(trash_dir, name), reaper.props.bytes_freed))
+
+        reaper.connect("progress", progress)
+    reaper.reap()
+    return reaper.props.bytes_freed
+
+
+def run(argv):
+    parser = OptionParser("%prog reap [options]")
+    parser.add_option(
+        "--root", metavar="PATH", help="look for additional packages in PATH")
+    parser.add_option(
+        "--user-cache", default=False, action="store_true",
+        help="empty the current user's cache trash rather than the "
+             "databases' trash")
+    parser.add_option(
+        "--no-nice", dest="nice", default=True, action="store_false",
+        help="run at normal rather than low priority")
+    parser.add_option(
+        "-v", "--verbose", default=False, action="store_true",
+        help="report progress")
+    options, _ = parser.parse_args(argv)
+    if options.nice:
+        os.nice(19)
+    if options.user_cache:
+        trash_dirs = [Click.get_user_cache_trash_dir()]
+    else:
+        db = Click.DB()
+        db.read(db_dir=None)
+        if options.root is not None:
+            db.add(options.root)
+        trash_dirs = [
+            db.get(i).get_trash_dir() for i in range(db.props.size)]
+    total = 0
+    for trash_dir in trash_dirs:
+        try:
+            total += reap(trash_dir, options.verbose)
+        except GLib.GError as e:
+            print(
+                "Cannot empty %s: %s" % (trash_dir, e.message),
+                file=sys.stderr)
+            return 1
+    if options.verbose:
+        print("Freed %d bytes" % total)
+    return 0
@@ -17,13 +17,43 @@
 
 from __future__ import print_function
 
+import io
+import json
 from optparse import OptionParser
+import sys
 
 from gi.repository import Click, GLib
 
 
+def read_registrations(path):
+    """Read (name, version) pairs from a file of JSON lines.
+
+    Each non-blank line must be an object with "name" and "version"
+    members.  A path of "-" means standard input.
+    """
+    if path == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with io.open(path, encoding="UTF-8") as f:
+            lines = f.readlines()
+    registrations = []
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            registrations.append((entry["name"], entry["version"]))
+        except (ValueError, KeyError, TypeError):
+            raise ValueError(
+                "%s:%d: expected an object with name and version" %
+                (path, lineno))
+    return registrations
+
+
 def run(argv):
-    parser = OptionParser("%prog register [options] PACKAGE-NAME VERSION")
+    parser = OptionParser(
+        "%prog register [options] PACKAGE-NAME VERSION\n"
+        "       %prog register [options] --from-file FILE")
     parser.add_option(
         "--root", metavar="PATH", help="look for additional packages in PATH")
     parser.add_option(
@@ -32,26 +62,47 @@ def run(argv):
     parser.add_option(
         "--all-users", default=False, action="store_true",
         help="register package for all users")
+    parser.add_option(
+        "--from-file", metavar="FILE",
+        help="register each package listed in FILE as JSON lines of the "
+             "form {\"name\": ..., \"version\": ...} (- for standard "
+             "input)")
     options, args = parser.parse_args(argv)
-    if len(args) < 1:
-        parser.error("need package name")
-    if len(args) < 2:
-        parser.error("need version")
+    if options.from_file is not None:
+        if args:
+            parser.error("--from-file takes no package arguments")
+        try:
+            registrations = read_registrations(options.from_file)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    else:
+        if len(args) < 1:
+            parser.error("need package name")
+        if len(args) < 2:
+            parser.error("need version")
+        registrations = [(args[0], args[1])]
     db = Click.DB()
     db.read(db_dir=None)
     if options.root is not None:
         db.add(options.root)
-    package = args[0]
-    version = args[1]
     if options.all_users:
         registry = Click.User.for_all_users(db)
     else:
         registry = Click.User.for_user(db, name=options.user)
-    try:
-        old_version = registry.get_version(package)
-    except GLib.GError:
-        old_version = None
-    registry.set_version(package, version)
-    if old_version is not None:
-        db.maybe_remove(package, old_version)
+    old_versions = []
+    for package, _ in registrations:
+        try:
+            old_versions.append(registry.get_version(package))
+        except GLib.GError:
+            old_versions.append(None)
+    if options.from_file is not None:
+        registry.set_versions(
+            [package for package, _ in registrations],
+            [version for _, version in registrations])
+    else:
+        package, version = registrations[0]
+        registry.set_version(package, version)
+    for (package, _), old_version in zip(registrations, old_versions):
+        if old_version is not None:
+            db.maybe_remove(package, old_version)
     return 0
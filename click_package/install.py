@@ -44,7 +44,7 @@ from contextlib import closing
 
 from debian.debfile import DebFile as _DebFile
 from debian.debian_support import Version
-from gi.repository import Click
+from gi.repository import Click, GLib
 
 from click_package.paths import preload_path
 from click_package.preinst import static_preinst_matches
@@ -458,10 +458,12 @@ class ClickInstaller:
             pw = pwd.getpwnam("clickpkg")
             os.chown(new_path, pw.pw_uid, pw.pw_gid, follow_symlinks=False)
         os.rename(new_path, current_path)
+        self.db.get(self.db.props.size - 1).record_unpack(
+            package_name, package_version)
 
         return package_name, package_version, old_version
 
-    def install(self, path, user=None, all_users=False, quiet=True):
+    def _install(self, path, user=None, all_users=False, quiet=True):
         package_name, package_version, old_version = self._unpack(
             path, user=user, all_users=all_users, quiet=quiet)
 
@@ -480,3 +482,17 @@ class ClickInstaller:
 
         if old_version is not None:
             self.db.maybe_remove(package_name, old_version)
+
+    def install(self, path, user=None, all_users=False, quiet=True):
+        # Run each affected hook's commands once, after the package has
+        # been unpacked, registered, and any old version removed.
+        transaction = Click.HookTransaction.begin(self.db)
+        try:
+            self._install(path, user=user, all_users=all_users, quiet=quiet)
+        except Exception:
+            try:
+                transaction.commit()
+            except GLib.GError:
+                pass
+            raise
+        transaction.commit()
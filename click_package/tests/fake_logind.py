@@ -0,0 +1,96 @@
+# Copyright (C) 2014 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fake logind and AccountsService services for tests.
+
+Usage: fake_logind.py BUS-ADDRESS USERS-JSON
+
+USERS-JSON is a list of [uid, name, system_account] triples.  Prints
+"ready" once both services can be found on the bus at BUS-ADDRESS.
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+
+from gi.repository import Gio, GLib
+
+
+LOGIND_XML = """\
+<node>
+  <interface name="org.freedesktop.login1.Manager">
+    <method name="ListUsers">
+      <arg type="a(uso)" direction="out"/>
+    </method>
+  </interface>
+</node>
+"""
+
+ACCOUNTS_USER_XML = """\
+<node>
+  <interface name="org.freedesktop.Accounts.User">
+    <property name="SystemAccount" type="b" access="read"/>
+  </interface>
+</node>
+"""
+
+
+def request_name(connection, name):
+    connection.call_sync(
+        "org.freedesktop.DBus", "/org/freedesktop/DBus",
+        "org.freedesktop.DBus", "RequestName",
+        GLib.Variant("(su)", (name, 4)), None, Gio.DBusCallFlags.NONE, -1,
+        None)
+
+
+def main(argv):
+    address = argv[1]
+    users = json.loads(argv[2])
+    flags = (Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT
+             | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION)
+    connection = Gio.DBusConnection.new_for_address_sync(
+        address, flags, None, None)
+
+    def logind_method_call(connection, sender, object_path, interface_name,
+                           method_name, parameters, invocation):
+        user_list = [
+            (uid, name, "/org/freedesktop/login1/user/_%d" % uid)
+            for uid, name, _ in users]
+        invocation.return_value(GLib.Variant("(a(uso))", (user_list,)))
+
+    logind_info = Gio.DBusNodeInfo.new_for_xml(LOGIND_XML)
+    connection.register_object(
+        "/org/freedesktop/login1", logind_info.interfaces[0],
+        logind_method_call, None, None)
+
+    accounts_info = Gio.DBusNodeInfo.new_for_xml(ACCOUNTS_USER_XML)
+    for uid, name, system_account in users:
+        def get_property(connection, sender, object_path, interface_name,
+                         property_name, system_account=system_account):
+            return GLib.Variant("b", system_account)
+
+        connection.register_object(
+            "/org/freedesktop/Accounts/User%d" % uid,
+            accounts_info.interfaces[0], None, get_property, None)
+
+    request_name(connection, "org.freedesktop.login1")
+    request_name(connection, "org.freedesktop.Accounts")
+    print("ready")
+    sys.stdout.flush()
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
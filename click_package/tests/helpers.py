@@ -86,6 +86,11 @@ class TestCase(gimock.GIMockTestCase):
         self.temp_dir = None
         self.save_env = dict(os.environ)
         self.maxDiff = None
+        # Password file lookups and the list of logged-in users are cached
+        # for the whole process, which would leak mocked results from one
+        # test into another.
+        Click.invalidate_nss_cache()
+        Click.invalidate_logged_in_users_cache()
 
     def tearDown(self):
         for key in set(os.environ) - set(self.save_env):
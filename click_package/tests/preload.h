@@ -10,6 +10,12 @@
  */
 extern int chown (const char *file, uid_t owner, gid_t group);
 
+/**
+ * fchownat: (attributes headers=fcntl.h,unistd.h)
+ */
+extern int fchownat (int dirfd, const char *pathname, uid_t owner,
+                     gid_t group, int flags);
+
 /**
  * geteuid: (attributes headers=sys/types.h,unistd.h)
  */
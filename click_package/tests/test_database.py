@@ -22,6 +22,7 @@ __all__ = [
     "TestClickDB",
     "TestClickInstalledPackage",
     "TestClickSingleDB",
+    "TestTrashReaper",
     ]
 
 
@@ -29,6 +30,9 @@ from functools import partial
 from itertools import takewhile
 import json
 import os
+import shutil
+import tempfile
+from textwrap import dedent
 import unittest
 
 from gi.repository import Click, GLib
@@ -147,6 +151,71 @@ class TestClickSingleDB(TestCase):
         ], self._installed_packages_tuplify(
             self.db.get_packages(all_versions=True)))
 
+    def _age_tree(self, *paths):
+        # Directories modified within the current second are never trusted
+        # by the package index, so push them into the past.
+        for path in paths:
+            os.utime(path, (1000000000, 1000000000))
+
+    def test_packages_index_written(self):
+        os.makedirs(os.path.join(self.temp_dir, ".click"))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        os.symlink("1.0", os.path.join(self.temp_dir, "a", "current"))
+        self._age_tree(
+            os.path.join(self.temp_dir, "a"), self.temp_dir)
+        self.db.get_packages(all_versions=True)
+        with open(os.path.join(self.temp_dir, ".click", "index")) as f:
+            self.assertEqual([
+                "click-index 1",
+                "R\t1000000000",
+                "P\ta\t1000000000\t1.0",
+                "V\t1.0\t1\t-1",
+            ], f.read().splitlines())
+
+    def test_packages_index_trusted_until_changed(self):
+        os.makedirs(os.path.join(self.temp_dir, ".click"))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        self._age_tree(os.path.join(self.temp_dir, "a"), self.temp_dir)
+        with open(os.path.join(self.temp_dir, ".click", "index"), "w") as f:
+            print("click-index 1", file=f)
+            print("R\t1000000000", file=f)
+            print("P\ta\t1000000000\t", file=f)
+            print("V\t0.9\t0\t-1", file=f)
+        db = Click.DB()
+        db.add(self.temp_dir)
+        self.assertEqual([
+            ("a", "0.9", os.path.join(self.temp_dir, "a", "0.9")),
+        ], self._installed_packages_tuplify(
+            db.get(0).get_packages(all_versions=True)))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.1"))
+        self.assertEqual([
+            ("a", "1.0", os.path.join(self.temp_dir, "a", "1.0")),
+            ("a", "1.1", os.path.join(self.temp_dir, "a", "1.1")),
+        ], self._installed_packages_tuplify(
+            db.get(0).get_packages(all_versions=True)))
+
+    def test_packages_index_corrupt(self):
+        os.makedirs(os.path.join(self.temp_dir, ".click"))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        with open(os.path.join(self.temp_dir, ".click", "index"), "w") as f:
+            print("click-index 1", file=f)
+            print("garbage", file=f)
+        self.assertEqual([
+            ("a", "1.0", os.path.join(self.temp_dir, "a", "1.0")),
+        ], self._installed_packages_tuplify(
+            self.db.get_packages(all_versions=True)))
+
+    def test_packages_no_index(self):
+        os.makedirs(os.path.join(self.temp_dir, ".click"))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        self.db.props.use_index = False
+        self.assertEqual([
+            ("a", "1.0", os.path.join(self.temp_dir, "a", "1.0")),
+        ], self._installed_packages_tuplify(
+            self.db.get_packages(all_versions=True)))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, ".click", "index")))
+
     def test_manifest(self):
         manifest_path = os.path.join(
             self.temp_dir, "a", "1.0", ".click", "info", "a.manifest")
@@ -226,6 +295,67 @@ class TestClickSingleDB(TestCase):
                 self.g_spawn_sync_side_effect, {b"lomiri-app-pid": 1 << 8})
             self.assertFalse(self.db.any_app_running("a", "1.0"))
 
+    def _make_proc(self, processes):
+        proc_dir = tempfile.mkdtemp(prefix="click-proc")
+        self.addCleanup(shutil.rmtree, proc_dir)
+        for pid, files in processes.items():
+            for name, contents in files.items():
+                with mkfile(os.path.join(proc_dir, str(pid), name)) as f:
+                    f.write(contents)
+        os.mkdir(os.path.join(proc_dir, "sys"))
+        self.master_db.props.proc_dir = proc_dir
+
+    def test_get_running_apps_app_pid(self):
+        with self.run_in_subprocess(
+                "click_find_on_path") as (enter, preloads):
+            enter()
+            preloads["click_find_on_path"].side_effect = (
+                lambda command: command == b"lomiri-app-pid")
+            bin_dir = os.path.join(self.temp_dir, "bin")
+            app_pid_path = os.path.join(bin_dir, "lomiri-app-pid")
+            script = dedent("""\
+                #! /bin/sh
+                echo "$1" >>"%s"
+                case $1 in
+                    a_a-app_1.0|c_c-app_1.0) echo 1234 ;;
+                    *) exit 1 ;;
+                esac""") % os.path.join(self.temp_dir, "log")
+            with mkfile(app_pid_path) as app_pid:
+                print(script, file=app_pid)
+            os.chmod(app_pid_path, 0o755)
+            os.environ["PATH"] = "%s:%s" % (bin_dir, os.environ["PATH"])
+            self.assertEqual(
+                ["a_a-app_1.0", "c_c-app_1.0"],
+                self.db.get_running_apps(
+                    ["a_a-app_1.0", "b_b-app_1.0", "c_c-app_1.0"]))
+            with open(os.path.join(self.temp_dir, "log")) as log:
+                self.assertCountEqual(
+                    ["a_a-app_1.0", "b_b-app_1.0", "c_c-app_1.0"],
+                    log.read().splitlines())
+
+    def test_get_running_apps_proc(self):
+        with self.run_in_subprocess(
+                "click_find_on_path", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["click_find_on_path"].return_value = True
+            self._make_proc({
+                1: {"attr/current": "unconfined\n",
+                    "cgroup": "0::/init.scope\n"},
+                100: {"attr/current": "a_a-app_1.0 (enforce)\n"},
+                200: {"attr/current": "unconfined\n",
+                      "cgroup": (
+                          "0::/user.slice/user-1000.slice/"
+                          "user@1000.service/app.slice/"
+                          "lomiri-app-launch--application-click--"
+                          "b_b-app_1.0--.service\n")},
+                })
+            self.assertEqual(
+                ["a_a-app_1.0", "b_b-app_1.0"],
+                self.db.get_running_apps(
+                    ["a_a-app_1.0", "b_b-app_1.0", "c_c-app_1.0"]))
+            self.assertFalse(preloads["g_spawn_sync"].called)
+
     def test_any_app_running_no_app_pid_command(self):
         with self.run_in_subprocess(
                 "click_find_on_path", "g_spawn_sync",
@@ -333,6 +463,42 @@ class TestClickSingleDB(TestCase):
             self.db.maybe_remove("a", "1.0")
             self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "a")))
 
+    def test_maybe_remove_moves_to_trash(self):
+        with self.run_in_subprocess(
+                "click_find_on_path", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            os.environ["TEST_QUIET"] = "1"
+            version_path = os.path.join(self.temp_dir, "a", "1.0")
+            manifest_path = os.path.join(
+                version_path, ".click", "info", "a.manifest")
+            with mkfile(manifest_path) as manifest:
+                json.dump({"hooks": {"a-app": {}}}, manifest)
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"lomiri-app-pid": 1 << 8})
+            preloads["click_find_on_path"].return_value = True
+            self.db.maybe_remove("a", "1.0")
+            self.assertFalse(os.path.exists(version_path))
+            trash_dir = self.db.get_trash_dir()
+            self.assertEqual(
+                os.path.join(self.temp_dir, ".click", "trash"), trash_dir)
+            holders = os.listdir(trash_dir)
+            self.assertEqual(1, len(holders))
+            self.assertTrue(os.path.exists(os.path.join(
+                trash_dir, holders[0], "1.0", ".click", "info",
+                "a.manifest")))
+
+    def test_gc_empties_trash(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            trash_dir = self.db.get_trash_dir()
+            touch(os.path.join(trash_dir, "XXXXXX", "1.0", "file"))
+            self.db.gc()
+            self.assertEqual([], os.listdir(trash_dir))
+
     def test_gc(self):
         with self.run_in_subprocess(
                 "click_find_on_path", "g_spawn_sync", "getpwnam"
@@ -373,6 +539,181 @@ class TestClickSingleDB(TestCase):
             self.assertFalse(os.path.exists(b_path))
             self.assertFalse(os.path.exists(c_path))
 
+    def test_gc_keeps_running(self):
+        with self.run_in_subprocess(
+                "g_spawn_sync", "getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            paths = {}
+            for package in "a", "b", "c":
+                paths[package] = os.path.join(self.temp_dir, package, "1.0")
+                with mkfile(os.path.join(
+                        paths[package], ".click", "info",
+                        "%s.manifest" % package)) as manifest:
+                    json.dump(
+                        {"hooks": {"%s-app" % package: {}}}, manifest)
+            self._make_proc({
+                100: {"attr/current": "a_a-app_1.0 (enforce)\n"},
+                200: {"attr/current": "c_c-app_1.0 (complain)\n"},
+                })
+            self.db.gc()
+            self.assertTrue(os.path.exists(paths["a"]))
+            self.assertFalse(os.path.exists(paths["b"]))
+            self.assertTrue(os.path.exists(paths["c"]))
+            self.assertFalse(preloads["g_spawn_sync"].called)
+
+    def _make_gc_journal_test(self):
+        for package in "a", "b":
+            with mkfile(os.path.join(
+                    self.temp_dir, package, "1.0", ".click", "info",
+                    "%s.manifest" % package)) as manifest:
+                json.dump({"hooks": {"%s-app" % package: {}}}, manifest)
+        a_user_path = os.path.join(
+            self.temp_dir, ".click", "users", "test-user", "a")
+        os.makedirs(os.path.dirname(a_user_path))
+        os.symlink(os.path.join(self.temp_dir, "a", "1.0"), a_user_path)
+        self._make_proc({})
+        self.db.record_unpack("a", "1.0")
+        self.db.gc()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir, "b", "1.0")))
+        # Something unpacks b without recording it in the journal.
+        with mkfile(os.path.join(
+                self.temp_dir, "b", "1.0", ".click", "info",
+                "b.manifest")) as manifest:
+            json.dump({"hooks": {"b-app": {}}}, manifest)
+
+    def test_gc_incremental(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            b_path = os.path.join(self.temp_dir, "b", "1.0")
+            self.db.gc()
+            self.assertTrue(os.path.exists(b_path))
+            self.db.record_unpack("b", "1.0")
+            self.db.gc()
+            self.assertFalse(os.path.exists(b_path))
+            self.assertTrue(os.path.exists(
+                os.path.join(self.temp_dir, "a", "1.0")))
+
+    def test_gc_truncated_journal(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            with open(os.path.join(
+                    self.temp_dir, ".click", "journal"), "w"):
+                pass
+            self.db.gc()
+            self.assertFalse(os.path.exists(
+                os.path.join(self.temp_dir, "b", "1.0")))
+
+    def test_gc_untrusted_journal(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            # Anyone could have written to this journal, so it is ignored.
+            os.chmod(os.path.join(self.temp_dir, ".click", "journal"), 0o666)
+            self.db.gc()
+            self.assertFalse(os.path.exists(
+                os.path.join(self.temp_dir, "b", "1.0")))
+
+    def test_gc_unjournalled_registration(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            touch(os.path.join(
+                self.temp_dir, ".click", "users", "test-user",
+                ".unjournalled"))
+            self.db.gc()
+            self.assertFalse(os.path.exists(
+                os.path.join(self.temp_dir, "b", "1.0")))
+
+    def test_gc_deleted_user(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            # The only user to register a is deleted, which the journal
+            # does not record.
+            preloads["getpwnam"].side_effect = (
+                lambda name: None if name == b"test-user" else
+                self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            Click.invalidate_nss_cache()
+            self.db.gc()
+            self.assertFalse(os.path.exists(
+                os.path.join(self.temp_dir, "a", "1.0")))
+
+    def test_gc_plan_incremental(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            self._make_gc_journal_test()
+            # The plan considers the same packages as gc, and does not
+            # move the checkpoint.
+            plan = json_object_to_python(self.master_db.get_gc_plan())
+            self.assertEqual([], plan["remove"])
+            b_path = os.path.join(self.temp_dir, "b", "1.0")
+            self.db.record_unpack("b", "1.0")
+            plan = json_object_to_python(self.master_db.get_gc_plan())
+            self.assertEqual(
+                [("b", "1.0")],
+                [(inst["package"], inst["version"])
+                 for inst in plan["remove"]])
+            self.assertTrue(os.path.exists(b_path))
+            self.db.gc()
+            self.assertFalse(os.path.exists(b_path))
+
+    def test_journal_records_changes(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            os.environ["TEST_QUIET"] = "1"
+            with mkfile(os.path.join(
+                    self.temp_dir, "a", "1.0", ".click", "info",
+                    "a.manifest")) as manifest:
+                json.dump({"hooks": {"a-app": {}}}, manifest)
+            self._make_proc({})
+            os.makedirs(os.path.join(self.temp_dir, ".click"))
+            self.db.record_unpack("a", "1.0")
+            registry = Click.User.for_user(self.master_db, "test-user")
+            registry.set_version("a", "1.0")
+            registry.remove("a")
+            self.db.maybe_remove("a", "1.0")
+            with open(os.path.join(
+                    self.temp_dir, ".click", "journal")) as journal:
+                lines = journal.read().splitlines()
+            self.assertTrue(lines[0].startswith("click-journal 1 "))
+            self.assertEqual(
+                [["unpack", "-", "a", "1.0"],
+                 ["register", "test-user", "a", "1.0"],
+                 ["unregister", "test-user", "a", "1.0"],
+                 ["remove", "-", "a", "1.0"]],
+                [line.split(" ")[1:] for line in lines[1:]])
+            offsets = [int(line.split(" ")[0]) for line in lines[1:]]
+            self.assertEqual(len(lines[0]) + 1, offsets[0])
+            self.assertEqual(offsets[0] + len(lines[1]) + 1, offsets[1])
+            self.assertEqual(0, os.stat(os.path.join(
+                self.temp_dir, ".click", "journal")).st_mode & 0o022)
+
     def test_gc_ignores_non_directory(self):
         with self.run_in_subprocess(
                 "getpwnam"
@@ -461,6 +802,30 @@ class TestClickSingleDB(TestCase):
             except:
                 self.fail("No user registration for 'test-package'")
 
+    def test_gc_keeps_version_when_reregistration_fails(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_dir=b"/foo")))
+            manifest = {"hooks": {"test-app": {"test": "foo"}}}
+            for version in "1.0", "3.0":
+                with mkfile(os.path.join(
+                        self.temp_dir, "test-package", version, ".click",
+                        "info", "test-package.manifest")) as f:
+                    json.dump(manifest, f)
+            version1 = os.path.join(self.temp_dir, "test-package", "1.0")
+            registration_path = os.path.join(
+                self.temp_dir, ".click", "users", "foo", "test-package")
+            os.makedirs(os.path.dirname(registration_path))
+            os.symlink(version1, registration_path)
+            # set_version cannot put its new link in place.
+            touch(os.path.join(
+                os.path.dirname(registration_path), ".test-package.new",
+                "blocker"))
+            self.db.gc()
+            self.assertEqual(version1, os.readlink(registration_path))
+            self.assertTrue(os.path.exists(version1))
+
     def _make_ownership_test(self):
         path = os.path.join(self.temp_dir, "a", "1.0")
         touch(os.path.join(path, ".click", "info", "a.manifest"))
@@ -481,6 +846,87 @@ class TestClickSingleDB(TestCase):
                 preloads[func_name].side_effect = (
                     partial(side_effect, func_name, limit, 3))
 
+    def test_gc_plan_reregistration(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_dir=b"/foo")))
+            manifest = {"hooks": {"test-app": {"test": "foo"}}}
+            for version in "1.0", "3.0":
+                with mkfile(os.path.join(
+                        self.temp_dir, "test-package", version, ".click",
+                        "info", "test-package.manifest")) as f:
+                    json.dump(manifest, f)
+            version1 = os.path.join(self.temp_dir, "test-package", "1.0")
+            registration_path = os.path.join(
+                self.temp_dir, ".click", "users", "foo", "test-package")
+            os.makedirs(os.path.dirname(registration_path))
+            os.symlink(version1, registration_path)
+            plan = json_object_to_python(self.db.get_gc_plan())
+            self.assertEqual([{
+                "user": "foo", "package": "test-package",
+                "old-version": "1.0", "new-version": "3.0",
+                }], plan["reregister"])
+            self.assertEqual(
+                [("test-package", "1.0")],
+                [(inst["package"], inst["version"])
+                 for inst in plan["remove"]])
+            self.assertEqual(version1, os.readlink(registration_path))
+
+    def test_gc_plan(self):
+        with self.run_in_subprocess("getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
+            a_path = os.path.join(self.temp_dir, "a", "1.0")
+            with mkfile(os.path.join(
+                    a_path, ".click", "info", "a.manifest")) as manifest:
+                json.dump({"hooks": {"a-app": {}}}, manifest)
+            b_path = os.path.join(self.temp_dir, "b", "1.0")
+            with mkfile(os.path.join(
+                    b_path, ".click", "info", "b.manifest")) as manifest:
+                json.dump({"hooks": {"b-app": {}}}, manifest)
+            c_path = os.path.join(self.temp_dir, "c", "1.0")
+            with mkfile(os.path.join(
+                    c_path, ".click", "info", "c.manifest")) as manifest:
+                json.dump({"hooks": {"c-app": {}}}, manifest)
+            a_user_path = os.path.join(
+                self.temp_dir, ".click", "users", "test-user", "a")
+            os.makedirs(os.path.dirname(a_user_path))
+            os.symlink(a_path, a_user_path)
+            self._make_proc({1: {"attr/current": "c_c-app_1.0 (enforce)\n"}})
+            plan = json_object_to_python(self.db.get_gc_plan())
+            self.assertEqual([], plan["reregister"])
+            self.assertEqual(
+                [("b", "1.0", b_path)],
+                [(inst["package"], inst["version"], inst["path"])
+                 for inst in plan["remove"]])
+            self.assertGreater(plan["remove"][0]["size"], 0)
+            self.assertEqual(plan["remove"][0]["size"], plan["size"])
+            self.assertEqual(
+                [("c", "1.0", c_path)],
+                [(inst["package"], inst["version"], inst["path"])
+                 for inst in plan["running"]])
+            self.assertTrue(os.path.exists(a_path))
+            self.assertTrue(os.path.exists(b_path))
+            self.assertTrue(os.path.exists(c_path))
+
+    def _set_fchownat_side_effect(self, preloads, result=0):
+        # Record the full path of each entry whose ownership is changed.
+        self.chown_calls = []
+
+        def fchownat_side_effect(dirfd, pathname, owner, group, flags):
+            if dirfd == -100:  # AT_FDCWD
+                path = os.path.realpath(pathname)
+            else:
+                path = os.path.join(
+                    os.readlink("/proc/self/fd/%d" % dirfd).encode(),
+                    pathname)
+            self.chown_calls.append((path, owner, group))
+            return result
+
+        preloads["fchownat"].side_effect = fchownat_side_effect
+
     def test_ensure_ownership_quick_if_correct(self):
         def stat_side_effect(name, limit, ver, path, buf):
             st = self.convert_stat_pointer(name, buf)
@@ -493,7 +939,7 @@ class TestClickSingleDB(TestCase):
                 return -1
 
         with self.run_in_subprocess(
-                "chown", "getpwnam", *self.STAT_FUNCTIONS
+                "fchownat", "getpwnam", *self.STAT_FUNCTIONS
                 ) as (enter, preloads):
             enter()
             preloads["getpwnam"].side_effect = (
@@ -503,7 +949,7 @@ class TestClickSingleDB(TestCase):
 
             self._make_ownership_test()
             self.db.ensure_ownership()
-            self.assertFalse(preloads["chown"].called)
+            self.assertFalse(preloads["fchownat"].called)
 
     def test_ensure_ownership(self):
         def stat_side_effect(name, limit, ver, path, buf):
@@ -517,7 +963,7 @@ class TestClickSingleDB(TestCase):
                 return -1
 
         with self.run_in_subprocess(
-                "chown", "getpwnam", *self.STAT_FUNCTIONS
+                "fchownat", "getpwnam", *self.STAT_FUNCTIONS
                 ) as (enter, preloads):
             enter()
             preloads["getpwnam"].side_effect = (
@@ -525,27 +971,58 @@ class TestClickSingleDB(TestCase):
             self._set_stat_side_effect(
                 preloads, stat_side_effect, self.db.props.root)
 
+            self._set_fchownat_side_effect(preloads)
+
             self._make_ownership_test()
             self.db.ensure_ownership()
+            temp_dir = os.path.realpath(self.temp_dir)
             expected_paths = [
-                self.temp_dir,
-                os.path.join(self.temp_dir, ".click"),
-                os.path.join(self.temp_dir, ".click", "log"),
-                os.path.join(self.temp_dir, ".click", "users"),
-                os.path.join(self.temp_dir, "a"),
-                os.path.join(self.temp_dir, "a", "1.0"),
-                os.path.join(self.temp_dir, "a", "1.0", ".click"),
-                os.path.join(self.temp_dir, "a", "1.0", ".click", "info"),
+                temp_dir,
+                os.path.join(temp_dir, ".click"),
+                os.path.join(temp_dir, ".click", "log"),
+                os.path.join(temp_dir, ".click", "users"),
+                os.path.join(temp_dir, "a"),
+                os.path.join(temp_dir, "a", "1.0"),
+                os.path.join(temp_dir, "a", "1.0", ".click"),
+                os.path.join(temp_dir, "a", "1.0", ".click", "info"),
                 os.path.join(
-                    self.temp_dir, "a", "1.0", ".click", "info", "a.manifest"),
-                os.path.join(self.temp_dir, "a", "current"),
+                    temp_dir, "a", "1.0", ".click", "info", "a.manifest"),
+                os.path.join(temp_dir, "a", "current"),
                 ]
             self.assertCountEqual(
                 [path.encode() for path in expected_paths],
-                [args[0][0] for args in preloads["chown"].call_args_list])
+                [call[0] for call in self.chown_calls])
             self.assertCountEqual(
-                [(1, 1)],
-                set(args[0][1:] for args in preloads["chown"].call_args_list))
+                [(1, 1)], set(call[1:] for call in self.chown_calls))
+
+    def test_ensure_ownership_full_skips_correct(self):
+        def stat_side_effect(name, limit, ver, path, buf):
+            st = self.convert_stat_pointer(name, buf)
+            if path == limit:
+                st.st_uid = 2
+                st.st_gid = 2
+                return 0
+            else:
+                self.delegate_to_original(name)
+                return -1
+
+        with self.run_in_subprocess(
+                "fchownat", "getpwnam", *self.STAT_FUNCTIONS
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            self._set_stat_side_effect(
+                preloads, stat_side_effect, self.db.props.root)
+
+            self._make_ownership_test()
+            touch(os.path.join(
+                self.temp_dir, "b", "1.0", ".click", "info", "b.manifest"))
+            visited, changed = self.db.ensure_ownership_full(2)
+            self.assertEqual(15, visited)
+            self.assertEqual(0, changed)
+            self.assertFalse(preloads["fchownat"].called)
 
     def test_ensure_ownership_missing_clickpkg_user(self):
         with self.run_in_subprocess("getpwnam") as (enter, preloads):
@@ -566,10 +1043,10 @@ class TestClickSingleDB(TestCase):
                 return -1
 
         with self.run_in_subprocess(
-                "chown", "getpwnam", *self.STAT_FUNCTIONS
+                "fchownat", "getpwnam", *self.STAT_FUNCTIONS
                 ) as (enter, preloads):
             enter()
-            preloads["chown"].return_value = -1
+            self._set_fchownat_side_effect(preloads, result=-1)
             preloads["getpwnam"].side_effect = (
                 lambda name: self.make_pointer(Passwd(pw_uid=1, pw_gid=1)))
             self._set_stat_side_effect(
@@ -580,6 +1057,41 @@ class TestClickSingleDB(TestCase):
                 Click.DatabaseError.ENSURE_OWNERSHIP, self.db.ensure_ownership)
 
 
+class TestTrashReaper(TestCase):
+    def setUp(self):
+        super(TestTrashReaper, self).setUp()
+        self.use_temp_dir()
+        self.trash_dir = os.path.join(self.temp_dir, "trash")
+
+    def test_reap_missing(self):
+        reaper = Click.TrashReaper.new(self.trash_dir)
+        reaper.reap()
+        self.assertEqual(0, reaper.props.bytes_freed)
+        self.assertEqual(0, reaper.props.files_removed)
+
+    def test_reap(self):
+        with mkfile(os.path.join(self.trash_dir, "1", "a", "file")) as f:
+            f.write("x" * 10000)
+        touch(os.path.join(self.trash_dir, "2", "b", "c", "file"))
+        reaper = Click.TrashReaper.new(self.trash_dir)
+        reaped = []
+        reaper.connect("progress", lambda reaper, name: reaped.append(name))
+        reaper.reap()
+        self.assertEqual([], os.listdir(self.trash_dir))
+        self.assertEqual(["1", "2"], sorted(reaped))
+        self.assertEqual(7, reaper.props.files_removed)
+        self.assertGreater(reaper.props.bytes_freed, 0)
+
+    def test_reap_does_not_follow_symlinks(self):
+        canary = os.path.join(self.temp_dir, "canary")
+        touch(os.path.join(canary, "file"))
+        os.makedirs(os.path.join(self.trash_dir, "1"))
+        os.symlink(canary, os.path.join(self.trash_dir, "1", "link"))
+        Click.TrashReaper.new(self.trash_dir).reap()
+        self.assertEqual([], os.listdir(self.trash_dir))
+        self.assertTrue(os.path.exists(os.path.join(canary, "file")))
+
+
 class TestClickDB(TestCase):
     def setUp(self):
         super(TestClickDB, self).setUp()
@@ -605,6 +1117,21 @@ class TestClickDB(TestCase):
             ["/a", "/b", "/c"],
             [db.get(i).props.root for i in range(db.props.size)])
 
+    def test_read_proc_dir(self):
+        with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
+            print("[Click Database]", file=a)
+            print("root = /a", file=a)
+        db = Click.DB()
+        db.read(db_dir=self.temp_dir)
+        self.assertIsNone(db.props.proc_dir)
+        with open(os.path.join(self.temp_dir, "b.conf"), "w") as b:
+            print("[Click Database]", file=b)
+            print("root = /b", file=b)
+            print("proc = /proc", file=b)
+        db = Click.DB()
+        db.read(db_dir=self.temp_dir)
+        self.assertEqual("/proc", db.props.proc_dir)
+
     def test_no_read(self):
         with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
             print("[Click Database]", file=a)
@@ -680,6 +1207,33 @@ class TestClickDB(TestCase):
             os.path.join(self.temp_dir, "b", "pkg", "1.1"),
             db.get_path("pkg", "1.1"))
 
+    def test_path_removed_version(self):
+        with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
+            print("[Click Database]", file=a)
+            print("root = %s" % os.path.join(self.temp_dir, "a"), file=a)
+        with open(os.path.join(self.temp_dir, "b.conf"), "w") as b:
+            print("[Click Database]", file=b)
+            print("root = %s" % os.path.join(self.temp_dir, "b"), file=b)
+        db = Click.DB()
+        db.read(db_dir=self.temp_dir)
+        a_pkg = os.path.join(self.temp_dir, "a", "pkg")
+        b_pkg = os.path.join(self.temp_dir, "b", "pkg")
+        os.makedirs(os.path.join(a_pkg, "1.0"))
+        os.makedirs(os.path.join(b_pkg, "1.0"))
+        # Make sure that the versions we find are trusted, so that only
+        # the change in modification time tells us to look again.
+        os.utime(a_pkg, (0, 0))
+        os.utime(b_pkg, (0, 0))
+        self.assertEqual(
+            os.path.join(a_pkg, "1.0"), db.get_path("pkg", "1.0"))
+        os.rmdir(os.path.join(a_pkg, "1.0"))
+        self.assertEqual(
+            os.path.join(b_pkg, "1.0"), db.get_path("pkg", "1.0"))
+        shutil.rmtree(b_pkg)
+        self.assertFalse(db.has_package_version("pkg", "1.0"))
+        self.assertRaisesDatabaseError(
+            Click.DatabaseError.DOES_NOT_EXIST, db.get_path, "pkg", "1.0")
+
     def test_has_package_version(self):
         with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
             print("[Click Database]", file=a)
@@ -794,6 +1348,30 @@ class TestClickDB(TestCase):
             b_manifest_obj,
             json.loads(db.get_manifest_as_string("pkg", "1.1")))
 
+    def test_manifest_cache(self):
+        db = Click.DB()
+        db.add(self.temp_dir)
+        manifest_path = os.path.join(
+            self.temp_dir, "pkg", "1.0", ".click", "info", "pkg.manifest")
+        with mkfile(manifest_path) as manifest:
+            json.dump({"name": "pkg", "version": "1.0"}, manifest)
+        # Manifests modified within the current second are never trusted.
+        os.utime(manifest_path, (1000000000, 1000000000))
+        self.assertEqual(0, db.props.manifest_cache_misses)
+        first = json_object_to_python(db.get_manifest("pkg", "1.0"))
+        self.assertEqual(1, db.props.manifest_cache_misses)
+        self.assertEqual(0, db.props.manifest_cache_hits)
+        self.assertEqual(
+            first, json_object_to_python(db.get_manifest("pkg", "1.0")))
+        self.assertEqual(1, db.props.manifest_cache_misses)
+        self.assertEqual(1, db.props.manifest_cache_hits)
+        with mkfile(manifest_path) as manifest:
+            json.dump({"name": "pkg", "version": "1.0", "extra": 1}, manifest)
+        os.utime(manifest_path, (1000000001, 1000000001))
+        self.assertEqual(
+            1, json_object_to_python(db.get_manifest("pkg", "1.0"))["extra"])
+        self.assertEqual(2, db.props.manifest_cache_misses)
+
     def test_manifest_bad(self):
         with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
             print("[Click Database]", file=a)
@@ -915,3 +1493,77 @@ class TestClickDB(TestCase):
         self.assertEqual(
             [b_pkg1_manifest_obj, b_pkg2_manifest_obj, a_pkg1_manifest_obj],
             json.loads(db.get_manifests_as_string(all_versions=True)))
+
+    def test_foreach_manifest(self):
+        with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
+            print("[Click Database]", file=a)
+            print("root = %s" % os.path.join(self.temp_dir, "a"), file=a)
+        db = Click.DB()
+        db.read(db_dir=self.temp_dir)
+        for name in "pkg1", "pkg2", "pkg3":
+            with mkfile(os.path.join(
+                    self.temp_dir, "a", name, "1.0", ".click", "info",
+                    "%s.manifest" % name)) as manifest:
+                json.dump({"name": name, "version": "1.0"}, manifest)
+        seen = []
+
+        def callback(manifest):
+            seen.append(json_object_to_python(manifest)["name"])
+            return len(seen) < 2
+
+        db.foreach_manifest(True, callback)
+        self.assertEqual(["pkg1", "pkg2"], seen)
+
+        with open(os.path.join(self.temp_dir, "out"), "w+") as out:
+            db.write_manifests(out.fileno(), all_versions=True)
+            out.seek(0)
+            self.assertEqual(
+                json_array_to_python(db.get_manifests(all_versions=True)),
+                json.load(out))
+
+    def test_get_manifests_with_fields(self):
+        with open(os.path.join(self.temp_dir, "a.conf"), "w") as a:
+            print("[Click Database]", file=a)
+            print("root = %s" % os.path.join(self.temp_dir, "a"), file=a)
+        db = Click.DB()
+        db.read(db_dir=self.temp_dir)
+        pkg1_path = os.path.join(self.temp_dir, "a", "pkg1", "1.0")
+        with mkfile(os.path.join(
+                pkg1_path, ".click", "info", "pkg1.manifest")) as manifest:
+            json.dump(
+                {"name": "pkg1", "version": "1.0", "title": "Package 1"},
+                manifest)
+        os.symlink("1.0", os.path.join(self.temp_dir, "a", "pkg1", "current"))
+        # Packages without a manifest are skipped, but manifests are not
+        # parsed if only the name and version are needed.
+        pkg2_path = os.path.join(self.temp_dir, "a", "pkg2", "2.0")
+        os.makedirs(pkg2_path)
+        os.symlink("2.0", os.path.join(self.temp_dir, "a", "pkg2", "current"))
+        self.assertEqual(
+            [{"name": "pkg1", "version": "1.0"}],
+            json_array_to_python(
+                db.get_manifests_with_fields(True, ["name", "version"])))
+        with mkfile(os.path.join(
+                pkg2_path, ".click", "info", "pkg2.manifest")) as manifest:
+            print("not json", file=manifest)
+        self.assertEqual(
+            [
+                {"name": "pkg1", "version": "1.0"},
+                {"name": "pkg2", "version": "2.0"},
+            ],
+            json_array_to_python(
+                db.get_manifests_with_fields(True, ["name", "version"])))
+        with mkfile(os.path.join(
+                pkg2_path, ".click", "info", "pkg2.manifest")) as manifest:
+            json.dump({"name": "pkg2", "version": "2.0"}, manifest)
+        self.assertEqual(
+            [
+                {
+                    "title": "Package 1",
+                    "_directory": pkg1_path,
+                    "_removable": 1,
+                },
+                {"_directory": pkg2_path, "_removable": 1},
+            ],
+            json_array_to_python(db.get_manifests_with_fields(
+                False, ["title", "_directory", "_removable"])))
@@ -31,6 +31,8 @@ from functools import partial
 from itertools import takewhile
 import json
 import os
+import shutil
+import tempfile
 from textwrap import dedent
 
 from gi.repository import Click, GLib
@@ -93,6 +95,31 @@ class TestClickPatternFormatter(TestCase):
             Click.pattern_possible_expansion(
                 "x_abc_1", "x_${id}_${num}", self._make_variant(num="2")))
 
+    def test_pattern_matcher(self):
+        matcher = Click.PatternMatcher.new(
+            "x_${id}_${num}", self._make_variant(num="1"))
+        self.assertEqual({"id": "abc"}, matcher.match("x_abc_1").unpack())
+        self.assertEqual({"id": "d_e"}, matcher.match("x_d_e_1").unpack())
+        self.assertIsNone(matcher.match("x_abc_2"))
+
+    def test_pattern_matcher_agrees_with_possible_expansion(self):
+        # Hooks compile each pattern once and match every directory entry
+        # against that, so a compiled matcher must give exactly the same
+        # answers as pattern_possible_expansion.
+        names = [
+            "/links/package%d_app_1.0.test" % i for i in range(20)] + [
+            "/links/package.other", "/elsewhere/package_app_1.0.test"]
+        pattern = "/links/${id}.test"
+        args = self._make_variant(user=None, home=None)
+        matcher = Click.PatternMatcher.new(pattern, args)
+        for name in names:
+            expected = Click.pattern_possible_expansion(name, pattern, args)
+            matched = matcher.match(name)
+            if expected is None:
+                self.assertIsNone(matched)
+            else:
+                self.assertEqual(expected.unpack(), matched.unpack())
+
 
 class TestClickHookBase(TestCase):
 
@@ -122,6 +149,14 @@ class TestClickHookBase(TestCase):
             db = Click.User.for_user(self.db, self.TEST_USER)
         db.set_version(package, version)
 
+    def _backdate(self):
+        # Changes made in the current second are never trusted.
+        then = 1000000000
+        for dirpath, _, _ in os.walk(self.temp_dir):
+            os.utime(dirpath, (then, then))
+        journal = os.path.join(self.temp_dir, ".click", "journal")
+        os.utime(journal, (then, then))
+
     def _make_hook_file(self, content, hookname="test"):
         hook_file = os.path.join(self.hooks_dir, "%s.hook" % hookname)
         with mkfile(hook_file) as f:
@@ -198,6 +233,42 @@ class TestClickHookSystemLevel(TestClickHookBase):
             hook = Click.Hook.open(self.db, "test")
             self.assertEqual("other", hook.get_hook_name())
 
+    def test_hooks_dir_parsed_once(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir") as (enter, preloads):
+            enter()
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            for name, hook_name in ("one", "a"), ("two", "b"):
+                content = dedent("""\
+                    Hook-Name: %s
+                    Pattern: /usr/share/%s/${id}.test""") % (hook_name, name)
+                self._make_hook_file(content, hookname=name)
+
+            def patterns(hook_name=None):
+                return [
+                    hook.get_field("pattern")
+                    for hook in Click.Hook.open_all(self.db, hook_name)]
+
+            # Directories modified within the current second are never
+            # trusted.
+            os.utime(self.hooks_dir, (1000000000, 1000000000))
+            self.assertEqual(["/usr/share/one/${id}.test"], patterns("a"))
+            self.assertEqual(["/usr/share/two/${id}.test"], patterns("b"))
+            self.assertEqual([], patterns("c"))
+            self.assertEqual(2, len(patterns()))
+            self.assertEqual(
+                "b", Click.Hook.open(self.db, "two").get_hook_name())
+            self.assertEqual(1, self.db.props.hook_registry_loads)
+            self._make_hook_file(dedent("""\
+                Hook-Name: a
+                Pattern: /usr/share/three/${id}.test"""), hookname="three")
+            os.utime(self.hooks_dir, (1000000001, 1000000001))
+            self.assertEqual(
+                ["/usr/share/one/${id}.test", "/usr/share/three/${id}.test"],
+                patterns("a"))
+            self.assertEqual(2, self.db.props.hook_registry_loads)
+
     def test_invalid_app_id(self):
         with self.run_in_subprocess(
                 "click_get_hooks_dir") as (enter, preloads):
@@ -493,6 +564,213 @@ class TestClickHookSystemLevel(TestClickHookBase):
                 os.readlink(path_2_1_1))
             self.assertFalse(os.path.lexists(path_3))
 
+    def test_run_system_hooks_skips_unchanged(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            os.environ["TEST_QUIET"] = "1"
+            links_dir = tempfile.mkdtemp(prefix="click-links")
+            self.addCleanup(shutil.rmtree, links_dir)
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file("Pattern: %s/${id}.test" % links_dir)
+            self._make_installed_click("test-1", "1.0", json_data={
+                "hooks": {"test1-app": {"test": "target-1"}}})
+            path = os.path.join(links_dir, "test-1_test1-app_1.0.test")
+            self._backdate()
+            Click.run_system_hooks(self.db)
+            self.assertTrue(os.path.lexists(path))
+            # Nothing that the hooks depend on has changed, so a missing
+            # link is not noticed ...
+            os.unlink(path)
+            self._backdate()
+            Click.run_system_hooks(self.db)
+            self.assertFalse(os.path.lexists(path))
+            # ... unless forced.
+            Click.run_system_hooks_full(self.db, force=True, jobs=1)
+            self.assertTrue(os.path.lexists(path))
+
+    def test_run_system_hooks_after(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            os.environ["TEST_QUIET"] = "1"
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            for name, after in ("a", "c, b"), ("b", None), ("c", "b"):
+                os.mkdir(os.path.join(self.temp_dir, name))
+                self._make_hook_file(
+                    "Pattern: %s/%s/${id}\nExec: update-%s\nUser: root%s" % (
+                        self.temp_dir, name, name,
+                        "" if after is None else "\nAfter: %s" % after),
+                    hookname=name)
+            Click.run_system_hooks(self.db)
+            self.assertEqual([
+                [b"/bin/sh", b"-c", b"update-b"],
+                [b"/bin/sh", b"-c", b"update-c"],
+                [b"/bin/sh", b"-c", b"update-a"],
+            ], self.spawn_calls)
+
+    def test_run_system_hooks_parallel(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam") as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            os.environ["TEST_QUIET"] = "1"
+            # Each hook is synced by a separate click process.
+            fake_click = os.path.join(self.temp_dir, "bin", "click")
+            fake_click_output = os.path.join(self.temp_dir, "fake-click.out")
+            with mkfile(fake_click) as f:
+                print(dedent("""\
+                    #!/bin/sh
+                    echo "$@" >> %s
+                    [ "$3" != c ]""") % fake_click_output, file=f)
+            os.chmod(fake_click, 0o755)
+            os.environ["PATH"] = "%s:%s" % (
+                os.path.dirname(fake_click), os.environ["PATH"])
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file("Pattern: /a-${id}", hookname="a")
+            self._make_hook_file(
+                "Pattern: /b-${id}\nAfter: a", hookname="b")
+            self._make_hook_file("Pattern: /c-${id}", hookname="c")
+            self.assertRaisesHooksError(
+                Click.HooksError.INCOMPLETE, Click.run_system_hooks_full,
+                self.db, force=True, jobs=2)
+            with open(fake_click_output) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(
+                ["hook sync %s --db=%s" % (name, self.temp_dir)
+                 for name in ("a", "b", "c")],
+                sorted(calls))
+            self.assertLess(
+                calls.index("hook sync a --db=%s" % self.temp_dir),
+                calls.index("hook sync b --db=%s" % self.temp_dir))
+
+    def test_trigger_is_deferred(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            os.environ["TEST_QUIET"] = "1"
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file(dedent("""\
+                Pattern: %s/${id}.test
+                Exec: test-update
+                User: root
+                Trigger: yes""") % self.temp_dir)
+            hook = Click.Hook.open(self.db, "test")
+            self.assertTrue(hook.props.is_trigger)
+            hook.run_commands(user_name=None)
+            hook.run_commands(user_name=None)
+            trigger_path = os.path.join(
+                self.temp_dir, ".click", "triggers", "test")
+            self.assertTrue(os.path.exists(trigger_path))
+            self.assertEqual([], self.spawn_calls)
+            Click.run_system_hooks(self.db)
+            self.assertFalse(os.path.exists(trigger_path))
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+
+    def test_failed_trigger_stays_pending(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 1})
+            os.environ["TEST_QUIET"] = "1"
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file(dedent("""\
+                Pattern: %s/${id}.test
+                Exec: test-update
+                User: root
+                Trigger: yes""") % self.temp_dir)
+            Click.Hook.open(self.db, "test").run_commands(user_name=None)
+            Click.run_system_hooks(self.db)
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+            self.assertTrue(os.path.exists(os.path.join(
+                self.temp_dir, ".click", "triggers", "test")))
+
+    def test_trigger_dir_not_world_writable(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            os.environ["TEST_QUIET"] = "1"
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file(dedent("""\
+                Pattern: %s/${id}.test
+                Exec: test-update
+                User: root
+                Trigger: yes""") % self.temp_dir)
+            triggers_dir = os.path.join(self.temp_dir, ".click", "triggers")
+            os.makedirs(triggers_dir)
+            os.chmod(triggers_dir, 0o1777)
+            Click.Hook.open(self.db, "test").run_commands(user_name=None)
+            self.assertEqual(0, os.stat(triggers_dir).st_mode & 0o022)
+            self.assertTrue(
+                os.path.exists(os.path.join(triggers_dir, "test")))
+            self.assertEqual([], self.spawn_calls)
+
+    def test_untrusted_trigger_runs_directly(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "getpwnam", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(
+                    Passwd(pw_uid=os.getuid(), pw_gid=os.getgid())))
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            os.environ["TEST_QUIET"] = "1"
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file(dedent("""\
+                Pattern: %s/${id}.test
+                Exec: test-update
+                User: root
+                Trigger: yes""") % self.temp_dir)
+            triggers_dir = os.path.join(self.temp_dir, ".click", "triggers")
+            os.makedirs(triggers_dir)
+            os.symlink("/dev/null", os.path.join(triggers_dir, "test"))
+            Click.Hook.open(self.db, "test").run_commands(user_name=None)
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+            Click.run_system_hooks(self.db)
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+            self.assertTrue(
+                os.path.islink(os.path.join(triggers_dir, "test")))
+
 
 class TestClickHookUserLevel(TestClickHookBase):
     def test_open(self):
@@ -640,6 +918,41 @@ class TestClickHookUserLevel(TestClickHookBase):
             self.assertTrue(os.path.islink(symlink_path))
             self.assertEqual(target_path, os.readlink(symlink_path))
 
+    def test_trigger_runs_once_per_transaction(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "click_get_user_home", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            self._setup_hooks_dir(preloads)
+            preloads["click_get_user_home"].return_value = b"/home/test-user"
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            os.makedirs(os.path.join(
+                self.temp_dir, "org.example.package", "1.0"))
+            user_db = Click.User.for_user(self.db, self.TEST_USER)
+            user_db.set_version("org.example.package", "1.0")
+            self._make_hook_file(dedent("""\
+                User-Level: yes
+                Pattern: %s/${id}.test
+                Exec: test-update
+                Trigger: yes""") % self.temp_dir)
+            hook = Click.Hook.open(self.db, "test")
+            triggers_dir = os.path.join(
+                self.temp_dir, ".click", "users", self.TEST_USER,
+                ".triggers")
+            transaction = Click.HookTransaction.begin(self.db)
+            for app_name in "test-app-1", "test-app-2":
+                hook.install_package(
+                    "org.example.package", "1.0", app_name, "foo/bar",
+                    user_name=self.TEST_USER)
+            self.assertEqual([], self.spawn_calls)
+            transaction.commit()
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+            self.assertEqual([], os.listdir(triggers_dir))
+            hook.run_commands(user_name=self.TEST_USER)
+            self.assertEqual(["test"], os.listdir(triggers_dir))
+
     def test_install_package_trailing_slash(self):
         with self.run_in_subprocess(
                 "click_get_hooks_dir", "click_get_user_home",
@@ -889,6 +1202,29 @@ class TestClickHookUserLevel(TestClickHookBase):
                 os.readlink(path_2))
             self.assertFalse(os.path.lexists(path_3))
 
+    def test_run_user_hooks_for_packages(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "click_get_user_home",
+                ) as (enter, preloads):
+            enter()
+            preloads["click_get_user_home"].return_value = b"/home/test-user"
+            self._setup_hooks_dir(preloads)
+            self._make_installed_click("test-1", "1.0", json_data={
+                "hooks": {"test1-app": {"test": "target-1"}}})
+            self._make_installed_click("test-2", "1.1", json_data={
+                "hooks": {"test2-app": {"test": "target-2"}}})
+            self._setup_hooks_dir(
+                preloads, hooks_dir=os.path.join(self.temp_dir, "hooks"))
+            self._make_hook_file(dedent("""\
+                User-Level: yes
+                Pattern: %s/${id}.test""") % self.temp_dir)
+            Click.run_user_hooks_for_packages(
+                self.db, self.TEST_USER, ["test-1"])
+            self.assertTrue(os.path.lexists(
+                os.path.join(self.temp_dir, "test-1_test1-app_1.0.test")))
+            self.assertFalse(os.path.lexists(
+                os.path.join(self.temp_dir, "test-2_test2-app_1.1.test")))
+
     def test_sync_without_user_db(self):
         with self.run_in_subprocess(
                 "click_get_hooks_dir", "click_get_user_home",
@@ -1097,6 +1433,104 @@ class TestPackageInstallHooks(TestClickHookBase):
             self.assertTrue(os.path.lexists(
                 os.path.join(self.temp_dir, "c", "test_app_1.1.c")))
 
+    def test_runs_commands_once_per_transaction(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "g_spawn_sync") as (enter, preloads):
+            enter()
+            hooks_dir = os.path.join(self.temp_dir, "hooks")
+            self._setup_hooks_dir(preloads, hooks_dir=hooks_dir)
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            with mkfile(os.path.join(hooks_dir, "b.hook")) as f:
+                print("Pattern: %s/b/${id}.b" % self.temp_dir, file=f)
+                print("Exec: update-b", file=f)
+                print("User: root", file=f)
+            with mkfile(os.path.join(hooks_dir, "a.hook")) as f:
+                print("Pattern: %s/a/${id}.a" % self.temp_dir, file=f)
+                print("Exec: update-a", file=f)
+                print("User: root", file=f)
+            os.mkdir(os.path.join(self.temp_dir, "a"))
+            os.mkdir(os.path.join(self.temp_dir, "b"))
+            for package in "test-1", "test-2":
+                self._make_installed_click(package, "1.0", json_data={
+                    "hooks": {
+                        "app1": {"a": "foo.a", "b": "foo.b"},
+                        "app2": {"a": "bar.a", "b": "bar.b"},
+                    }})
+            transaction = Click.HookTransaction.begin(self.db)
+            Click.package_install_hooks(
+                self.db, "test-1", None, "1.0", user_name=None)
+            Click.package_install_hooks(
+                self.db, "test-2", None, "1.0", user_name=None)
+            self.assertTrue(os.path.islink(os.path.join(
+                self.temp_dir, "b", "test-2_app2_1.0.b")))
+            self.assertEqual([], self.spawn_calls)
+            transaction.commit()
+            self.assertEqual([
+                [b"/bin/sh", b"-c", b"update-a"],
+                [b"/bin/sh", b"-c", b"update-b"],
+            ], self.spawn_calls)
+            del self.spawn_calls[:]
+            Click.package_install_hooks(
+                self.db, "test-1", None, "1.0", user_name=None)
+            self.assertEqual([
+                [b"/bin/sh", b"-c", b"update-a"],
+                [b"/bin/sh", b"-c", b"update-b"],
+            ], self.spawn_calls)
+
+    def test_transaction_reports_all_failures(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "g_spawn_sync") as (enter, preloads):
+            enter()
+            hooks_dir = os.path.join(self.temp_dir, "hooks")
+            self._setup_hooks_dir(preloads, hooks_dir=hooks_dir)
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 1})
+            for name in "a", "b":
+                with mkfile(os.path.join(hooks_dir, "%s.hook" % name)) as f:
+                    print("Pattern: %s/%s/${id}" % (self.temp_dir, name),
+                          file=f)
+                    print("Exec: update-%s" % name, file=f)
+                    print("User: root", file=f)
+                os.mkdir(os.path.join(self.temp_dir, name))
+            self._make_installed_click("test", "1.0", json_data={
+                "hooks": {"app": {"a": "foo.a", "b": "foo.b"}}})
+            self.assertRaisesHooksError(
+                Click.HooksError.INCOMPLETE, Click.package_install_hooks,
+                self.db, "test", None, "1.0", user_name=None)
+            self.assertEqual(2, len(self.spawn_calls))
+            self.assertTrue(os.path.islink(os.path.join(
+                self.temp_dir, "b", "test_app_1.0")))
+
+    def test_runs_trigger_once_per_transaction(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "g_spawn_sync") as (enter, preloads):
+            enter()
+            hooks_dir = os.path.join(self.temp_dir, "hooks")
+            self._setup_hooks_dir(preloads, hooks_dir=hooks_dir)
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            with mkfile(os.path.join(hooks_dir, "a.hook")) as f:
+                print("Pattern: %s/a/${id}.a" % self.temp_dir, file=f)
+                print("Exec: update-a", file=f)
+                print("User: root", file=f)
+                print("Trigger: yes", file=f)
+            os.mkdir(os.path.join(self.temp_dir, "a"))
+            for package in "test-1", "test-2":
+                self._make_installed_click(package, "1.0", json_data={
+                    "hooks": {"app": {"a": "foo.a"}}})
+            transaction = Click.HookTransaction.begin(self.db)
+            Click.package_install_hooks(
+                self.db, "test-1", None, "1.0", user_name=None)
+            Click.package_install_hooks(
+                self.db, "test-2", None, "1.0", user_name=None)
+            self.assertEqual([], self.spawn_calls)
+            transaction.commit()
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"update-a"]], self.spawn_calls)
+            self.assertEqual([], os.listdir(os.path.join(
+                self.temp_dir, ".click", "triggers")))
+
 
 class TestPackageRemoveHooks(TestClickHookBase):
     def test_removes_hooks(self):
@@ -1140,6 +1574,70 @@ class TestPackageRemoveHooks(TestClickHookBase):
             self.assertFalse(os.path.lexists(yelp_other_path))
 
 
+class TestBulkRegistrationHooks(TestClickHookBase):
+    def _make_package(self, package, version):
+        with mkfile(os.path.join(
+                self.temp_dir, package, version, ".click", "info",
+                "%s.manifest" % package)) as f:
+            json.dump({"hooks": {"app": {"test": "foo.test"}}}, f)
+
+    def test_set_versions_runs_commands_once(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "click_get_user_home", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            hooks_dir = os.path.join(self.temp_dir, "hooks")
+            self._setup_hooks_dir(preloads, hooks_dir=hooks_dir)
+            preloads["click_get_user_home"].return_value = b"/home/test-user"
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            self._make_hook_file(dedent("""\
+                User-Level: yes
+                Pattern: %s/links/${id}.test
+                Exec: test-update""") % self.temp_dir)
+            self._make_package("a", "1.0")
+            self._make_package("b", "2.0")
+            registry = Click.User.for_user(self.db, self.TEST_USER)
+            registry.set_versions(["a", "b"], ["1.0", "2.0"])
+            self.assertEqual("1.0", registry.get_version("a"))
+            self.assertEqual("2.0", registry.get_version("b"))
+            self.assertTrue(os.path.islink(os.path.join(
+                self.temp_dir, "links", "a_app_1.0.test")))
+            self.assertTrue(os.path.islink(os.path.join(
+                self.temp_dir, "links", "b_app_2.0.test")))
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+
+    def test_remove_many_runs_commands_once(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "click_get_user_home", "g_spawn_sync",
+                ) as (enter, preloads):
+            enter()
+            hooks_dir = os.path.join(self.temp_dir, "hooks")
+            self._setup_hooks_dir(preloads, hooks_dir=hooks_dir)
+            preloads["click_get_user_home"].return_value = b"/home/test-user"
+            preloads["g_spawn_sync"].side_effect = partial(
+                self.g_spawn_sync_side_effect, {b"/bin/sh": 0})
+            self._make_hook_file(dedent("""\
+                User-Level: yes
+                Pattern: %s/links/${id}.test
+                Exec: test-update""") % self.temp_dir)
+            self._make_package("a", "1.0")
+            self._make_package("b", "2.0")
+            registry = Click.User.for_user(self.db, self.TEST_USER)
+            registry.set_versions(["a", "b"], ["1.0", "2.0"])
+            del self.spawn_calls[:]
+            registry.remove_many(["a", "b"])
+            self.assertFalse(registry.has_package_name("a"))
+            self.assertFalse(registry.has_package_name("b"))
+            self.assertFalse(os.path.lexists(os.path.join(
+                self.temp_dir, "links", "a_app_1.0.test")))
+            self.assertFalse(os.path.lexists(os.path.join(
+                self.temp_dir, "links", "b_app_2.0.test")))
+            self.assertEqual(
+                [[b"/bin/sh", b"-c", b"test-update"]], self.spawn_calls)
+
+
 class TestPackageHooksValidateFramework(TestClickHookBase):
 
     def _setup_test_env(self, preloads):
@@ -1230,3 +1728,35 @@ class TestPackageHooksValidateFramework(TestClickHookBase):
             # run the hooks
             Click.run_user_hooks(self.db, user_name=self.TEST_USER)
             self.assertFalse(os.path.lexists(self.hook_symlink_path))
+
+    def test_unchanged_user_hooks_are_skipped(self):
+        with self.run_in_subprocess(
+                "click_get_hooks_dir", "click_get_user_home",
+                "click_get_frameworks_dir",
+                ) as (enter, preloads):
+            enter()
+            cache_dir = tempfile.mkdtemp(prefix="click-cache")
+            self.addCleanup(shutil.rmtree, cache_dir)
+            os.environ["XDG_CACHE_HOME"] = cache_dir
+            self._setup_frameworks(
+                preloads, frameworks=["ubuntu-sdk-13.10"])
+            self._setup_test_env(preloads)
+            self._make_installed_click(json_data={
+                "framework": "ubuntu-sdk-13.10",
+                "hooks": {
+                    "test1-app": {"test": "target-1"}
+                },
+            })
+            self._backdate()
+            Click.run_user_hooks(self.db, user_name=self.TEST_USER)
+            self.assertTrue(os.path.lexists(self.hook_symlink_path))
+            # Nothing that the hooks depend on has changed, so a missing
+            # link is not noticed ...
+            os.unlink(self.hook_symlink_path)
+            self._backdate()
+            Click.run_user_hooks(self.db, user_name=self.TEST_USER)
+            self.assertFalse(os.path.lexists(self.hook_symlink_path))
+            # ... unless forced.
+            Click.run_user_hooks_full(
+                self.db, user_name=self.TEST_USER, force=True)
+            self.assertTrue(os.path.lexists(self.hook_symlink_path))
@@ -26,8 +26,11 @@ __all__ = [
 import json
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
 from textwrap import dedent
+from unittest import skipUnless
 
 # Important:
 #
@@ -175,6 +178,34 @@ class TestClickUser(TestCase):
             preloads["chown"].assert_any_call(
                 os.path.join(click_dir, "users", "user").encode(), 2, 2)
 
+    def test_nss_cache(self):
+        with self.run_in_subprocess(
+                "chown", "geteuid", "getpwnam") as (enter, preloads):
+            enter()
+            preloads["geteuid"].return_value = 0
+            getpwnam_result = Passwd()
+            getpwnam_result.pw_uid = 1
+            getpwnam_result.pw_gid = 1
+            preloads["getpwnam"].side_effect = (
+                lambda name: self.make_pointer(getpwnam_result))
+            os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+
+            def user_lookups():
+                return len([
+                    call for call in preloads["getpwnam"].call_args_list
+                    if call[0][0] == b"user"])
+
+            # Separate instances share the process-wide cache.
+            Click.User.for_user(self.db, "user").set_version("a", "1.0")
+            shutil.rmtree(os.path.join(self.temp_dir, ".click"))
+            Click.User.for_user(self.db, "user").set_version("a", "1.0")
+            self.assertEqual(1, user_lookups())
+
+            Click.invalidate_nss_cache()
+            shutil.rmtree(os.path.join(self.temp_dir, ".click"))
+            Click.User.for_user(self.db, "user").set_version("a", "1.0")
+            self.assertEqual(2, user_lookups())
+
     def test_ensure_db_mkdir_fails(self):
         with self.run_in_subprocess("mkdir") as (enter, preloads):
             enter()
@@ -353,6 +384,64 @@ class TestClickUser(TestCase):
             os.readlink(a_underlay))
         self.assertFalse(os.path.islink(a_overlay))
 
+    def test_set_versions(self):
+        registry = Click.User.for_user(self.db, "user")
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        os.makedirs(os.path.join(self.temp_dir, "b", "2.0"))
+        registry.set_versions(["a", "b"], ["1.0", "2.0"])
+        self.assertEqual("1.0", registry.get_version("a"))
+        self.assertEqual("2.0", registry.get_version("b"))
+
+    def test_set_versions_missing_target(self):
+        registry = Click.User.for_user(self.db, "user")
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        self.assertRaisesDatabaseError(
+            Click.DatabaseError.DOES_NOT_EXIST,
+            registry.set_versions, ["a", "b"], ["1.0", "2.0"])
+        self.assertFalse(registry.has_package_name("a"))
+
+    def test_set_versions_failure_restores(self):
+        registry = Click.User.for_user(self.db, "user")
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.1"))
+        os.makedirs(os.path.join(self.temp_dir, "b", "2.0"))
+        registry.set_version("a", "1.0")
+        # b cannot be registered, since something is in the way.
+        touch(os.path.join(registry.get_overlay_db(), "b", "file"))
+        self.assertRaises(
+            GLib.GError, registry.set_versions, ["a", "b"], ["1.1", "2.0"])
+        self.assertEqual("1.0", registry.get_version("a"))
+        self.assertEqual(
+            os.path.join(self.temp_dir, "a", "1.0"),
+            os.readlink(os.path.join(registry.get_overlay_db(), "a")))
+        # Nothing changed, so nothing is journalled.
+        with open(os.path.join(
+                self.temp_dir, ".click", "journal")) as journal:
+            self.assertEqual(
+                [["register", "user", "a", "1.0"]],
+                [line.split(" ")[1:]
+                 for line in journal.read().splitlines()[1:]])
+
+    def test_remove_many(self):
+        registry = Click.User.for_user(self.db, "user")
+        os.makedirs(registry.get_overlay_db())
+        a_path = os.path.join(registry.get_overlay_db(), "a")
+        b_path = os.path.join(registry.get_overlay_db(), "b")
+        os.symlink("/1.0", a_path)
+        os.symlink("/2.0", b_path)
+        registry.remove_many(["a", "b"])
+        self.assertFalse(os.path.exists(a_path))
+        self.assertFalse(os.path.exists(b_path))
+
+    def test_remove_many_missing(self):
+        registry = Click.User.for_user(self.db, "user")
+        os.makedirs(registry.get_overlay_db())
+        path = os.path.join(registry.get_overlay_db(), "a")
+        os.symlink("/1.0", path)
+        self.assertRaisesUserError(
+            Click.UserError.NO_SUCH_PACKAGE, registry.remove_many, ["a", "b"])
+        self.assertTrue(os.path.islink(path))
+
     def test_remove_missing(self):
         registry = Click.User.for_user(self.db, "user")
         self.assertRaisesUserError(
@@ -422,6 +511,47 @@ class TestClickUser(TestCase):
         self.assertRaisesUserError(
             Click.UserError.NO_SUCH_PACKAGE, registry.get_path, "d")
 
+    def test_get_registrations(self):
+        user_dbs, registry = self._setUpMultiDB()
+        os.symlink("@hidden", os.path.join(user_dbs[1], "b"))
+        self.assertEqual(
+            [
+                ("a", "1.1", 1, False, os.path.join(user_dbs[1], "a")),
+                ("b", None, 1, True, os.path.join(user_dbs[1], "b")),
+                ("c", "0.1", 1, False, os.path.join(user_dbs[1], "c")),
+            ],
+            [
+                (reg.props.package, reg.props.version, reg.props.layer,
+                 reg.props.hidden, reg.props.path)
+                for reg in registry.get_registrations()])
+
+    def test_dropped_session(self):
+        user_dbs, registry = self._setUpMultiDB()
+        registry.begin_dropped_session()
+        try:
+            self.assertEqual("1.1", registry.get_version("a"))
+            self.assertEqual(
+                os.path.join(user_dbs[0], "b"), registry.get_path("b"))
+            # Changes made during the session are seen.
+            os.symlink("@hidden", os.path.join(user_dbs[1], "b"))
+            self.assertRaisesUserError(
+                Click.UserError.HIDDEN_PACKAGE, registry.get_version, "b")
+            self.assertRaisesUserError(
+                Click.UserError.NO_SUCH_PACKAGE, registry.get_version, "d")
+            # So are registration directories created during the session.
+            all_users_db = os.path.join(
+                self.multi_db.get(1).props.root, ".click", "users", "@all")
+            os.makedirs(all_users_db)
+            os.symlink(
+                os.path.join(self.temp_dir, "click", "c", "0.1"),
+                os.path.join(all_users_db, "d"))
+            self.assertEqual("0.1", registry.get_version("d"))
+        finally:
+            registry.end_dropped_session()
+        self.assertEqual("1.1", registry.get_version("a"))
+        self.assertEqual(
+            os.path.join(all_users_db, "d"), registry.get_path("d"))
+
     def test_get_manifest(self):
         registry = Click.User.for_user(self.db, "user")
         manifest_path = os.path.join(
@@ -499,6 +629,59 @@ class TestClickUser(TestCase):
         self.assertEqual(
             [a_manifest_obj, b_manifest_obj],
             json.loads(registry.get_manifests_as_string()))
+        seen = []
+
+        def collect(manifest):
+            seen.append(json_object_to_python(manifest))
+            return True
+
+        registry.foreach_manifest(collect)
+        self.assertEqual([a_manifest_obj, b_manifest_obj], seen)
+        with open(os.path.join(self.temp_dir, "out"), "w+") as out:
+            registry.write_manifests(out.fileno())
+            out.seek(0)
+            self.assertEqual([a_manifest_obj, b_manifest_obj], json.load(out))
+
+    def test_get_manifests_with_fields(self):
+        user_dbs, registry = self._setUpMultiDB()
+        self.assertEqual(
+            [
+                {"name": "a", "version": "1.1"},
+                {"name": "c", "version": "0.1"},
+                {"name": "b", "version": "2.0"},
+            ],
+            json_array_to_python(
+                registry.get_manifests_with_fields(["name", "version"])))
+        self.assertEqual(
+            [
+                {"name": "a", "_directory": os.path.join(user_dbs[1], "a")},
+                {"name": "c", "_directory": os.path.join(user_dbs[1], "c")},
+                {"name": "b", "_directory": os.path.join(user_dbs[0], "b")},
+            ],
+            json_array_to_python(
+                registry.get_manifests_with_fields(["name", "_directory"])))
+        registry.set_version("a", "1.0")
+        self.assertEqual(
+            [
+                {"hooks": {"a-app": {}}, "_removable": 1},
+                {"_removable": 1},
+                {"_removable": 1},
+            ],
+            json_array_to_python(
+                registry.get_manifests_with_fields(["hooks", "_removable"])))
+
+    def test_get_manifests_with_fields_missing_manifest(self):
+        user_dbs, registry = self._setUpMultiDB()
+        os.unlink(os.path.join(
+            self.temp_dir, "click", "c", "0.1", ".click", "info",
+            "c.manifest"))
+        self.assertEqual(
+            [
+                {"name": "a", "version": "1.1"},
+                {"name": "b", "version": "2.0"},
+            ],
+            json_array_to_python(
+                registry.get_manifests_with_fields(["name", "version"])))
 
     def test_get_manifests_multiple_root(self):
         user_dbs, registry = self._setUpMultiDB()
@@ -574,6 +757,95 @@ class TestClickUser(TestCase):
         self.assertTrue(registry.is_removable("b"))
 
 
+@skipUnless(Click.find_on_path("dbus-daemon"), "needs dbus-daemon")
+class LoggedInUsersTestCase(TestCase):
+    """Registrations for all users, against a fake logind on a private bus.
+    """
+
+    def setUp(self):
+        super(LoggedInUsersTestCase, self).setUp()
+        self.use_temp_dir()
+        self.db = Click.DB()
+        self.db.add(self.temp_dir)
+        self._start_fake_logind([
+            [1000, "test-user", False],
+            [117, "lightdm", True],
+        ])
+
+    def _start(self, args):
+        process = subprocess.Popen(
+            args, stdout=subprocess.PIPE, universal_newlines=True)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        return process
+
+    def _start_fake_logind(self, users):
+        bus = self._start([
+            "dbus-daemon", "--session", "--nofork", "--print-address=1"])
+        address = bus.stdout.readline().strip()
+        service = self._start([
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), "fake_logind.py"),
+            address, json.dumps(users)])
+        self.assertEqual("ready", service.stdout.readline().strip())
+        os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+
+    def _setUpFakeClick(self, status=0):
+        # Each logged-in user's hooks are run by a separate click process.
+        fake_click = os.path.join(self.temp_dir, "bin", "click")
+        self.fake_click_output = os.path.join(
+            self.temp_dir, "fake-click.out")
+        make_file_with_content(fake_click, dedent("""\
+        #!/bin/sh
+        echo "$@" >> %s
+        exit %d
+        """ % (self.fake_click_output, status)), 0o755)
+        os.environ["PATH"] = "%s:%s" % (
+            os.path.dirname(fake_click), os.environ["PATH"])
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+
+    def _read_fake_click_output(self):
+        with open(self.fake_click_output) as f:
+            return f.read().splitlines()
+
+    def test_set_version_runs_hooks_for_logged_in_users(self):
+        self._setUpFakeClick()
+        registry = Click.User.for_all_users(self.db)
+        registry.set_version("a", "1.0")
+        # System accounts are skipped.
+        self.assertEqual(
+            ["hook run-user --user=test-user --db=%s --package=a" %
+             self.temp_dir],
+            self._read_fake_click_output())
+
+    def test_remove_runs_hooks_for_logged_in_users(self):
+        self._setUpFakeClick()
+        registry = Click.User.for_all_users(self.db)
+        registry.set_version("a", "1.0")
+        registry.remove("a")
+        self.assertEqual(
+            ["hook run-user --user=test-user --db=%s --package=a" %
+             self.temp_dir] * 2,
+            self._read_fake_click_output())
+
+    def test_hooks_fail_for_logged_in_users(self):
+        self._setUpFakeClick(status=1)
+        registry = Click.User.for_all_users(self.db)
+        self.assertRaisesHooksError(
+            Click.HooksError.INCOMPLETE, registry.set_version, "a", "1.0")
+        self.assertEqual("1.0", registry.get_version("a"))
+
+    def test_hooks_run_in_process_without_click(self):
+        # If click cannot be run, hooks are run in this process instead.
+        empty_bin = os.path.join(self.temp_dir, "empty-bin")
+        os.makedirs(empty_bin)
+        os.environ["PATH"] = empty_bin
+        os.makedirs(os.path.join(self.temp_dir, "a", "1.0"))
+        registry = Click.User.for_all_users(self.db)
+        registry.set_version("a", "1.0")
+        self.assertEqual("1.0", registry.get_version("a"))
+
+
 class StopAppTestCase(TestCase):
 
     def setUp(self):
@@ -605,6 +877,19 @@ class StopAppTestCase(TestCase):
         with open(self.fake_app_stop_output) as f:
             self.assertEqual("meep_a-app_2.0", f.read().strip())
 
+    def test_app_stops_on_remove_many(self):
+        make_installed_click(self.db, self.temp_dir, "meep", "2.0",
+                             {"hooks": {"a-app": {}, "b-app": {}}})
+        make_installed_click(self.db, self.temp_dir, "moop", "1.0",
+                             {"hooks": {"c-app": {}}})
+        registry = Click.User.for_user(self.db, "user")
+        registry.remove_many(["meep", "moop"])
+        # the stops run concurrently, so they may finish in any order
+        with open(self.fake_app_stop_output) as f:
+            self.assertEqual(
+                ["meep_a-app_2.0", "meep_b-app_2.0", "moop_c-app_1.0"],
+                sorted(f.read().splitlines()))
+
 
 class UserDataRemovalTestCase(TestCase):
 
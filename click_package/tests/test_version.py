@@ -0,0 +1,74 @@
+# Copyright (C) 2014 Canonical Ltd.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for click_package.version."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+__all__ = [
+    'TestVersionCompare',
+    ]
+
+
+from debian.debian_support import Version
+from gi.repository import Click
+
+from click_package.tests.helpers import TestCase
+
+
+class TestVersionCompare(TestCase):
+    def assertVersionOrder(self, older, newer):
+        self.assertLess(Click.version_compare(older, newer), 0)
+        self.assertGreater(Click.version_compare(newer, older), 0)
+
+    def test_equal(self):
+        self.assertEqual(0, Click.version_compare("1.0", "1.0"))
+        self.assertEqual(0, Click.version_compare("1.0", "1.00"))
+        self.assertEqual(0, Click.version_compare("0:1.0", "1.0"))
+        self.assertEqual(0, Click.version_compare("1.0", "1.0-0"))
+
+    def test_upstream(self):
+        self.assertVersionOrder("1.0", "1.1")
+        self.assertVersionOrder("1.9", "1.10")
+        self.assertVersionOrder("1.0", "1.0a")
+        self.assertVersionOrder("1.0a", "1.0+b1")
+
+    def test_tilde(self):
+        self.assertVersionOrder("1.0~rc1", "1.0")
+        self.assertVersionOrder("1.0~~", "1.0~")
+        self.assertVersionOrder("1.0-1~bpo1", "1.0-1")
+
+    def test_epoch(self):
+        self.assertVersionOrder("2.0", "1:0.1")
+        self.assertVersionOrder("1:9.9", "2:0.1")
+
+    def test_revision(self):
+        self.assertVersionOrder("1.0-1", "1.0-2")
+        self.assertVersionOrder("1.0-9", "1.0-10")
+        self.assertVersionOrder("1.0-1", "1.0.1")
+
+    def test_matches_python_debian(self):
+        versions = [
+            "0.1", "1.0", "1.0~rc1", "1.0-1", "1:0.9", "1.0a", "1.0+b1",
+            "1.0.1", "2", "10", "1.0-1~bpo1", "1.0~~",
+            ]
+        for a in versions:
+            for b in versions:
+                expected = (
+                    (Version(a) > Version(b)) - (Version(a) < Version(b)))
+                actual = Click.version_compare(a, b)
+                self.assertEqual(
+                    expected, (actual > 0) - (actual < 0),
+                    "%s vs. %s" % (a, b))
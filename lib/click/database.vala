@@ -58,6 +58,423 @@ private unowned string? get_app_pid_command ()
 		return app_pid_command;
 }
 
+/* lomiri-app-pid only takes one application ID at a time, so checking
+ * many IDs still runs it once per ID.  All that is batched is the shell
+ * that loops over them, so that we spawn one process per batch from here
+ * rather than one per ID.
+ */
+private const string APP_PID_BATCH_SCRIPT = """cmd="$1"; shift
+for id; do "$cmd" "$id" >/dev/null 2>&1 && printf '%s\n' "$id"; done
+exit 0""";
+
+/* Keep well clear of ARG_MAX. */
+private const int APP_PID_BATCH_SIZE = 256;
+
+private void
+run_app_pid_command_batch (string command, string[] app_ids,
+			   Gee.Set<string> running)
+{
+	string[] argv = { "/bin/sh", "-c", APP_PID_BATCH_SCRIPT, "sh", command };
+	foreach (var app_id in app_ids)
+		argv += app_id;
+	try {
+		string output;
+		int exit_status;
+		Process.spawn_sync (null, argv, null,
+				    SpawnFlags.STDERR_TO_DEV_NULL, null,
+				    out output, null, out exit_status);
+		foreach (var line in output.split ("\n")) {
+			if (line != "")
+				running.add (line);
+		}
+	} catch (SpawnError e) {
+		warning ("Failed to run %s: %s", command, e.message);
+	}
+}
+
+/**
+ * scan_proc_for_apps:
+ * @proc_dir: The path to a proc file system.
+ * @candidates: Application IDs to look for.
+ * @running: Set to which running application IDs are added.
+ *
+ * Find running applications by looking at the AppArmor label (which for
+ * confined applications is the application ID) and the control group path
+ * (which contains the application ID as one of its "--"-separated
+ * components) of each process.
+ */
+private void
+scan_proc_for_apps (string proc_dir, Gee.Set<string> candidates,
+		    Gee.Set<string> running)
+{
+	DirStream dir;
+	try {
+		dir = DirStream.open (proc_dir);
+	} catch (FileError e) {
+		warning ("Cannot scan %s: %s", proc_dir, e.message);
+		return;
+	}
+	foreach (var entry in dir) {
+		if (! entry.name[0].isdigit ())
+			continue;
+		unowned string pid_dir = entry.path;
+		string contents;
+		try {
+			FileUtils.get_contents
+				(Path.build_filename (pid_dir, "attr", "current"),
+				 out contents);
+			/* For example, "com.example.foo_foo_1.0 (enforce)". */
+			var label = contents.strip ().split (" ", 2)[0];
+			if (label in candidates)
+				running.add (label);
+		} catch (FileError e) {
+		}
+		try {
+			FileUtils.get_contents
+				(Path.build_filename (pid_dir, "cgroup"),
+				 out contents);
+			foreach (var line in contents.split ("\n")) {
+				foreach (var component in line.split ("/")) {
+					foreach (var part in component.split
+							("--")) {
+						if (part in candidates)
+							running.add (part);
+					}
+				}
+			}
+		} catch (FileError e) {
+		}
+		if (running.size == candidates.size)
+			break;
+	}
+}
+
+/**
+ * get_running_app_ids:
+ * @app_ids: Application IDs to check.
+ * @proc_dir: If not null, scan processes in this proc file system rather
+ * than running lomiri-app-pid once for each of @app_ids.
+ *
+ * Returns: The subset of @app_ids that are known to be running.
+ */
+private Gee.Set<string>
+get_running_app_ids (Gee.Collection<string> app_ids, string? proc_dir)
+{
+	var running = new Gee.HashSet<string> ();
+	if (app_ids.size == 0)
+		return running;
+
+	if (proc_dir != null) {
+		var candidates = new Gee.HashSet<string> ();
+		candidates.add_all (app_ids);
+		scan_proc_for_apps (proc_dir, candidates, running);
+		return running;
+	}
+
+	unowned string? command = get_app_pid_command ();
+	if (command == null)
+		return running;
+	string[] batch = {};
+	foreach (var app_id in app_ids) {
+		batch += app_id;
+		if (batch.length == APP_PID_BATCH_SIZE) {
+			run_app_pid_command_batch (command, batch, running);
+			batch = {};
+		}
+	}
+	if (batch.length > 0)
+		run_app_pid_command_batch (command, batch, running);
+	return running;
+}
+
+private class CachedManifest : Object {
+	public uint64 ino;
+	public int64 mtime;
+	public int64 size;
+	public int64 parse_time;
+	public uint64 last_used;
+	public Json.Object manifest;
+
+	public
+	CachedManifest (Posix.Stat st, int64 parse_time, Json.Object manifest)
+	{
+		this.ino = (uint64) st.st_ino;
+		this.mtime = (int64) st.st_mtime;
+		this.size = (int64) st.st_size;
+		this.parse_time = parse_time;
+		this.last_used = 0;
+		this.manifest = manifest;
+	}
+
+	public bool
+	matches (Posix.Stat st)
+	{
+		/* A manifest modified in the same second that we parsed it
+		 * might have been modified again since without its mtime
+		 * changing, so don't trust it.
+		 */
+		return ino == (uint64) st.st_ino &&
+		       mtime == (int64) st.st_mtime &&
+		       size == (int64) st.st_size && mtime < parse_time;
+	}
+}
+
+/* A bounded cache of parsed manifests, keyed by path and validated against
+ * the inode number, modification time, and size of the manifest file.
+ * Cached manifests are sealed, so callers that want to add dynamic keys
+ * must take a copy first.
+ */
+internal class ManifestCache : Object {
+	private const uint MAX_ENTRIES = 256;
+
+	private Gee.HashMap<string, CachedManifest> entries;
+	private uint64 clock;
+
+	public uint hits;
+	public uint misses;
+
+	public
+	ManifestCache ()
+	{
+		entries = new Gee.HashMap<string, CachedManifest> ();
+		clock = 0;
+		hits = 0;
+		misses = 0;
+	}
+
+	private void
+	evict_oldest ()
+	{
+		string? oldest_path = null;
+		uint64 oldest_used = uint64.MAX;
+		foreach (var entry in entries.entries) {
+			if (entry.value.last_used < oldest_used) {
+				oldest_path = entry.key;
+				oldest_used = entry.value.last_used;
+			}
+		}
+		if (oldest_path != null)
+			entries.unset (oldest_path);
+	}
+
+	/**
+	 * lookup:
+	 * @manifest_path: The path to a manifest file.
+	 *
+	 * Returns: A sealed #Json.Object containing the parsed manifest.
+	 */
+	public Json.Object
+	lookup (string manifest_path) throws DatabaseError
+	{
+		Posix.Stat st;
+		if (Posix.stat (manifest_path, out st) < 0) {
+			entries.unset (manifest_path);
+			throw new DatabaseError.BAD_MANIFEST
+				("Failed to parse manifest in %s: %s",
+				 manifest_path, strerror (errno));
+		}
+
+		var cached = entries[manifest_path];
+		if (cached != null && cached.matches (st)) {
+			++hits;
+			cached.last_used = ++clock;
+			return cached.manifest;
+		}
+
+		++misses;
+		var parse_time = get_real_time () / 1000000;
+		var parser = new Json.Parser ();
+		try {
+			parser.load_from_file (manifest_path);
+		} catch (Error e) {
+			entries.unset (manifest_path);
+			throw new DatabaseError.BAD_MANIFEST
+				("Failed to parse manifest in %s: %s",
+				 manifest_path, e.message);
+		}
+		var node = parser.get_root ();
+		if (node == null ||
+		    node.get_node_type () != Json.NodeType.OBJECT) {
+			entries.unset (manifest_path);
+			throw new DatabaseError.BAD_MANIFEST
+				("Manifest in %s is not a JSON object",
+				 manifest_path);
+		}
+		var manifest = node.dup_object ();
+		manifest.seal ();
+
+		if (cached == null && entries.size >= MAX_ENTRIES)
+			evict_oldest ();
+		cached = new CachedManifest (st, parse_time, manifest);
+		cached.last_used = ++clock;
+		entries[manifest_path] = cached;
+		return manifest;
+	}
+}
+
+/**
+ * copy_manifest:
+ * @manifest: A (possibly sealed) manifest.
+ *
+ * Returns: A shallow copy of @manifest whose top-level members may be
+ * changed.
+ */
+private Json.Object
+copy_manifest (Json.Object manifest)
+{
+	var copy = new Json.Object ();
+	foreach (unowned string name in manifest.get_members ())
+		copy.set_member (name, manifest.get_member (name).copy ());
+	return copy;
+}
+
+private bool
+has_field (string[] fields, string field)
+{
+	foreach (unowned string f in fields) {
+		if (f == field)
+			return true;
+	}
+	return false;
+}
+
+/**
+ * fields_need_manifest:
+ * @fields: Requested manifest fields.
+ *
+ * Returns: True if any of @fields can only be answered by reading the
+ * manifest.  The name and version of an installed package are known from
+ * the database layout, and dynamic keys are computed separately.
+ */
+private bool
+fields_need_manifest (string[] fields)
+{
+	foreach (unowned string field in fields) {
+		if (field != "name" && field != "version" &&
+		    ! field.has_prefix ("_"))
+			return true;
+	}
+	return false;
+}
+
+/**
+ * project_manifest:
+ * @manifest: A (possibly sealed) manifest, or null if it was not needed.
+ * @package: The package name.
+ * @version: The package version.
+ * @fields: Requested manifest fields.
+ *
+ * Returns: A new object containing only those of @fields that are present
+ * in @manifest, except for dynamic keys, which the caller must add.
+ */
+private Json.Object
+project_manifest (Json.Object? manifest, string package, string version,
+		  string[] fields)
+{
+	var obj = new Json.Object ();
+	foreach (unowned string field in fields) {
+		if (field.has_prefix ("_"))
+			continue;
+		if (manifest != null) {
+			if (manifest.has_member (field))
+				obj.set_member
+					(field, manifest.get_member (field).copy ());
+		} else if (field == "name")
+			obj.set_string_member (field, package);
+		else if (field == "version")
+			obj.set_string_member (field, version);
+	}
+	return obj;
+}
+
+/**
+ * ManifestFunc:
+ * @manifest: The manifest of an installed package, including dynamic keys.
+ *
+ * A function called for each manifest by the foreach_manifest methods.
+ *
+ * Returns: True to continue, or false to stop.
+ *
+ * Since: 0.5.3
+ */
+public delegate bool ManifestFunc (Json.Object manifest);
+
+/* Serialises a JSON array of manifests one element at a time, either to
+ * a file descriptor or to a string, so that the parsed manifests never
+ * need to be held in memory all at once.
+ */
+private class ManifestWriter : Object {
+	private int fd;
+	private StringBuilder? builder;
+	private bool first;
+	private Json.Generator generator;
+	private Json.Node node;
+	private Error? error;
+
+	public
+	ManifestWriter (int fd) throws FileError
+	{
+		this.fd = fd;
+		builder = null;
+		first = true;
+		generator = new Json.Generator ();
+		node = new Json.Node (Json.NodeType.OBJECT);
+		error = null;
+		emit ("[");
+	}
+
+	public
+	ManifestWriter.for_string ()
+	{
+		this.fd = -1;
+		builder = new StringBuilder ("[");
+		first = true;
+		generator = new Json.Generator ();
+		node = new Json.Node (Json.NodeType.OBJECT);
+		error = null;
+	}
+
+	private void
+	emit (string data) throws FileError
+	{
+		if (builder != null)
+			builder.append (data);
+		else
+			write_all (fd, data);
+	}
+
+	public bool
+	add (Json.Object manifest)
+	{
+		node.set_object (manifest);
+		generator.set_root (node);
+		try {
+			if (! first)
+				emit (",");
+			emit (generator.to_data (null));
+		} catch (FileError e) {
+			error = e.copy ();
+			return false;
+		}
+		first = false;
+		return true;
+	}
+
+	public void
+	finish () throws Error
+	{
+		if (error != null)
+			throw error.copy ();
+		emit ("]");
+	}
+
+	public string
+	get_string ()
+	{
+		return builder.str;
+	}
+}
+
 public class InstalledPackage : Object, Gee.Hashable<InstalledPackage> {
 	public string package { get; construct; }
 	public string version { get; construct; }
@@ -86,10 +503,103 @@ public class InstalledPackage : Object, Gee.Hashable<InstalledPackage> {
 	}
 }
 
+private class GcReregistration : Object {
+	public string user_name;
+	public string package;
+	public string old_version;
+	public string new_version;
+
+	public
+	GcReregistration (string user_name, string package,
+			  string old_version, string new_version)
+	{
+		this.user_name = user_name;
+		this.package = package;
+		this.old_version = old_version;
+		this.new_version = new_version;
+	}
+}
+
+/* The decisions made by a garbage collection run, computed from a single
+ * snapshot of all user registrations.
+ */
+private class GcPlan : Object {
+	/* User name → user database. */
+	public Gee.Map<string, User> users;
+	/* Registrations that should move to a newer version. */
+	public Gee.List<GcReregistration> reregister;
+	/* Unregistered versions in this database; these are removed unless
+	 * they are running.
+	 */
+	public Gee.List<InstalledPackage> remove;
+	/* Packages with a legacy @gcinuse registration. */
+	public Gee.Set<string> gc_in_use;
+
+	public
+	GcPlan ()
+	{
+		users = new Gee.TreeMap<string, User> ();
+		reregister = new Gee.ArrayList<GcReregistration> ();
+		remove = new Gee.ArrayList<InstalledPackage> ();
+		gc_in_use = new Gee.HashSet<string> ();
+	}
+}
+
+/* One scan of every package version in a #DB, shared between the phases
+ * of run_system_hooks so that each of them does not walk the database
+ * again.
+ */
+internal class PackageScan : Object {
+	/* As returned by DB.get_packages with all_versions set. */
+	public Gee.List<InstalledPackage> packages;
+	/* Required frameworks → whether they are all available. */
+	public Gee.Map<string, bool> frameworks_valid;
+
+	public
+	PackageScan (DB db) throws Error
+	{
+		packages = new Gee.ArrayList<InstalledPackage> ();
+		frameworks_valid = new Gee.HashMap<string, bool> ();
+		refresh (db);
+	}
+
+	/* Scan again after package versions have been removed, in case
+	 * they were hiding identical versions in an underlay database.
+	 */
+	public void
+	refresh (DB db) throws Error
+	{
+		packages.clear ();
+		foreach (var inst in db.get_packages (true))
+			packages.add (inst);
+	}
+
+	/* The package versions in the overlay database. */
+	public Gee.List<InstalledPackage>
+	get_writeable ()
+	{
+		var ret = new Gee.ArrayList<InstalledPackage> ();
+		foreach (var inst in packages) {
+			if (inst.writeable)
+				ret.add (inst);
+		}
+		return ret;
+	}
+}
+
 public class SingleDB : Object {
 	public string root { get; construct; }
-	
+
+	/**
+	 * True if the package index for this database should be kept on
+	 * disk in <root>/.click/index, otherwise false.
+	 *
+	 * Since: 0.5.3
+	 */
+	public bool use_index { get; set; default = true; }
+
 	private WeakRef _master_db = WeakRef(null);
+	private PackageIndex? index = null;
 
 	internal
 	SingleDB (string root, DB master_db)
@@ -104,6 +614,35 @@ public class SingleDB : Object {
 		return Environment.get_variable ("TEST_QUIET") == null;
 	}
 
+	/**
+	 * get_trash_dir:
+	 *
+	 * Returns: The directory into which removed package versions are
+	 * moved until a #TrashReaper deletes them.
+	 *
+	 * Since: 0.5.3
+	 */
+	public string
+	get_trash_dir ()
+	{
+		return Path.build_filename (root, ".click", "trash");
+	}
+
+	/**
+	 * get_index:
+	 *
+	 * Returns: The package index for this database, brought up to date
+	 * with the file system.
+	 */
+	private PackageIndex
+	get_index () throws Error
+	{
+		if (index == null || index.persistent != use_index)
+			index = new PackageIndex (root, use_index);
+		index.refresh ();
+		return index;
+	}
+
 	/**
 	 * get_path:
 	 * @package: A package name.
@@ -156,36 +695,21 @@ public class SingleDB : Object {
 	{
 		var ret = new List<InstalledPackage> ();
 
-		foreach (var package in Click.Dir.open (root)) {
-			if (package == ".click")
-				continue;
+		foreach (var pkg in get_index ().get_packages ()) {
 			if (all_versions) {
-				var package_path =
-					Path.build_filename (root, package);
-				if (! is_dir (package_path))
-					continue;
-				foreach (var version in Click.Dir.open
-						(package_path)) {
+				foreach (var version in pkg.versions.keys) {
 					var version_path = Path.build_filename
-						(package_path, version);
-					if (is_symlink (version_path) ||
-					    ! is_dir (version_path))
-						continue;
+						(root, pkg.name, version);
 					ret.prepend(new InstalledPackage
-						(package, version,
+						(pkg.name, version,
 						 version_path));
 				}
-			} else {
+			} else if (pkg.current != null &&
+				   ! ("/" in pkg.current)) {
 				var current_path = Path.build_filename
-					(root, package, "current");
-				if (! is_symlink (current_path))
-					continue;
-				var version = FileUtils.read_link
-					(current_path);
-				if (! ("/" in version))
-					ret.prepend(new InstalledPackage
-						(package, version,
-						 current_path));
+					(root, pkg.name, "current");
+				ret.prepend(new InstalledPackage
+					(pkg.name, pkg.current, current_path));
 			}
 		}
 
@@ -193,6 +717,26 @@ public class SingleDB : Object {
 		return ret;
 	}
 
+	/**
+	 * load_manifest:
+	 * @package: A package name.
+	 * @path: The path to an unpacked version of @package.
+	 *
+	 * Returns: The sealed, cached manifest of the package unpacked in
+	 * @path, without any dynamic keys.
+	 */
+	private Json.Object
+	load_manifest (string package, string path) throws DatabaseError
+	{
+		var manifest_path = Path.build_filename
+			(path, ".click", "info", @"$package.manifest");
+		var master_db = (DB) this._master_db.get ();
+		if (master_db != null)
+			return master_db.manifest_cache.lookup (manifest_path);
+		else
+			return new ManifestCache ().lookup (manifest_path);
+	}
+
 	/**
 	 * get_manifest:
 	 * @package: A package name.
@@ -210,22 +754,7 @@ public class SingleDB : Object {
 	{
 		/* Extract the raw manifest from the file system. */
 		var path = get_path (package, version);
-		var manifest_path = Path.build_filename
-			(path, ".click", "info", @"$package.manifest");
-		var parser = new Json.Parser ();
-		try {
-			parser.load_from_file (manifest_path);
-		} catch (Error e) {
-			throw new DatabaseError.BAD_MANIFEST
-				("Failed to parse manifest in %s: %s",
-				 manifest_path, e.message);
-		}
-		var node = parser.get_root ();
-		if (node.get_node_type () != Json.NodeType.OBJECT)
-			throw new DatabaseError.BAD_MANIFEST
-				("Manifest in %s is not a JSON object",
-				 manifest_path);
-		var manifest = node.dup_object ();
+		var manifest = copy_manifest (load_manifest (package, path));
 
 		/* Set up dynamic keys. */
 		var to_remove = new List<string> ();
@@ -311,13 +840,9 @@ public class SingleDB : Object {
 		if (get_app_pid_command () == null)
 			return false;
 
-		var manifest_path = Path.build_filename
-			(get_path (package, version), ".click", "info",
-			 @"$package.manifest");
-		var parser = new Json.Parser ();
+		var path = get_path (package, version);
 		try {
-			parser.load_from_file (manifest_path);
-			var manifest = parser.get_root ().get_object ();
+			var manifest = load_manifest (package, path);
 			if (! manifest.has_member ("hooks"))
 				return false;
 			var hooks = manifest.get_object_member ("hooks");
@@ -331,24 +856,130 @@ public class SingleDB : Object {
 		return false;
 	}
 
+	/**
+	 * get_app_ids:
+	 * @package: A package name.
+	 * @version: A version string.
+	 *
+	 * Returns: The application IDs provided by version @version of
+	 * @package, or an empty list if its manifest cannot be read.
+	 */
+	private Gee.List<string>
+	get_app_ids (string package, string version)
+	{
+		var ret = new Gee.ArrayList<string> ();
+		try {
+			var path = get_path (package, version);
+			var manifest = load_manifest (package, path);
+			if (manifest.has_member ("hooks")) {
+				var hooks = manifest.get_object_member
+					("hooks");
+				foreach (unowned string app_name in
+						hooks.get_members ())
+					ret.add (@"$(package)_$(app_name)_" +
+						 @"$(version)");
+			}
+		} catch (Error e) {
+		}
+		return ret;
+	}
+
+	private string?
+	get_proc_dir ()
+	{
+		var master_db = (DB) this._master_db.get ();
+		return master_db != null ? master_db.proc_dir : null;
+	}
+
+	/**
+	 * get_running_apps:
+	 * @app_ids: Application IDs, in the form PACKAGE_APP_VERSION.
+	 *
+	 * Check which of a set of applications are running.  If
+	 * #ClickDB:proc_dir is set, this is a single scan of its processes.
+	 * Otherwise, lomiri-app-pid still runs once per application, but
+	 * from one shell per batch of applications rather than one process
+	 * spawned from here per application.
+	 *
+	 * Returns: The elements of @app_ids that are known to be running.
+	 *
+	 * Since: 0.5.3
+	 */
+	public string[]
+	get_running_apps (string[] app_ids)
+	{
+		var candidates = new Gee.ArrayList<string> ();
+		foreach (var app_id in app_ids)
+			candidates.add (app_id);
+		var running = get_running_app_ids (candidates, get_proc_dir ());
+		string[] ret = {};
+		foreach (var app_id in app_ids) {
+			if (app_id in running)
+				ret += app_id;
+		}
+		return ret;
+	}
+
+	/**
+	 * get_running_versions:
+	 * @packages: Installed package versions.
+	 *
+	 * Returns: Those of @packages with at least one running application.
+	 */
+	private Gee.Set<InstalledPackage>
+	get_running_versions (Gee.Collection<InstalledPackage> packages)
+	{
+		var app_ids = new Gee.HashMultiMap<InstalledPackage, string> ();
+		foreach (var inst in packages) {
+			foreach (var app_id in get_app_ids
+					(inst.package, inst.version))
+				app_ids[inst] = app_id;
+		}
+		var running = get_running_app_ids
+			(app_ids.get_values (), get_proc_dir ());
+		var ret = new Gee.HashSet<InstalledPackage> ();
+		foreach (var inst in app_ids.get_keys ()) {
+			foreach (var app_id in app_ids[inst]) {
+				if (app_id in running) {
+					ret.add (inst);
+					break;
+				}
+			}
+		}
+		return ret;
+	}
+
 	private void
 	remove_unless_running (string package, string version) throws Error
+	{
+		if (any_app_running (package, version)) {
+			/* Make sure that gc looks at it again. */
+			new Journal (root).append
+				(JOURNAL_RETRY, null, package, version);
+			return;
+		}
+		remove_version (package, version);
+	}
+
+	private void
+	remove_version (string package, string version) throws Error
 	{
 		/* The callers already check that master_db exists. */
 		var master_db = (DB) this._master_db.get();
 
-		if (any_app_running (package, version))
-			return;
-
 		var version_path = get_path (package, version);
 		if (show_messages ())
 			message ("Removing %s", version_path);
 		package_remove_hooks (master_db, package, version);
-		var file = File.new_for_path (version_path);
-		try {
-			rmtree (file, null);
-		} catch (Error e) {
-			warning ("Error removing '%s': %s", version_path, e.message);
+		/* Deleting the tree itself is left to gc or click reap. */
+		if (! move_to_trash (version_path, get_trash_dir ())) {
+			var file = File.new_for_path (version_path);
+			try {
+				rmtree (file, null);
+			} catch (Error e) {
+				warning ("Error removing '%s': %s",
+					 version_path, e.message);
+			}
 		}
 
 		var package_path = Path.build_filename (root, package);
@@ -374,58 +1005,294 @@ public class SingleDB : Object {
 					("rmdir %s failed: %s",
 					 package_path, strerror (errno));
 		}
+		new Journal (root).append
+			(JOURNAL_REMOVE, null, package, version);
+	}
+
+	/**
+	 * record_unpack:
+	 * @package: A package name.
+	 * @version: A version string.
+	 *
+	 * Record in this database's journal that @version of @package has
+	 * just been unpacked, so that the next gc and hook synchronisation
+	 * take it into account.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	record_unpack (string package, string version)
+	{
+		new Journal (root).append (JOURNAL_UNPACK, null, package, version);
+	}
+
+	/**
+	 * maybe_remove:
+	 * @package: A package name.
+	 * @version: A version string.
+	 *
+	 * Remove a package version if it is not in use.
+	 *
+	 * "In use" may mean registered for another user, or running.  In
+	 * either case, we do nothing.  We will already have removed at
+	 * least one registration by this point, so if no registrations are
+	 * left but it is running, then gc will be able to come along later
+	 * and clean things out.
+	 */
+	public void
+	maybe_remove (string package, string version) throws Error
+	{
+		/* Acquire a local, strong reference from the WeakRef. */
+		var master_db = (DB) this._master_db.get();
+		if (master_db == null) {
+			error("operation requires DB.");
+			return;
+		}
+
+		var users_db = new Users (master_db);
+		foreach (var user_name in users_db.get_user_names ()) {
+			var user_db = users_db.get_user (user_name);
+			string reg_version;
+			try {
+				reg_version = user_db.get_version (package);
+			} catch (UserError e) {
+				continue;
+			}
+			if (reg_version == version) {
+				/* In use. */
+				return;
+			}
+		}
+
+		remove_unless_running (package, version);
+	}
+
+	/**
+	 * plan_gc:
+	 * @only: (allow-none): If not null, only consider these packages.
+	 * @scan: (allow-none): A scan of @master_db to use rather than
+	 * scanning it again.
+	 *
+	 * Work out what gc would do.  All user registrations are read once
+	 * up front; both re-registrations and removals are then decided
+	 * from that snapshot.
+	 */
+	private GcPlan
+	plan_gc (DB master_db, Gee.Set<string>? only = null,
+		 PackageScan? scan = null) throws Error
+	{
+		var plan = new GcPlan ();
+		if (only != null && only.is_empty)
+			return plan;
+		if (scan == null)
+			scan = new PackageScan (master_db);
+
+		/* User name → package → registered version. */
+		var registrations =
+			new Gee.TreeMap<string, Gee.Map<string, string>> ();
+		var users_db = new Users (master_db);
+		foreach (var user_name in users_db.get_user_names ()) {
+			var user_db = users_db.get_user (user_name);
+			plan.users[user_name] = user_db;
+			registrations[user_name] =
+				user_db.get_registered_versions ();
+		}
+
+		// Clean up user registrations: registrations for old packages should
+		// be updated to point to the newest version available. TODO: Check
+		// registration timestamps and compare to package timestamps before
+		// blindly re-registering so old versions can still be registered if
+		// they were done so after the new package was installed.
+		var newest = new Gee.HashMap<string, string> ();
+		foreach (var package in scan.packages) {
+			if (only != null && ! (package.package in only))
+				continue;
+			var version = newest[package.package];
+			if (version == null ||
+			    version_compare (package.version, version) > 0)
+				newest[package.package] = package.version;
+		}
+		foreach (var user_entry in registrations.entries) {
+			foreach (var entry in user_entry.value.entries) {
+				var version = newest[entry.key];
+				if (version == null || entry.value == "current" ||
+				    version_compare (entry.value, version) >= 0)
+					continue;
+				plan.reregister.add (new GcReregistration
+					(user_entry.key, entry.key,
+					 entry.value, version));
+				entry.value = version;
+			}
+		}
+
+		var user_reg = new Gee.HashMultiMap<string, string> ();
+		foreach (var user_entry in registrations.entries) {
+			if (plan.users[user_entry.key].is_gc_in_use) {
+				plan.gc_in_use.add_all (user_entry.value.keys);
+				continue;
+			}
+			foreach (var entry in user_entry.value.entries) {
+				if (entry.value == "current")
+					continue;
+				/* Odd multimap syntax; this should really
+				 * be more like foo[package] += version.
+				 */
+				user_reg[entry.key] = entry.value;
+			}
+		}
+
+		Gee.List<InstalledPackage> own;
+		if (root == master_db.overlay)
+			own = scan.get_writeable ();
+		else {
+			own = new Gee.ArrayList<InstalledPackage> ();
+			foreach (var inst in get_packages (true))
+				own.add (inst);
+		}
+		foreach (var inst in own) {
+			if (only != null && ! (inst.package in only))
+				continue;
+			if (inst.version in user_reg[inst.package])
+				/* In use. */
+				continue;
+			plan.remove.add (inst);
+		}
+
+		return plan;
+	}
+
+	private string
+	get_gc_checkpoint_path ()
+	{
+		return Path.build_filename
+			(root, ".click", "checkpoints", "gc");
 	}
 
 	/**
-	 * maybe_remove:
-	 * @package: A package name.
-	 * @version: A version string.
+	 * get_gc_journal_packages:
+	 * @master_db: The #DB containing this database.
+	 * @next: (out): The checkpoint to save once gc has finished, or null.
 	 *
-	 * Remove a package version if it is not in use.
+	 * Returns: The packages that gc needs to consider, according to the
+	 * journal, or null if it must consider every package.  This does not
+	 * change the checkpoint.
+	 */
+	private Gee.Set<string>?
+	get_gc_journal_packages (DB master_db, out JournalCheckpoint? next)
+	{
+		next = null;
+		if (root != master_db.overlay)
+			return null;
+		var entries = read_journal_since_checkpoint
+			(master_db, get_gc_checkpoint_path (), false, out next);
+		if (entries == null)
+			return null;
+		var only = new Gee.HashSet<string> ();
+		foreach (var entry in entries)
+			only.add (entry.package);
+		return only;
+	}
+
+	/**
+	 * get_gc_plan:
 	 *
-	 * "In use" may mean registered for another user, or running.  In
-	 * either case, we do nothing.  We will already have removed at
-	 * least one registration by this point, so if no registrations are
-	 * left but it is running, then gc will be able to come along later
-	 * and clean things out.
+	 * Work out what gc would do, without changing anything.  As with
+	 * gc, only the packages named in the journal since the last gc are
+	 * considered, if possible.
+	 *
+	 * Returns: A #Json.Object describing the plan.  "reregister" is an
+	 * array of objects with "user", "package", "old-version", and
+	 * "new-version" members, for user registrations that would be moved
+	 * to the newest available version.  "remove" is an array of objects
+	 * with "package", "version", "path", and "size" members, for
+	 * package versions that would be removed.  "running" is an array of
+	 * objects with the same members, for unregistered package versions
+	 * that would be kept because they are running.  "size" is the total
+	 * number of bytes that would be freed.
+	 *
+	 * Since: 0.5.3
 	 */
-	public void
-	maybe_remove (string package, string version) throws Error
+	public Json.Object
+	get_gc_plan () throws Error
 	{
 		/* Acquire a local, strong reference from the WeakRef. */
 		var master_db = (DB) this._master_db.get();
-		if (master_db == null) {
-			error("operation requires DB.");
-			return;
+		if (master_db == null)
+			throw new DatabaseError.INVALID
+				("operation requires DB.");
+
+		JournalCheckpoint? next;
+		var plan = plan_gc
+			(master_db, get_gc_journal_packages (master_db, out next));
+		var ret = new Json.Object ();
+
+		var reregister = new Json.Array ();
+		foreach (var rereg in plan.reregister) {
+			var obj = new Json.Object ();
+			obj.set_string_member ("user", rereg.user_name);
+			obj.set_string_member ("package", rereg.package);
+			obj.set_string_member ("old-version", rereg.old_version);
+			obj.set_string_member ("new-version", rereg.new_version);
+			reregister.add_object_element (obj);
 		}
-
-		var users_db = new Users (master_db);
-		foreach (var user_name in users_db.get_user_names ()) {
-			var user_db = users_db.get_user (user_name);
-			string reg_version;
-			try {
-				reg_version = user_db.get_version (package);
-			} catch (UserError e) {
-				continue;
-			}
-			if (reg_version == version) {
-				/* In use. */
-				return;
+		ret.set_array_member ("reregister", reregister);
+
+		var remove = new Json.Array ();
+		var running = new Json.Array ();
+		uint64 total_size = 0;
+		var running_versions = get_running_versions (plan.remove);
+		foreach (var inst in plan.remove) {
+			var size = disk_usage (inst.path);
+			var obj = new Json.Object ();
+			obj.set_string_member ("package", inst.package);
+			obj.set_string_member ("version", inst.version);
+			obj.set_string_member ("path", inst.path);
+			obj.set_int_member ("size", (int64) size);
+			if (inst in running_versions)
+				running.add_object_element (obj);
+			else {
+				remove.add_object_element (obj);
+				total_size += size;
 			}
 		}
+		ret.set_array_member ("remove", remove);
+		ret.set_array_member ("running", running);
+		ret.set_int_member ("size", (int64) total_size);
 
-		remove_unless_running (package, version);
+		return ret;
+	}
+
+	/**
+	 * get_gc_plan_as_string:
+	 *
+	 * Returns: A JSON string containing the serialised output of
+	 * get_gc_plan.
+	 *
+	 * Since: 0.5.3
+	 */
+	public string
+	get_gc_plan_as_string () throws Error
+	{
+		var plan = get_gc_plan ();
+		var node = new Json.Node (Json.NodeType.OBJECT);
+		node.set_object (plan);
+		var generator = new Json.Generator ();
+		generator.set_root (node);
+		return generator.to_data (null);
 	}
 
 	/**
 	 * gc:
 	 *
 	 * Remove package versions that have no user registrations and that
-	 * are not running.
+	 * are not running, and then delete everything in the trash
+	 * directory.
 	 *
 	 * This is rather like maybe_remove, but is suitable for bulk use,
 	 * since it only needs to scan the database once rather than once
-	 * per package.
+	 * per package.  If this is the overlay database and its journal
+	 * shows what has changed since the last gc, then only the packages
+	 * named in the journal are considered.
 	 *
 	 * For historical reasons, we don't count @gcinuse as a real user
 	 * registration, and remove any such registrations we find.  We can
@@ -434,6 +1301,19 @@ public class SingleDB : Object {
 	 */
 	public void
 	gc () throws Error
+	{
+		gc_scanned (null);
+	}
+
+	/**
+	 * gc_scanned:
+	 * @scan: (allow-none): A scan of the master database to use rather
+	 * than scanning it again.  It is refreshed if anything is removed.
+	 *
+	 * Like gc.
+	 */
+	internal void
+	gc_scanned (PackageScan? scan) throws Error
 	{
 		/* Acquire a local, strong reference from the WeakRef. */
 		var master_db = (DB) this._master_db.get();
@@ -442,147 +1322,78 @@ public class SingleDB : Object {
 			return;
 		}
 
-		// Clean up user registrations: registrations for old packages should
-		// be updated to point to the newest version available. TODO: Check
-		// registration timestamps and compare to package timestamps before
-		// blindly re-registering so old versions can still be registered if
-		// they were done so after the new package was installed.
-		foreach (var package in master_db.get_packages(true)) {
-			var users_db = new Users (master_db);
-			foreach (var name in users_db.get_user_names ()) {
-				var user_db = users_db.get_user (name);
-
-				try {
-					string registered_version = user_db.get_version (package.package);
-
-					string[] args = { "dpkg", "--compare-versions",
-					                  registered_version, "lt",
-					                  package.version };
-					int exit_status;
-					Process.spawn_sync (null, args, null,
-					                    SpawnFlags.SEARCH_PATH, null, null,
-					                    null, out exit_status);
-
-					// This will throw if non-zero
-					Process.check_exit_status (exit_status);
-
-					// Update the user's registered version if necessary.
-					user_db.set_version (package.package, package.version);
-				} catch {
-					// User was either not registered for this app or was
-					// registered for this version (or newer). Either way,
-					// skip it.
-				}
-			}
-		}
+		var journal = new Journal (root);
+		var checkpoint_path = get_gc_checkpoint_path ();
+		JournalCheckpoint? next;
+		var only = get_gc_journal_packages (master_db, out next);
 
-		var users_db = new Users (master_db);
-		var user_reg = new Gee.HashMultiMap<string, string> ();
-		foreach (var user_name in users_db.get_user_names ()) {
-			var user_db = users_db.get_user (user_name);
-			foreach (var package in user_db.get_package_names ()) {
-				var version = user_db.get_version (package);
-				if (version == "current")
-					continue;
-				/* Odd multimap syntax; this should really
-				 * be more like foo[package] += version.
-				 */
-				if (! user_db.is_gc_in_use)
-					user_reg[package] = version;
+		var plan = plan_gc (master_db, only, scan);
+
+		/* Package → versions that are still registered because
+		 * re-registration failed.
+		 */
+		var kept = new Gee.HashMultiMap<string, string> ();
+		foreach (var rereg in plan.reregister) {
+			try {
+				plan.users[rereg.user_name].set_version
+					(rereg.package, rereg.new_version);
+			} catch {
+				// The registration could not be updated; skip
+				// it, but try again next time.
+				kept[rereg.package] = rereg.old_version;
+				journal.append
+					(JOURNAL_RETRY, rereg.user_name,
+					 rereg.package, rereg.old_version);
 			}
 		}
-
-		var gc_in_use_user_db = new User.for_gc_in_use (master_db);
-		foreach (var package in Click.Dir.open (root)) {
-			if (package == ".click")
-				continue;
-			var package_path = Path.build_filename (root, package);
-			if (! is_dir (package_path))
-				continue;
-			foreach (var version in Click.Dir.open
-					(package_path)) {
-				if (version == "current")
-					continue;
-				if (version in user_reg[package])
-					/* In use. */
-					continue;
-				if (gc_in_use_user_db.has_package_name
-						(package))
-					gc_in_use_user_db.remove (package);
-				remove_unless_running (package, version);
+		if (kept.size > 0) {
+			/* The plan assumed that these versions would no
+			 * longer be registered, so must not remove them.
+			 */
+			var remove = new Gee.ArrayList<InstalledPackage> ();
+			foreach (var inst in plan.remove) {
+				if (! (inst.version in kept[inst.package]))
+					remove.add (inst);
 			}
+			plan.remove = remove;
 		}
-	}
-
-	private delegate void WalkFunc (string dirpath, string[] dirnames,
-					string[] filenames) throws Error;
 
-	/**
-	 * walk:
-	 *
-	 * An reduced emulation of Python's os.walk.
-	 */
-	private void
-	walk (string top, WalkFunc func) throws Error
-	{
-		string[] dirs = {};
-		string[] nondirs = {};
-		foreach (var name in Click.Dir.open (top)) {
-			var path = Path.build_filename (top, name);
-			if (is_dir (path))
-				dirs += name;
-			else
-				nondirs += name;
-		}
-		func (top, dirs, nondirs);
-		foreach (var name in dirs) {
-			var path = Path.build_filename (top, name);
-			if (! is_symlink (path))
-				walk (path, func);
+		/* Check all candidates for running applications at once. */
+		var running_versions = get_running_versions (plan.remove);
+
+		User? gc_in_use_user_db = null;
+		var removed = false;
+		foreach (var inst in plan.remove) {
+			unowned string package = inst.package;
+			if (package in plan.gc_in_use) {
+				if (gc_in_use_user_db == null)
+					gc_in_use_user_db =
+						new User.for_gc_in_use
+						(master_db);
+				gc_in_use_user_db.remove (package);
+				plan.gc_in_use.remove (package);
+			}
+			if (! (inst in running_versions)) {
+				remove_version (package, inst.version);
+				removed = true;
+			} else
+				journal.append
+					(JOURNAL_RETRY, null, package,
+					 inst.version);
 		}
-	}
+		if (scan != null && removed)
+			scan.refresh (master_db);
 
-	private delegate void ClickpkgForeachFunc (string path)
-		throws DatabaseError;
+		/* Entries appended since we read the journal, including our
+		 * own retries, are left for next time.
+		 */
+		save_journal_checkpoint (next, checkpoint_path);
 
-	/**
-	 * foreach_clickpkg_path:
-	 *
-	 * Call a delegate for each path which should be owned by clickpkg.
-	 */
-	private void
-	foreach_clickpkg_path (ClickpkgForeachFunc func) throws Error
-	{
-		if (exists (root))
-			func (root);
-		foreach (var package in Click.Dir.open (root)) {
-			var path = Path.build_filename (root, package);
-			if (package == ".click") {
-				func (path);
-				var log_path = Path.build_filename
-					(path, "log");
-				if (exists (log_path))
-					func (log_path);
-				var users_path = Path.build_filename
-					(path, "users");
-				if (exists (users_path))
-					func (users_path);
-			} else {
-				walk (path, (dp, dns, fns) => {
-					func (dp);
-					foreach (var dn in dns) {
-						var dnp = Path.build_filename
-							(dp, dn);
-						if (is_symlink (dnp))
-							func (dnp);
-					}
-					foreach (var fn in fns) {
-						var fnp = Path.build_filename
-							(dp, fn);
-						func (fnp);
-					}
-				});
-			}
+		try {
+			new TrashReaper (get_trash_dir ()).reap ();
+		} catch (FileError e) {
+			warning ("Error emptying %s: %s",
+				 get_trash_dir (), e.message);
 		}
 	}
 
@@ -599,8 +1410,31 @@ public class SingleDB : Object {
 	public void
 	ensure_ownership () throws Error
 	{
-		errno = 0;
-		unowned Posix.Passwd? pw = Posix.getpwnam ("clickpkg");
+		uint visited, changed;
+		ensure_ownership_full (1, out visited, out changed);
+	}
+
+	/**
+	 * ensure_ownership_full:
+	 * @max_workers: The maximum number of packages to process in
+	 * parallel, or 0 to use one worker per processor.
+	 * @visited: (out): The number of database entries examined.
+	 * @changed: (out): The number of database entries whose ownership
+	 * was changed.
+	 *
+	 * Like ensure_ownership, but allows the work to be spread across
+	 * several threads and reports what was done.  Entries that are
+	 * already owned by clickpkg are left alone.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	ensure_ownership_full (uint max_workers, out uint visited,
+			       out uint changed) throws Error
+	{
+		visited = 0;
+		changed = 0;
+		var pw = lookup_passwd ("clickpkg");
 		if (pw == null)
 			throw new DatabaseError.ENSURE_OWNERSHIP
 				("Cannot get password file entry for " +
@@ -608,22 +1442,65 @@ public class SingleDB : Object {
 		Posix.Stat st;
 		if (Posix.stat (root, out st) < 0)
 			return;
-		if (st.st_uid == pw.pw_uid && st.st_gid == pw.pw_gid)
+		if (st.st_uid == pw.uid && st.st_gid == pw.gid)
 			return;
-		foreach_clickpkg_path ((path) => {
-			if (Posix.chown (path, pw.pw_uid, pw.pw_gid) < 0)
-				throw new DatabaseError.ENSURE_OWNERSHIP
-					("Cannot set ownership of %s: %s",
-					 path, strerror (errno));
-		});
+		var walker = new OwnershipWalker (pw.uid, pw.gid);
+		try {
+			walker.run (root, max_workers);
+		} finally {
+			visited = (uint) walker.visited;
+			changed = (uint) walker.changed;
+		}
 	}
 }
 
 public class DB : Object {
 	private Gee.ArrayList<SingleDB> db = new Gee.ArrayList<SingleDB> ();
 
+	internal ManifestCache manifest_cache = new ManifestCache ();
+	internal HookRegistry hook_registry = new HookRegistry ();
+	/* The outermost HookTransaction in progress, if any. */
+	internal HookTransaction? hook_transaction = null;
+
+	private PackageLocator? _locator = null;
+
 	public DB () {}
 
+	private PackageLocator
+	get_locator ()
+	{
+		if (_locator == null)
+			_locator = new PackageLocator (db);
+		return _locator;
+	}
+
+	/**
+	 * The number of manifest lookups answered from the cache.
+	 *
+	 * Since: 0.5.3
+	 */
+	public uint manifest_cache_hits {
+		get { return manifest_cache.hits; }
+	}
+
+	/**
+	 * The number of manifest lookups that required parsing a manifest.
+	 *
+	 * Since: 0.5.3
+	 */
+	public uint manifest_cache_misses {
+		get { return manifest_cache.misses; }
+	}
+
+	/**
+	 * The number of times the hooks directory has been parsed.
+	 *
+	 * Since: 0.5.3
+	 */
+	public uint hook_registry_loads {
+		get { return hook_registry.loads; }
+	}
+
 	public void
 	read (string? db_dir = null) throws FileError
 	{
@@ -646,6 +1523,16 @@ public class DB : Object {
 			}
 			assert (root != null);
 			add (root);
+			try {
+				if (config.has_key ("Click Database", "index"))
+					db.last ().use_index = config.get_boolean
+						("Click Database", "index");
+				if (config.has_key ("Click Database", "proc"))
+					proc_dir = config.get_string
+						("Click Database", "proc");
+			} catch (KeyFileError e) {
+				warning ("%s", e.message);
+			}
 		}
 	}
 
@@ -681,6 +1568,20 @@ public class DB : Object {
 		}
 	}
 
+	/**
+	 * proc_dir:
+	 *
+	 * If set, find running applications by scanning the processes in
+	 * this proc file system (normally /proc) once, rather than by
+	 * running lomiri-app-pid for each application.  This is not the
+	 * default, since it only recognises applications by their AppArmor
+	 * label or control group path.  DB.read sets it from a "proc" key
+	 * in any of the database configuration files.
+	 *
+	 * Since: 0.5.3
+	 */
+	public string? proc_dir { get; set; default = null; }
+
 	/**
 	 * get_path:
 	 * @package: A package name.
@@ -691,12 +1592,9 @@ public class DB : Object {
 	public string
 	get_path (string package, string version) throws DatabaseError
 	{
-		foreach (var single_db in db) {
-			try {
-				return single_db.get_path (package, version);
-			} catch (DatabaseError e) {
-			}
-		}
+		var layer = get_locator ().find (package, version);
+		if (layer != null)
+			return Path.build_filename (layer.root, package, version);
 		throw new DatabaseError.DOES_NOT_EXIST
 			("%s %s does not exist in any database",
 			 package, version);
@@ -713,12 +1611,7 @@ public class DB : Object {
 	public bool
 	has_package_version (string package, string version)
 	{
-		try {
-			get_path (package, version);
-			return true;
-		} catch (DatabaseError e) {
-			return false;
-		}
+		return get_locator ().find (package, version) != null;
 	}
 
 	/**
@@ -772,9 +1665,11 @@ public class DB : Object {
 	public Json.Object
 	get_manifest (string package, string version) throws DatabaseError
 	{
-		foreach (var single_db in db) {
+		foreach (var layer in get_locator ().find_layers (package)) {
+			if (! (version in layer.versions))
+				continue;
 			try {
-				return single_db.get_manifest
+				return db[layer.layer].get_manifest
 					(package, version);
 			} catch (DatabaseError e) {
 				if (e is DatabaseError.BAD_MANIFEST)
@@ -827,6 +1722,28 @@ public class DB : Object {
 	get_manifests (bool all_versions = false) throws Error
 	{
 		var ret = new Json.Array ();
+		foreach_manifest (all_versions, (obj) => {
+			ret.add_object_element (obj);
+			return true;
+		});
+		return ret;
+	}
+
+	/**
+	 * foreach_manifest:
+	 * @all_versions: If true, visit manifests for all versions, not
+	 * just current ones.
+	 * @func: (scope call): A function to call for each manifest.
+	 *
+	 * Call @func for the manifest of each package in this database in
+	 * turn, as get_manifests would return them, without building them
+	 * all in memory at once.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	foreach_manifest (bool all_versions, ManifestFunc func) throws Error
+	{
 		foreach (var inst in get_packages (all_versions)) {
 			Json.Object obj;
 			try {
@@ -842,11 +1759,138 @@ public class DB : Object {
 			 */
 			obj.set_int_member ("_removable",
 					    inst.writeable ? 1 : 0);
-			ret.add_object_element (obj);
+			if (! func (obj))
+				break;
+		}
+	}
+
+	/**
+	 * load_manifest_at:
+	 * @package: A package name.
+	 * @path: The path to an unpacked version of @package.
+	 *
+	 * Returns: The sealed, cached manifest of the package unpacked in
+	 * @path, without any dynamic keys.
+	 */
+	internal Json.Object
+	load_manifest_at (string package, string path) throws DatabaseError
+	{
+		return manifest_cache.lookup (Path.build_filename
+			(path, ".click", "info", @"$package.manifest"));
+	}
+
+	/**
+	 * check_manifest_at:
+	 * @package: A package name.
+	 * @path: The path to an unpacked version of @package.
+	 *
+	 * Check that the package unpacked in @path has a manifest, without
+	 * parsing it.  Throws the same error as load_manifest_at would if
+	 * it does not.
+	 */
+	internal void
+	check_manifest_at (string package, string path) throws DatabaseError
+	{
+		var manifest_path = Path.build_filename
+			(path, ".click", "info", @"$package.manifest");
+		Posix.Stat st;
+		if (Posix.stat (manifest_path, out st) < 0)
+			throw new DatabaseError.BAD_MANIFEST
+				("Failed to parse manifest in %s: %s",
+				 manifest_path, strerror (errno));
+	}
+
+	/**
+	 * foreach_manifest_with_fields:
+	 * @all_versions: If true, visit all versions, not just current
+	 * ones.
+	 * @fields: (array zero-terminated=1): The manifest keys to return.
+	 * @func: (scope call): A function to call for each package.
+	 *
+	 * Like foreach_manifest, but each object passed to @func contains
+	 * only the requested keys.  Dynamic keys such as "_directory" and
+	 * "_removable" are only computed if requested, and manifests are
+	 * not parsed if only "name" and "version" are requested, since
+	 * those are known from the database layout.  Packages whose
+	 * manifest is missing are still skipped with a warning.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	foreach_manifest_with_fields (bool all_versions, string[] fields,
+				      ManifestFunc func) throws Error
+	{
+		var need_manifest = fields_need_manifest (fields);
+		var need_directory = has_field (fields, "_directory");
+		foreach (var inst in get_packages (all_versions)) {
+			Json.Object? manifest = null;
+			string? path = null;
+			try {
+				path = get_path (inst.package, inst.version);
+				if (need_manifest)
+					manifest = load_manifest_at
+						(inst.package, path);
+				else
+					check_manifest_at (inst.package, path);
+			} catch (DatabaseError e) {
+				warning ("%s", e.message);
+				continue;
+			}
+			var obj = project_manifest
+				(manifest, inst.package, inst.version, fields);
+			if (need_directory)
+				obj.set_string_member ("_directory", path);
+			if (has_field (fields, "_removable"))
+				obj.set_int_member ("_removable",
+						    inst.writeable ? 1 : 0);
+			if (! func (obj))
+				break;
 		}
+	}
+
+	/**
+	 * get_manifests_with_fields:
+	 * @all_versions: If true, return all versions, not just current
+	 * ones.
+	 * @fields: (array zero-terminated=1): The manifest keys to return.
+	 *
+	 * Returns: A #Json.Array as returned by get_manifests, but with
+	 * each manifest reduced to the requested keys.  See
+	 * foreach_manifest_with_fields.
+	 *
+	 * Since: 0.5.3
+	 */
+	public Json.Array
+	get_manifests_with_fields (bool all_versions, string[] fields)
+		throws Error
+	{
+		var ret = new Json.Array ();
+		foreach_manifest_with_fields (all_versions, fields, (obj) => {
+			ret.add_object_element (obj);
+			return true;
+		});
 		return ret;
 	}
 
+	/**
+	 * write_manifests:
+	 * @fd: A file descriptor open for writing.
+	 * @all_versions: If true, write manifests for all versions, not
+	 * just current ones.
+	 *
+	 * Write the same serialised array as get_manifests_as_string to
+	 * @fd, one manifest at a time.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	write_manifests (int fd, bool all_versions = false) throws Error
+	{
+		var writer = new ManifestWriter (fd);
+		foreach_manifest (all_versions, writer.add);
+		writer.finish ();
+	}
+
 	/**
 	 * get_manifests_as_string:
 	 * @all_versions: If true, return manifests for all versions, not
@@ -865,12 +1909,10 @@ public class DB : Object {
 	public string
 	get_manifests_as_string (bool all_versions = false) throws Error
 	{
-		var manifests = get_manifests (all_versions);
-		var node = new Json.Node (Json.NodeType.ARRAY);
-		node.set_array (manifests);
-		var generator = new Json.Generator ();
-		generator.set_root (node);
-		return generator.to_data (null);
+		var writer = new ManifestWriter.for_string ();
+		foreach_manifest (all_versions, writer.add);
+		writer.finish ();
+		return writer.get_string ();
 	}
 
 	private void
@@ -895,12 +1937,71 @@ public class DB : Object {
 		db.last ().gc ();
 	}
 
+	internal void
+	gc_scanned (PackageScan? scan) throws Error
+	{
+		ensure_db();
+		db.last ().gc_scanned (scan);
+	}
+
+	/**
+	 * get_gc_plan:
+	 *
+	 * Returns: A #Json.Object describing what gc would do, without
+	 * changing anything.  See click_single_db_get_gc_plan.
+	 *
+	 * Since: 0.5.3
+	 */
+	public Json.Object
+	get_gc_plan () throws Error
+	{
+		ensure_db();
+		return db.last ().get_gc_plan ();
+	}
+
+	/**
+	 * get_gc_plan_as_string:
+	 *
+	 * Returns: A JSON string containing the serialised output of
+	 * get_gc_plan.
+	 *
+	 * Since: 0.5.3
+	 */
+	public string
+	get_gc_plan_as_string () throws Error
+	{
+		ensure_db();
+		return db.last ().get_gc_plan_as_string ();
+	}
+
 	public void
 	ensure_ownership () throws Error
 	{
 		ensure_db();
 		db.last ().ensure_ownership ();
 	}
+
+	/**
+	 * ensure_ownership_full:
+	 * @max_workers: The maximum number of packages to process in
+	 * parallel, or 0 to use one worker per processor.
+	 * @visited: (out): The number of database entries examined.
+	 * @changed: (out): The number of database entries whose ownership
+	 * was changed.
+	 *
+	 * Like ensure_ownership, but allows the work to be spread across
+	 * several threads and reports what was done.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	ensure_ownership_full (uint max_workers, out uint visited,
+			       out uint changed) throws Error
+	{
+		ensure_db();
+		db.last ().ensure_ownership_full
+			(max_workers, out visited, out changed);
+	}
 }
 
 }
@@ -91,17 +91,17 @@ public class Framework : Object {
 	get_frameworks ()
 	{
 		var ret = new List<Framework> ();
-		Click.Dir dir;
+		DirStream dir;
 		try {
-			dir = Click.Dir.open (get_frameworks_dir ());
+			dir = DirStream.open (get_frameworks_dir (), true);
 		} catch (FileError e) {
 			return ret;
 		}
 		foreach (var entry in dir) {
-			if (! entry.has_suffix (".framework"))
+			if (! entry.name.has_suffix (".framework"))
 				continue;
 			try {
-				ret.prepend (open (entry[0:-10]));
+				ret.prepend (open (entry.name[0:-10]));
 			} catch (Error e) {
 				continue;
 			}
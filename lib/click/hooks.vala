@@ -95,14 +95,21 @@ validate_framework (string required_frameworks)
 	return true;
 }
 
+/* @cache maps required_frameworks strings to earlier results. */
 private bool
-validate_framework_for_package (DB db, string package, string? version)
+validate_framework_for_package (DB db, string package, string? version,
+				Gee.Map<string, bool>? cache = null)
 {
 	var manifest = read_manifest (db, package, version);
 	if (!manifest.has_member ("framework"))
 		return true;
 	var required_frameworks = manifest.get_string_member ("framework");
-	return validate_framework (required_frameworks);
+	if (cache == null)
+		return validate_framework (required_frameworks);
+	if (! cache.has_key (required_frameworks))
+		cache[required_frameworks] =
+			validate_framework (required_frameworks);
+	return cache[required_frameworks];
 }
 
 private Json.Object
@@ -110,14 +117,11 @@ read_manifest (DB db, string package, string? version)
 {
 	if (version == null)
 		return new Json.Object ();
-	var parser = new Json.Parser ();
 	try {
 		var manifest_path = Path.build_filename
 			(db.get_path (package, version), ".click", "info",
 			 @"$package.manifest");
-		parser.load_from_file (manifest_path);
-		var manifest = parser.get_root ().get_object ();
-		return manifest.ref ();
+		return db.manifest_cache.lookup (manifest_path);
 	} catch (Error e) {
 		return new Json.Object ();
 	}
@@ -373,39 +377,84 @@ pattern_format (string format_string, Variant args)
 public Variant?
 pattern_possible_expansion (string s, string format_string, Variant args)
 {
-	string[] regex_pieces = {};
-	string[] group_names = {};
-	foreach (var segment in pattern_parse (format_string)) {
-		if (segment.is_expansion) {
-			unowned string value;
-			if (args.lookup (segment.text, "m&s", out value))
-				regex_pieces += Regex.escape_string (value);
-			else {
-				regex_pieces += "(.*)";
-				group_names += segment.text;
-			}
-		} else
-			regex_pieces += Regex.escape_string (segment.text);
-	}
-	var joined = string.joinv ("", regex_pieces);
-	Regex compiled;
-	try {
-		compiled = new Regex ("^" + joined + "$");
-	} catch (RegexError e) {
-		return null;
+	return new PatternMatcher (format_string, args).match (s);
+}
+
+/* Matches strings against one format string and set of bound keys, as
+ * pattern_possible_expansion does, but parses and compiles them only once
+ * rather than once per string.
+ */
+public class PatternMatcher : Object {
+	private Regex? compiled;
+	private string[] group_names;
+
+	/**
+	 * PatternMatcher:
+	 * @format_string: A format string.
+	 * @args: A #GLib.Variant of type "a{sms}", binding keys to values.
+	 *
+	 * Returns: (transfer full): A newly-allocated #Click.PatternMatcher.
+	 *
+	 * Since: 0.5.3
+	 */
+	public
+	PatternMatcher (string format_string, Variant args)
+	{
+		string[] regex_pieces = {};
+		group_names = {};
+		foreach (var segment in pattern_parse (format_string)) {
+			if (segment.is_expansion) {
+				unowned string value;
+				if (args.lookup (segment.text, "m&s",
+						 out value))
+					regex_pieces += Regex.escape_string
+						(value);
+				else {
+					regex_pieces += "(.*)";
+					group_names += segment.text;
+				}
+			} else
+				regex_pieces += Regex.escape_string
+					(segment.text);
+		}
+		var joined = string.joinv ("", regex_pieces);
+		try {
+			compiled = new Regex ("^" + joined + "$",
+					      RegexCompileFlags.OPTIMIZE);
+		} catch (RegexError e) {
+			compiled = null;
+		}
 	}
-	MatchInfo match_info;
-	var builder = new VariantBuilder (new VariantType ("a{ss}"));
-	if (compiled.match (s, 0, out match_info)) {
-		for (int group_i = 0; group_i < group_names.length;
-		     ++group_i) {
+
+	/**
+	 * match:
+	 * @s: A string.
+	 *
+	 * Check if @s is a possible $-expansion of this matcher's format
+	 * string, as for pattern_possible_expansion.
+	 *
+	 * Returns: A (possibly empty) dictionary #GLib.Variant mapping all
+	 * the unspecified keys to their bound values, or null if @s is not a
+	 * possible expansion.
+	 *
+	 * Since: 0.5.3
+	 */
+	public Variant?
+	match (string s)
+	{
+		if (compiled == null)
+			return null;
+		MatchInfo match_info;
+		if (! compiled.match (s, 0, out match_info))
+			return null;
+		var builder = new VariantBuilder (new VariantType ("a{ss}"));
+		for (int group_i = 0; group_i < group_names.length; ++group_i) {
 			var match = match_info.fetch (group_i + 1);
 			assert (match != null);
 			builder.add ("{ss}", group_names[group_i], match);
 		}
 		return builder.end ();
-	} else
-		return null;
+	}
 }
 
 public class Hook : Object {
@@ -413,6 +462,8 @@ public class Hook : Object {
 	public string name { internal get; construct; }
 
 	private Gee.Map<string, string> fields;
+	/* "user\nhome" → matcher for this hook's previous entries. */
+	private Gee.HashMap<string, PatternMatcher>? matchers = null;
 
 	private Hook (DB db, string name)
 	{
@@ -429,16 +480,23 @@ public class Hook : Object {
 	public static Hook
 	open (DB db, string name) throws HooksError
 	{
-		var hook_path = Path.build_filename
-			(get_hooks_dir (), @"$name.hook");
+		Hook? hook = null;
 		try {
-			var hook = new Hook (db, name);
-			hook.fields = parse_deb822_file (hook_path);
-			return hook;
-		} catch (Error e) {
+			hook = db.hook_registry.open (db, name);
+		} catch (FileError e) {
+		}
+		if (hook == null)
 			throw new HooksError.NO_SUCH_HOOK
 				("No click hook '%s' installed", name);
-		}
+		return hook;
+	}
+
+	internal static Hook
+	from_fields (DB db, string name, Gee.Map<string, string> fields)
+	{
+		var hook = new Hook (db, name);
+		hook.fields = fields;
+		return hook;
 	}
 
 	/**
@@ -454,24 +512,7 @@ public class Hook : Object {
 	public static List<Hook>
 	open_all (DB db, string? hook_name = null) throws FileError
 	{
-		var ret = new List<Hook> ();
-		var dir = get_hooks_dir ();
-		foreach (var name in Click.Dir.open (dir)) {
-			if (! name.has_suffix (".hook"))
-				continue;
-			var path = Path.build_filename (dir, name);
-			try {
-				var hook = new Hook (db, name[0:-5]);
-				hook.fields = parse_deb822_file (path);
-				if (hook_name == null ||
-				    hook.get_hook_name () == hook_name)
-					ret.prepend (hook);
-			} catch (Error e) {
-				continue;
-			}
-		}
-		ret.reverse ();
-		return ret;
+		return db.hook_registry.open_all (db, hook_name);
 	}
 
 	/**
@@ -518,6 +559,38 @@ public class Hook : Object {
 		return is_user_level || fields["single-version"] == "yes";
 	} }
 
+	/**
+	 * is_trigger:
+	 *
+	 * True if this hook's commands are run as a deferred trigger,
+	 * otherwise false.
+	 *
+	 * Since: 0.5.3
+	 */
+	public bool is_trigger { get {
+		return fields["trigger"] == "yes";
+	} }
+
+	/**
+	 * get_after:
+	 *
+	 * Returns: The names of the hooks that must be run before this one,
+	 * from its After field.
+	 */
+	internal string[]
+	get_after ()
+	{
+		string[] ret = {};
+		var after = fields["after"];
+		if (after == null)
+			return ret;
+		foreach (var name in after.split_set (", \t")) {
+			if (name != "")
+				ret += name;
+		}
+		return ret;
+	}
+
 	/**
 	 * get_hook_name:
 	 *
@@ -607,42 +680,30 @@ public class Hook : Object {
 			return ret.substring (0, len);
 	}
 
-	private void
-	priv_drop_failure (string name) throws HooksError
+	private static void
+	priv_drop_failure (string name)
 	{
-		throw new HooksError.DROP_PRIVS
-			("Cannot drop privileges (%s): %s",
-			 name, strerror (errno));
+		/* Only async-signal-safe calls are allowed here; see
+		 * drop_privileges.
+		 */
+		const string prefix = "Cannot drop privileges: ";
+		Posix.write (2, prefix, prefix.length);
+		Posix.write (2, name, name.length);
+		Posix.write (2, "\n", 1);
+		Posix._exit (1);
 	}
 
-	/* This function is not async-signal-safe, but runs between fork() and
-	 * execve().  As such, it is not safe to run hooks from a multi-threaded
-	 * process.  Do not use the GLib main loop with this!
+	/* This runs between fork() and execve(), possibly in a child of a
+	 * multi-threaded process (see DB.ensure_ownership_full), so it must
+	 * only make async-signal-safe calls: no allocation, no logging, and
+	 * no changes to the environment.  The password and group database
+	 * lookups are done beforehand, and the caller passes the new HOME in
+	 * the child's environment.  If anything goes wrong, the child exits
+	 * straight away.
 	 */
-	private void
-	drop_privileges_inner (string user_name) throws HooksError
+	internal static void
+	drop_privileges (CachedPasswd pw, Posix.gid_t[] supp)
 	{
-		if (Posix.geteuid () != 0)
-			return;
-
-		errno = 0;
-		unowned Posix.Passwd? pw = Posix.getpwnam (user_name);
-		if (pw == null)
-			throw new HooksError.NO_SUCH_USER
-				("Cannot get password file entry for user " +
-				 "'%s': %s", user_name, strerror (errno));
-		Posix.gid_t[] supp = {};
-		Posix.setgrent ();
-		unowned PosixExtra.Group? gr;
-		while ((gr = PosixExtra.getgrent ()) != null) {
-			foreach (unowned string member in gr.gr_mem) {
-				if (member == user_name) {
-					supp += gr.gr_gid;
-					break;
-				}
-			}
-		}
-		Posix.endgrent ();
 		if (PosixExtra.setgroups (supp.length, supp) < 0)
 			priv_drop_failure ("setgroups");
 		/* Portability note: this assumes that we have
@@ -652,34 +713,35 @@ public class Hook : Object {
 		 * involving other similar calls; see e.g.
 		 * gnulib/lib/idpriv-drop.c.
 		 */
-		if (PosixExtra.setresgid (pw.pw_gid, pw.pw_gid, pw.pw_gid) < 0)
+		if (PosixExtra.setresgid (pw.gid, pw.gid, pw.gid) < 0)
 			priv_drop_failure ("setresgid");
-		if (PosixExtra.setresuid (pw.pw_uid, pw.pw_uid, pw.pw_uid) < 0)
+		if (PosixExtra.setresuid (pw.uid, pw.uid, pw.uid) < 0)
 			priv_drop_failure ("setresuid");
-		{
-			Posix.uid_t ruid, euid, suid;
-			Posix.gid_t rgid, egid, sgid;
-			assert (PosixExtra.getresuid (out ruid, out euid,
-						      out suid) == 0 &&
-				ruid == pw.pw_uid && euid == pw.pw_uid &&
-				suid == pw.pw_uid);
-			assert (PosixExtra.getresgid (out rgid, out egid,
-						      out sgid) == 0 &&
-				rgid == pw.pw_gid && egid == pw.pw_gid &&
-				sgid == pw.pw_gid);
-		}
-		Environment.set_variable ("HOME", pw.pw_dir, true);
-		Posix.umask (get_umask () | Posix.S_IWOTH);
+		Posix.uid_t ruid, euid, suid;
+		Posix.gid_t rgid, egid, sgid;
+		if (PosixExtra.getresuid (out ruid, out euid, out suid) < 0 ||
+		    ruid != pw.uid || euid != pw.uid || suid != pw.uid)
+			priv_drop_failure ("getresuid");
+		if (PosixExtra.getresgid (out rgid, out egid, out sgid) < 0 ||
+		    rgid != pw.gid || egid != pw.gid || sgid != pw.gid)
+			priv_drop_failure ("getresgid");
+		Posix.umask (Posix.umask (0) | Posix.S_IWOTH);
 	}
 
-	private void
-	drop_privileges (string user_name)
+	/**
+	 * get_dropped_envp:
+	 * @pw: The user that a child process will run as.
+	 *
+	 * Returns: The environment for a child process whose child setup
+	 * function is drop_privileges.
+	 */
+	internal static string[]
+	get_dropped_envp (CachedPasswd pw)
 	{
-		try {
-			drop_privileges_inner (user_name);
-		} catch (HooksError e) {
-			error ("%s", e.message);
-		}
+		var envp = Environ.get ();
+		if (pw.dir != null)
+			envp = Environ.set_variable (envp, "HOME", pw.dir, true);
+		return envp;
 	}
 
 	/**
@@ -701,32 +763,81 @@ public class Hook : Object {
 	 * @user_name: (allow-none): A user name, or null.
 	 *
 	 * Run any commands specified by the hook to keep itself up to date.
+	 *
+	 * If this hook has "Trigger: yes", its commands are not run straight
+	 * away; instead, a pending trigger is recorded, and the commands run
+	 * once for any number of triggers when pending triggers are next
+	 * processed.
 	 */
 	public void
 	run_commands (string? user_name = null) throws Error
 	{
-		if (fields.has_key ("exec")) {
-			string[] argv = {"/bin/sh", "-c", fields["exec"]};
-			var target_user_name = get_run_commands_user
-				(user_name);
-			SpawnChildSetupFunc drop =
-				() => drop_privileges (target_user_name);
-			int exit_status;
-			Process.spawn_sync (null, argv, null,
-					    SpawnFlags.SEARCH_PATH, drop,
-					    null, null, out exit_status);
-			try {
-				Process.check_exit_status (exit_status);
-			} catch (Error e) {
-				throw new HooksError.COMMAND_FAILED
-					("Hook command '%s' failed: %s",
-					 fields["exec"], e.message);
-			}
+		if (! fields.has_key ("exec"))
+			return;
+		if (is_trigger && record_trigger (db, this, user_name))
+			return;
+		run_exec (user_name);
+	}
+
+	/**
+	 * run_exec:
+	 *
+	 * Like run_commands, but always run the commands straight away.
+	 */
+	internal void
+	run_exec (string? user_name = null) throws Error
+	{
+		if (! fields.has_key ("exec"))
+			return;
+		string[] argv = {"/bin/sh", "-c", fields["exec"]};
+		var target_user_name = get_run_commands_user (user_name);
+		CachedPasswd? pw = null;
+		Posix.gid_t[] supp = {};
+		if (Posix.geteuid () == 0) {
+			pw = lookup_passwd (target_user_name);
+			if (pw == null)
+				throw new HooksError.NO_SUCH_USER
+					("Cannot get password file entry " +
+					 "for user '%s': %s",
+					 target_user_name, strerror (errno));
+			supp = get_supplementary_groups (pw);
+		}
+		string[]? envp = null;
+		if (pw != null)
+			envp = get_dropped_envp (pw);
+		SpawnChildSetupFunc drop = () => {
+			if (pw != null)
+				drop_privileges (pw, supp);
+		};
+		int exit_status;
+		Process.spawn_sync (null, argv, envp, SpawnFlags.SEARCH_PATH,
+				    drop, null, null, out exit_status);
+		try {
+			Process.check_exit_status (exit_status);
+		} catch (Error e) {
+			throw new HooksError.COMMAND_FAILED
+				("Hook command '%s' failed: %s",
+				 fields["exec"], e.message);
 		}
+	}
 
-		if (fields["trigger"] == "yes")
-			throw new HooksError.NYI
-				("'Trigger: yes' not yet implemented");
+	private PatternMatcher
+	get_pattern_matcher (string? user_name, string? user_home)
+	{
+		if (matchers == null)
+			matchers = new Gee.HashMap<string, PatternMatcher> ();
+		var key = @"$(user_name ?? "")\n$(user_home ?? "")";
+		var matcher = matchers[key];
+		if (matcher == null) {
+			var builder = new VariantBuilder
+				(new VariantType ("a{sms}"));
+			builder.add ("{sms}", "user", user_name);
+			builder.add ("{sms}", "home", user_home);
+			matcher = new PatternMatcher
+				(fields["pattern"], builder.end ());
+			matchers[key] = matcher;
+		}
+		return matcher;
 	}
 
 	private List<PreviousEntry>
@@ -735,18 +846,14 @@ public class Hook : Object {
 		var ret = new List<PreviousEntry> ();
 		var link_dir_path = Path.get_dirname (get_pattern
 			("", "", "", user_name));
+		var matcher = get_pattern_matcher
+			(user_name, get_user_home (user_name));
 		/* TODO: This only works if the application ID only appears, at
 		 * most, in the last component of the pattern path.
 		 */
 		foreach (var entry in Click.Dir.open (link_dir_path)) {
 			var path = Path.build_filename (link_dir_path, entry);
-			var exp_builder = new VariantBuilder
-				(new VariantType ("a{sms}"));
-			exp_builder.add ("{sms}", "user", user_name);
-			exp_builder.add
-				("{sms}", "home", get_user_home (user_name));
-			var exp = pattern_possible_expansion
-				(path, fields["pattern"], exp_builder.end ());
+			var exp = matcher.match (path);
 			unowned string? id = null;
 			if (exp != null)
 				exp.lookup ("id", "&s", out id);
@@ -775,8 +882,11 @@ public class Hook : Object {
 	 * Install a hook symlink.
 	 *
 	 * This should be called with dropped privileges if necessary.
+	 *
+	 * Returns: False if the symlink was already in place, otherwise
+	 * true.
 	 */
-	private void
+	private bool
 	install_link (string package, string version, string app_name,
 		      string relative_path, string? user_name = null,
 		      User? user_db = null) throws Error
@@ -789,9 +899,10 @@ public class Hook : Object {
 		var target = Path.build_filename (path, relative_path);
 		var link = get_pattern (package, version, app_name, user_name);
 		if (is_symlink (link) && FileUtils.read_link (link) == target)
-			return;
+			return false;
 		ensuredir (Path.get_dirname (link));
 		symlink_force (target, link);
+		return true;
 	}
 
 	/**
@@ -802,12 +913,31 @@ public class Hook : Object {
 	 * @relative_path: A relative path within the unpacked package.
 	 * @user_name: (allow-none): A user name, or null.
 	 *
-	 * Run this hook in response to @package being installed.
+	 * Run this hook in response to @package being installed.  If a
+	 * #HookTransaction is in progress, the hook's commands are put off
+	 * until it is committed.
 	 */
 	public void
 	install_package (string package, string version, string app_name,
 			 string relative_path, string? user_name = null)
 		throws Error
+	{
+		HookTransaction.run (db, (transaction) => {
+			install_package_links (package, version, app_name,
+					       relative_path, user_name);
+			transaction.add (this, user_name);
+		});
+	}
+
+	/**
+	 * install_package_links:
+	 *
+	 * Like install_package, but without running the hook's commands.
+	 */
+	internal void
+	install_package_links (string package, string version,
+			       string app_name, string relative_path,
+			       string? user_name = null) throws Error
 	{
 		if (! is_user_level)
 			assert (user_name == null);
@@ -836,7 +966,6 @@ public class Hook : Object {
 		} else
 			install_link (package, version, app_name,
 				      relative_path);
-		run_commands (user_name);
 	}
 
 	/**
@@ -846,25 +975,44 @@ public class Hook : Object {
 	 * @app_name: An application name.
 	 * @user_name: (allow-none): A user name, or null.
 	 *
-	 * Run this hook in response to @package being removed.
+	 * Run this hook in response to @package being removed.  If a
+	 * #HookTransaction is in progress, the hook's commands are put off
+	 * until it is committed.
 	 */
 	public void
 	remove_package (string package, string version, string app_name,
 			string? user_name = null) throws Error
+	{
+		HookTransaction.run (db, (transaction) => {
+			remove_package_links (package, version, app_name,
+					      user_name);
+			transaction.add (this, user_name);
+		});
+	}
+
+	/**
+	 * remove_package_links:
+	 *
+	 * Like remove_package, but without running the hook's commands.
+	 */
+	internal void
+	remove_package_links (string package, string version,
+			      string app_name, string? user_name = null)
+		throws Error
 	{
 		unlink_force (get_pattern
 			(package, version, app_name, user_name));
-		run_commands (user_name);
 	}
 
 	private Gee.ArrayList<UnpackedPackage>
 	get_all_packages_for_user (string user_name, User user_db) throws Error
 	{
 		var ret = new Gee.ArrayList<UnpackedPackage> ();
-		foreach (var package in user_db.get_package_names ())
-			ret.add (new UnpackedPackage
-				(package, user_db.get_version (package),
-				 user_name));
+		foreach (var reg in user_db.get_registrations ()) {
+			if (! reg.hidden)
+				ret.add (new UnpackedPackage
+					(reg.package, reg.version, user_name));
+		}
 		return ret;
 	}
 
@@ -879,12 +1027,14 @@ public class Hook : Object {
 	 * user, or only for a single user if user is not null.
 	 *
 	 * If running a system-level hook, this returns (package, version,
-	 * null) for each version of each unpacked package.
+	 * null) for each version of each unpacked package, taken from @scan
+	 * if it is not null.
 	 *
 	 * Returns: A list of all unpacked packages.
 	 */
 	private List<UnpackedPackage>
-	get_all_packages (string? user_name = null) throws Error
+	get_all_packages (string? user_name = null, PackageScan? scan = null)
+		throws Error
 	{
 		var ret = new Gee.ArrayList<UnpackedPackage> ();
 		if (is_user_level) {
@@ -905,6 +1055,10 @@ public class Hook : Object {
 						(one_user_name, one_user_db));
 				}
 			}
+		} else if (scan != null) {
+			foreach (var inst in scan.packages)
+				ret.add (new UnpackedPackage
+					(inst.package, inst.version));
 		} else {
 			foreach (var inst in db.get_packages (true))
 				ret.add (new UnpackedPackage
@@ -923,19 +1077,26 @@ public class Hook : Object {
 	/**
 	 * get_relevant_apps:
 	 * @user_name: (allow-none): A user name, or null.
+	 * @only: (allow-none): If not null, only consider these packages.
+	 * @scan: (allow-none): A #PackageScan to use, or null.
 	 *
 	 * Returns: A list of all applications relevant for this hook.
 	 */
 	private List<RelevantApp>
-	get_relevant_apps (string? user_name = null) throws Error
+	get_relevant_apps (string? user_name = null,
+			   Gee.Set<string>? only = null,
+			   PackageScan? scan = null) throws Error
 	{
 		var ret = new List<RelevantApp> ();
 		var hook_name = get_hook_name ();
-		foreach (var unpacked in get_all_packages (user_name)) {
+		foreach (var unpacked in get_all_packages (user_name, scan)) {
+			if (only != null && ! (unpacked.package in only))
+				continue;
 			// if the app is not using a valid framework (anymore)
 			// we don't consider it relevant (anymore)
 			if (!validate_framework_for_package 
-				    (db, unpacked.package, unpacked.version))
+				    (db, unpacked.package, unpacked.version,
+				     scan != null ? scan.frameworks_valid : null))
 				continue;
 
 			var manifest_hooks = read_manifest_hooks
@@ -968,10 +1129,15 @@ public class Hook : Object {
 	public void
 	install (string? user_name = null) throws Error
 	{
-		foreach (var app in get_relevant_apps (user_name))
-			install_package (app.package, app.version,
+		HookTransaction.run (db, (transaction) => {
+			foreach (var app in get_relevant_apps (user_name)) {
+				install_package_links
+					(app.package, app.version,
 					 app.app_name, app.relative_path,
 					 app.user_name);
+				transaction.add (this, app.user_name);
+			}
+		});
 	}
 
 	/**
@@ -984,9 +1150,14 @@ public class Hook : Object {
 	public void
 	remove (string? user_name = null) throws Error
 	{
-		foreach (var app in get_relevant_apps (user_name))
-			remove_package (app.package, app.version, app.app_name,
-					app.user_name);
+		HookTransaction.run (db, (transaction) => {
+			foreach (var app in get_relevant_apps (user_name)) {
+				remove_package_links
+					(app.package, app.version,
+					 app.app_name, app.user_name);
+				transaction.add (this, app.user_name);
+			}
+		});
 	}
 
 	/**
@@ -1000,49 +1171,264 @@ public class Hook : Object {
 	 */
 	public void
 	sync (string? user_name = null) throws Error
+	{
+		sync_packages (user_name, null);
+	}
+
+	/**
+	 * sync_only:
+	 * @user_name: (allow-none): A user name, or null.
+	 * @packages: (array length=n_packages): Package names.
+	 *
+	 * Like sync, but only consider @packages: links for other packages
+	 * are left alone, and the hook's commands are only run if anything
+	 * changed.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	sync_only (string? user_name, string[] packages) throws Error
+	{
+		var only = new Gee.HashSet<string> ();
+		foreach (var package in packages)
+			only.add (package);
+		sync_packages (user_name, only);
+	}
+
+	/**
+	 * sync_packages:
+	 * @user_name: (allow-none): A user name, or null.
+	 * @only: (allow-none): If not null, only consider these packages.
+	 * @scan: (allow-none): A #PackageScan to use for a system-level
+	 * hook, or null.
+	 *
+	 * Like sync, but if @only is not null then links for other
+	 * packages are left alone, and the hook's commands are only run if
+	 * anything changed.
+	 */
+	internal void
+	sync_packages (string? user_name, Gee.Set<string>? only,
+		       PackageScan? scan = null) throws Error
 	{
 		if (! is_user_level)
 			assert (user_name == null);
 
 		var seen = new Gee.HashSet<string> ();
-		foreach (var app in get_relevant_apps (user_name)) {
-			unowned string package = app.package;
-			unowned string version = app.version;
-			unowned string app_name = app.app_name;
-
-			seen.add (@"$(package)_$(app_name)_$(version)");
-			if (is_user_level) {
-				var user_db = new User.for_user
-					(db, user_name);
-				var overlay_path = Path.build_filename
-					(user_db.get_overlay_db (),
-					 package);
-				user_db.drop_privileges ();
-				try {
-					if (exists (overlay_path))
+		var changed = false;
+		/* Handle all the registrations in one dropped session, rather
+		 * than switching privileges for every app.
+		 */
+		User? user_db = null;
+		try {
+			foreach (var app in get_relevant_apps
+					(user_name, only, scan)) {
+				unowned string package = app.package;
+				unowned string version = app.version;
+				unowned string app_name = app.app_name;
+
+				seen.add (@"$(package)_$(app_name)_$(version)");
+				if (is_user_level) {
+					if (user_db == null) {
+						var new_user_db = new User.for_user
+							(db, user_name);
+						new_user_db.begin_dropped_session ();
+						user_db = new_user_db;
+					}
+					var overlay_path = Path.build_filename
+						(user_db.get_overlay_db (),
+						 package);
+					/* Only touch the registration if
+					 * it needs refreshing, so that
+					 * run_user_hooks_full can tell
+					 * that nothing has changed.
+					 */
+					if (exists (overlay_path) &&
+					    FileUtils.read_link
+						(overlay_path) !=
+					    db.get_path (package, version))
 						user_db.raw_set_version
 							(package, version);
-					install_link (package, version,
-						      app_name,
-						      app.relative_path,
-						      app.user_name, user_db);
-				} finally {
-					user_db.regain_privileges ();
-				}
-			} else
-				install_link (package, version, app_name,
-					      app.relative_path);
+					if (install_link (package, version,
+							  app_name,
+							  app.relative_path,
+							  app.user_name,
+							  user_db))
+						changed = true;
+				} else if (install_link (package, version,
+							 app_name,
+							 app.relative_path))
+					changed = true;
+			}
+		} finally {
+			if (user_db != null)
+				user_db.end_dropped_session ();
 		}
 
 		foreach (var prev in get_previous_entries (user_name)) {
 			unowned string package = prev.package;
 			unowned string version = prev.version;
 			unowned string app_name = prev.app_name;
-			if (! (@"$(package)_$(app_name)_$(version)" in seen))
+			if (only != null && ! (package in only))
+				continue;
+			if (! (@"$(package)_$(app_name)_$(version)" in seen)) {
 				unlink_force (prev.path);
+				changed = true;
+			}
 		}
 
-		run_commands (user_name);
+		if (only == null || changed)
+			run_commands (user_name);
+	}
+}
+
+/* The hook files in the hooks directory, parsed once and indexed by
+ * Hook-Name and by level, rather than parsed again for every (app, hook)
+ * pair in a manifest.  Everything is parsed again if the hooks directory
+ * or its modification time changes; hook files are installed by renaming
+ * them into place, which changes the directory's modification time.
+ *
+ * Only the parsed fields are kept, since a #Hook holds a reference to the
+ * #DB that owns this registry.
+ */
+internal class HookRegistry : Object {
+	private string? dir;
+	private int64 mtime;
+	private int64 load_time;
+
+	/* Hook name → fields, in name order. */
+	private Gee.TreeMap<string, Gee.Map<string, string>> hooks;
+	/* Hook-Name → hook names, in name order. */
+	private Gee.HashMap<string, Gee.List<string>> by_hook_name;
+	private Gee.List<string> user_level;
+	private Gee.List<string> system_level;
+
+	/* The number of times the hooks directory has been parsed. */
+	public uint loads;
+
+	public
+	HookRegistry ()
+	{
+		dir = null;
+		mtime = INDEX_UNTRUSTED;
+		load_time = 0;
+		hooks = new Gee.TreeMap<string, Gee.Map<string, string>> ();
+		by_hook_name = new Gee.HashMap<string, Gee.List<string>> ();
+		user_level = new Gee.ArrayList<string> ();
+		system_level = new Gee.ArrayList<string> ();
+		loads = 0;
+	}
+
+	private void
+	refresh () throws FileError
+	{
+		var current_dir = get_hooks_dir ();
+		var current_mtime = get_mtime (current_dir);
+		/* As with ManifestCache, a directory modified in the same
+		 * second that we read it might have been modified again since
+		 * without its mtime changing, so don't trust it.
+		 */
+		if (current_dir == dir && current_mtime == mtime &&
+		    mtime < load_time)
+			return;
+
+		var new_load_time = get_real_time () / 1000000;
+		var new_hooks = new Gee.TreeMap<string, Gee.Map<string, string>> ();
+		var new_by_hook_name =
+			new Gee.HashMap<string, Gee.List<string>> ();
+		var new_user_level = new Gee.ArrayList<string> ();
+		var new_system_level = new Gee.ArrayList<string> ();
+		foreach (var entry in DirStream.open (current_dir, true)) {
+			if (! entry.name.has_suffix (".hook"))
+				continue;
+			var name = entry.name[0:-5];
+			Gee.Map<string, string> fields;
+			try {
+				fields = parse_deb822_file (entry.path);
+			} catch (Error e) {
+				continue;
+			}
+			new_hooks[name] = fields;
+			var hook_name = fields["hook-name"] ?? name;
+			if (! new_by_hook_name.has_key (hook_name))
+				new_by_hook_name[hook_name] =
+					new Gee.ArrayList<string> ();
+			new_by_hook_name[hook_name].add (name);
+			if (fields["user-level"] == "yes")
+				new_user_level.add (name);
+			else
+				new_system_level.add (name);
+		}
+
+		dir = current_dir;
+		mtime = current_mtime;
+		load_time = new_load_time;
+		hooks = new_hooks;
+		by_hook_name = new_by_hook_name;
+		user_level = new_user_level;
+		system_level = new_system_level;
+		++loads;
+	}
+
+	private List<Hook>
+	make_hooks (DB db, Gee.Iterable<string> names)
+	{
+		var ret = new List<Hook> ();
+		foreach (var name in names)
+			ret.prepend (Hook.from_fields (db, name, hooks[name]));
+		ret.reverse ();
+		return ret;
+	}
+
+	/**
+	 * open:
+	 * @db: The #DB that owns this registry.
+	 * @name: The name of a hook.
+	 *
+	 * Returns: The hook called @name, or null if there is no such hook.
+	 */
+	public Hook?
+	open (DB db, string name) throws FileError
+	{
+		refresh ();
+		if (! hooks.has_key (name))
+			return null;
+		return Hook.from_fields (db, name, hooks[name]);
+	}
+
+	/**
+	 * open_all:
+	 * @db: The #DB that owns this registry.
+	 * @hook_name: (allow-none): A string to match against Hook-Name
+	 * fields, or null.
+	 *
+	 * Returns: The hooks whose Hook-Name fields equal @hook_name, or all
+	 * hooks if @hook_name is null, in name order.
+	 */
+	public List<Hook>
+	open_all (DB db, string? hook_name) throws FileError
+	{
+		refresh ();
+		if (hook_name == null)
+			return make_hooks (db, hooks.keys);
+		if (! by_hook_name.has_key (hook_name))
+			return new List<Hook> ();
+		return make_hooks (db, by_hook_name[hook_name]);
+	}
+
+	/**
+	 * open_level:
+	 * @db: The #DB that owns this registry.
+	 * @user_level: True for user-level hooks, false for system-level
+	 * hooks.
+	 *
+	 * Returns: The hooks at the given level, in name order.
+	 */
+	public List<Hook>
+	open_level (DB db, bool user_level) throws FileError
+	{
+		refresh ();
+		return make_hooks
+			(db, user_level ? this.user_level : system_level);
 	}
 }
 
@@ -1051,11 +1437,10 @@ get_user_home (string? user_name)
 {
 	if (user_name == null)
 		return null;
-	/* TODO: caching */
-	unowned Posix.Passwd? pw = Posix.getpwnam (user_name);
+	var pw = lookup_passwd (user_name);
 	if (pw == null)
 		return null;
-	return pw.pw_dir;
+	return pw.dir;
 }
 
 private Gee.TreeSet<AppHook>
@@ -1070,6 +1455,148 @@ get_app_hooks (Json.Object manifest)
 	return items;
 }
 
+/* A hook whose commands have been put off until the end of a batch. */
+private class PendingCommand : Object {
+	public Hook hook;
+	public string? user_name;
+
+	public
+	PendingCommand (Hook hook, string? user_name)
+	{
+		this.hook = hook;
+		this.user_name = user_name;
+	}
+}
+
+internal delegate void HookTransactionFunc (HookTransaction transaction)
+	throws Error;
+
+/* A set of hook link changes whose commands are run together, so that
+ * each hook's commands run once for a whole batch of packages and
+ * applications rather than once per link.
+ *
+ * While a transaction is in progress on a #DB, installing or removing
+ * packages' hooks in that #DB joins it.
+ */
+public class HookTransaction : Object {
+	public DB db { get; construct; }
+
+	/* Keyed by hook name and then user name, so that commands run in
+	 * hook name order.
+	 */
+	private Gee.TreeMap<string, PendingCommand> pending;
+	private uint depth;
+
+	private
+	HookTransaction (DB db)
+	{
+		Object (db: db);
+	}
+
+	construct {
+		pending = new Gee.TreeMap<string, PendingCommand> ();
+		depth = 0;
+	}
+
+	/**
+	 * HookTransaction.begin:
+	 * @db: A #Click.DB.
+	 *
+	 * Begin a transaction on @db, or join the one already in progress.
+	 * Until the outermost transaction is committed, hook links are
+	 * changed straight away, but hooks' commands are put off.
+	 *
+	 * Returns: (transfer full): The transaction in progress on @db.
+	 *
+	 * Since: 0.5.3
+	 */
+	public static HookTransaction
+	begin (DB db)
+	{
+		var transaction = db.hook_transaction;
+		if (transaction == null) {
+			transaction = new HookTransaction (db);
+			db.hook_transaction = transaction;
+		}
+		++transaction.depth;
+		return transaction;
+	}
+
+	internal void
+	add (Hook hook, string? user_name)
+	{
+		var key = @"$(hook.name)\n$(user_name ?? "")";
+		if (! pending.has_key (key))
+			pending[key] = new PendingCommand (hook, user_name);
+	}
+
+	/**
+	 * commit:
+	 *
+	 * End this transaction.  If it is the outermost one, run the
+	 * commands of each hook whose links changed during the transaction
+	 * once, in hook name order, carrying on past failures, and then
+	 * process those hooks' pending triggers.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	commit () throws Error
+	{
+		return_if_fail (depth > 0);
+		if (--depth > 0)
+			return;
+		if (db.hook_transaction == this)
+			db.hook_transaction = null;
+
+		string[] failed = {};
+		var triggers = new Gee.ArrayList<string> ();
+		foreach (var command in pending.values) {
+			try {
+				command.hook.run_commands (command.user_name);
+			} catch (HooksError e) {
+				warning ("Hook %s failed: %s",
+					 command.hook.name, e.message);
+				failed += command.hook.name;
+			}
+			if (command.hook.is_trigger)
+				triggers.add (get_trigger_name
+					(command.hook, command.user_name));
+		}
+		pending.clear ();
+		run_triggers (db, triggers);
+		if (failed.length != 0)
+			throw new HooksError.INCOMPLETE
+				("Some hooks failed: %s",
+				 string.joinv (", ", failed));
+	}
+
+	/**
+	 * run:
+	 * @db: A #Click.DB.
+	 * @func: A function that changes hook links.
+	 *
+	 * Call @func in a transaction on @db, and commit it.  If @func
+	 * fails, links may already have changed, so the transaction is still
+	 * committed, but the error from @func is the one reported.
+	 */
+	internal static void
+	run (DB db, HookTransactionFunc func) throws Error
+	{
+		var transaction = begin (db);
+		try {
+			func (transaction);
+		} catch (Error e) {
+			try {
+				transaction.commit ();
+			} catch (Error commit_error) {
+			}
+			throw e;
+		}
+		transaction.commit ();
+	}
+}
+
 /**
  * package_install_hooks:
  * @db: A #Click.DB.
@@ -1087,6 +1614,24 @@ public void
 package_install_hooks (DB db, string package, string? old_version,
 		       string new_version, string? user_name = null)
 	throws Error
+{
+	HookTransaction.run (db, (transaction) => {
+		package_install_hooks_queued (db, package, old_version,
+					      new_version, user_name,
+					      transaction);
+	});
+}
+
+/**
+ * package_install_hooks_queued:
+ * @transaction: The transaction in which to run hook commands.
+ *
+ * Like package_install_hooks.
+ */
+internal void
+package_install_hooks_queued (DB db, string package, string? old_version,
+			      string new_version, string? user_name,
+			      HookTransaction transaction) throws Error
 {
 	var old_manifest = read_manifest_hooks (db, package, old_version);
 	var new_manifest = read_manifest_hooks (db, package, new_version);
@@ -1104,8 +1649,10 @@ package_install_hooks (DB db, string package, string? old_version,
 				continue;
 			if (! hook.is_single_version)
 				continue;
-			hook.remove_package (package, old_version,
-					     app_hook.app_name, user_name);
+			hook.remove_package_links
+				(package, old_version, app_hook.app_name,
+				 user_name);
+			transaction.add (hook, user_name);
 		}
 	}
 
@@ -1121,9 +1668,10 @@ package_install_hooks (DB db, string package, string? old_version,
 			foreach (var hook in Hook.open_all (db, hook_name)) {
 				if (hook.is_user_level != (user_name != null))
 					continue;
-				hook.install_package (package, new_version,
-						      app_name, relative_path,
-						      user_name);
+				hook.install_package_links
+					(package, new_version, app_name,
+					 relative_path, user_name);
+				transaction.add (hook, user_name);
 			}
 		}
 	}
@@ -1144,6 +1692,23 @@ package_install_hooks (DB db, string package, string? old_version,
 public void
 package_remove_hooks (DB db, string package, string old_version,
 		      string? user_name = null) throws Error
+{
+	HookTransaction.run (db, (transaction) => {
+		package_remove_hooks_queued (db, package, old_version,
+					     user_name, transaction);
+	});
+}
+
+/**
+ * package_remove_hooks_queued:
+ * @transaction: The transaction in which to run hook commands.
+ *
+ * Like package_remove_hooks.
+ */
+internal void
+package_remove_hooks_queued (DB db, string package, string old_version,
+			     string? user_name, HookTransaction transaction)
+	throws Error
 {
 	var old_manifest = read_manifest_hooks (db, package, old_version);
 
@@ -1151,12 +1716,115 @@ package_remove_hooks (DB db, string package, string old_version,
 		foreach (var hook in Hook.open_all (db, app_hook.hook_name)) {
 			if (hook.is_user_level != (user_name != null))
 				continue;
-			hook.remove_package (package, old_version,
-					     app_hook.app_name, user_name);
+			hook.remove_package_links
+				(package, old_version, app_hook.app_name,
+				 user_name);
+			transaction.add (hook, user_name);
 		}
 	}
 }
 
+/**
+ * get_journal_packages:
+ * @db: A #Click.DB.
+ * @checkpoint_path: Where the caller keeps its checkpoint.
+ * @user_name: (allow-none): A user name, or null for system-level hooks.
+ * @next: (out): The checkpoint to save after a successful run.
+ *
+ * Returns: The packages that hook synchronisation needs to consider, or
+ * null if it must consider all packages.  For user-level hooks, changes
+ * to other users' registrations are ignored.
+ */
+private Gee.Set<string>?
+get_journal_packages (DB db, string checkpoint_path, string? user_name,
+		      out JournalCheckpoint? next)
+{
+	var entries = read_journal_since_checkpoint
+		(db, checkpoint_path, true, out next);
+	if (entries == null)
+		return null;
+	var ret = new Gee.HashSet<string> ();
+	foreach (var entry in entries) {
+		if (user_name != null && entry.user_name != null &&
+		    entry.user_name != user_name &&
+		    entry.user_name != ALL_USERS)
+			continue;
+		ret.add (entry.package);
+	}
+	return ret;
+}
+
+/**
+ * get_system_hooks_generations:
+ * @db: A #Click.DB.
+ * @journal_stamp: The result of get_journal_stamp.
+ *
+ * Returns: A map from each phase of run_system_hooks to a generation
+ * stamp covering everything that phase depends on.
+ */
+private Gee.Map<string, string>
+get_system_hooks_generations (DB db, string journal_stamp)
+{
+	var now = get_real_time () / 1000000;
+	var overlay = new StringBuilder ();
+	append_signature_mtime (overlay, db.overlay, now);
+	var clickpkg = "-";
+	var pw = lookup_passwd ("clickpkg");
+	if (pw != null)
+		clickpkg = "%u %u".printf ((uint) pw.uid, (uint) pw.gid);
+
+	var ret = new Gee.HashMap<string, string> ();
+	ret["gc"] = Checksum.compute_for_string
+		(ChecksumType.SHA1, journal_stamp + overlay.str +
+		 journal_signature (db, false));
+	ret["ownership"] = Checksum.compute_for_string
+		(ChecksumType.SHA1,
+		 @"$journal_stamp$(overlay.str)clickpkg $clickpkg\n");
+	ret["hooks"] = Checksum.compute_for_string
+		(ChecksumType.SHA1, journal_stamp + overlay.str +
+		 journal_signature (db, true));
+	return ret;
+}
+
+private Gee.Map<string, string>
+load_generations (string path)
+{
+	var ret = new Gee.HashMap<string, string> ();
+	string contents;
+	try {
+		FileUtils.get_contents (path, out contents);
+	} catch (FileError e) {
+		return ret;
+	}
+	foreach (var line in contents.split ("\n")) {
+		var fields = line.split (" ");
+		if (fields.length == 2)
+			ret[fields[0]] = fields[1];
+	}
+	return ret;
+}
+
+private void
+save_generations (Gee.Map<string, string> generations, string path)
+{
+	var builder = new StringBuilder ();
+	foreach (var entry in generations.entries)
+		builder.append (@"$(entry.key) $(entry.value)\n");
+	try {
+		ensuredir (Path.get_dirname (path));
+		FileUtils.set_contents (path, builder.str);
+	} catch (FileError e) {
+		warning ("Cannot save %s: %s", path, e.message);
+	}
+}
+
+private string
+format_phase_time (int64 start)
+{
+	return "%.3fs".printf
+		((double) (get_monotonic_time () - start) / 1000000);
+}
+
 /**
  * run_system_hooks:
  * @db: A #Click.DB.
@@ -1166,17 +1834,119 @@ package_remove_hooks (DB db, string package, string old_version,
  * This is useful when starting up from images with preinstalled packages
  * which may not have had their system-level hooks run properly when
  * building the image.  It is suitable for running at system startup.
+ *
+ * This is equivalent to run_system_hooks_full with @force set to false
+ * and @jobs set to 1.
  */
 public void
 run_system_hooks (DB db) throws Error
 {
-	db.gc ();
-	db.ensure_ownership ();
+	run_system_hooks_full (db, false, 1);
+}
+
+/**
+ * run_system_hooks_full:
+ * @db: A #Click.DB.
+ * @force: If true, run every phase in full even if nothing seems to have
+ * changed.
+ * @jobs: The number of system-level hooks to run at once.
+ *
+ * Run system-level hooks for all installed packages, after garbage
+ * collection and fixing the ownership of the overlay database, and then
+ * process any pending system-level triggers.
+ *
+ * Unless @force is true, each of these three phases is skipped if
+ * nothing that it depends on has changed since it last succeeded, and
+ * system-level hooks only consider the packages that the overlay
+ * database's journal shows have changed, if possible.  The phases share
+ * a single scan of the database, and the time each one took is logged.
+ *
+ * Hooks run in name order, except that a hook is always run after the
+ * hooks named in its After field.  If @jobs is greater than 1, up to that
+ * many hooks whose After hooks have finished are run at once, each in
+ * its own child process.
+ *
+ * Since: 0.5.3
+ */
+public void
+run_system_hooks_full (DB db, bool force, uint jobs) throws Error
+{
+	var checkpoint_path = Path.build_filename
+		(db.overlay, ".click", "checkpoints", "system-hooks");
+	var generation_path = @"$checkpoint_path.generation";
+	var generations = get_system_hooks_generations
+		(db, get_journal_stamp (db));
+	var last_good = load_generations (generation_path);
+	PackageScan? scan = null;
+	var gc_time = "skipped";
+	var ownership_time = "skipped";
+	var hooks_time = "skipped";
+
+	try {
+		if (force || last_good["gc"] != generations["gc"]) {
+			var start = get_monotonic_time ();
+			scan = new PackageScan (db);
+			db.gc_scanned (scan);
+			last_good["gc"] = generations["gc"];
+			gc_time = format_phase_time (start);
+		}
+
+		if (force ||
+		    last_good["ownership"] != generations["ownership"]) {
+			var start = get_monotonic_time ();
+			uint visited, changed;
+			db.ensure_ownership_full
+				(0, out visited, out changed);
+			if (changed > 0)
+				message ("Changed ownership of %u of %u " +
+					 "files in %s",
+					 changed, visited, db.overlay);
+			last_good["ownership"] = generations["ownership"];
+			ownership_time = format_phase_time (start);
+		}
+
+		if (force || last_good["hooks"] != generations["hooks"]) {
+			var start = get_monotonic_time ();
+			run_system_hooks_phase
+				(db, checkpoint_path, force, scan, jobs);
+			last_good["hooks"] = generations["hooks"];
+			hooks_time = format_phase_time (start);
+		}
+	} finally {
+		save_generations (last_good, generation_path);
+		var start = get_monotonic_time ();
+		run_triggers (db, get_pending_triggers (db, null));
+		message ("System hooks: gc %s, ownership %s, hooks %s, " +
+			 "triggers %s",
+			 gc_time, ownership_time, hooks_time,
+			 format_phase_time (start));
+	}
+}
+
+private void
+run_system_hooks_phase (DB db, string checkpoint_path, bool force,
+			PackageScan? scan, uint jobs) throws Error
+{
+	JournalCheckpoint? next;
+	var only = get_journal_packages
+		(db, checkpoint_path, null, out next);
+	if (force)
+		only = null;
+	if (only != null && only.is_empty) {
+		/* Nothing has changed. */
+		save_journal_checkpoint (next, checkpoint_path);
+		return;
+	}
+	var hooks = order_hooks (db.hook_registry.open_level (db, false));
 	string[] failed = {};
-	foreach (var hook in Hook.open_all (db)) {
-		if (! hook.is_user_level) {
+	if (jobs > 1)
+		failed = sync_hooks_in_parallel (db, hooks, only, jobs);
+	else {
+		if (scan == null)
+			scan = new PackageScan (db);
+		foreach (var hook in hooks) {
 			try {
-				hook.sync ();
+				hook.sync_packages (null, only, scan);
 			} catch (HooksError e) {
 				warning ("System-level hook %s failed: %s",
 					 hook.name, e.message);
@@ -1188,6 +1958,225 @@ run_system_hooks (DB db) throws Error
 		throw new HooksError.INCOMPLETE
 			("Some system-level hooks failed: %s",
 			 string.joinv (", ", failed));
+	save_journal_checkpoint (next, checkpoint_path);
+}
+
+/**
+ * order_hooks:
+ * @hooks: Hooks, in name order.
+ *
+ * Returns: @hooks, in name order except that each hook comes after the
+ * hooks named in its After field.  Hooks that are not in @hooks are
+ * ignored, and if the After fields form a cycle, it is broken at the
+ * first hook in name order.
+ */
+private Gee.List<Hook>
+order_hooks (List<Hook> hooks)
+{
+	var waiting = new Gee.ArrayList<Hook> ();
+	var names = new Gee.HashSet<string> ();
+	foreach (var hook in hooks) {
+		waiting.add (hook);
+		names.add (hook.name);
+	}
+	var ret = new Gee.ArrayList<Hook> ();
+	var done = new Gee.HashSet<string> ();
+	while (! waiting.is_empty) {
+		var next = 0;
+		for (var i = 0; i < waiting.size; ++i) {
+			var ready = true;
+			foreach (var name in waiting[i].get_after ()) {
+				if (name in names && ! (name in done)) {
+					ready = false;
+					break;
+				}
+			}
+			if (ready) {
+				next = i;
+				break;
+			}
+			if (i == waiting.size - 1)
+				warning ("Hook %s is part of a cycle of " +
+					 "After fields; running it anyway",
+					 waiting[0].name);
+		}
+		var hook = waiting.remove_at (next);
+		ret.add (hook);
+		done.add (hook.name);
+	}
+	return ret;
+}
+
+/**
+ * sync_hooks_in_parallel:
+ * @db: A #Click.DB.
+ * @hooks: System-level hooks, as ordered by order_hooks.
+ * @only: (allow-none): As for Hook.sync_packages.
+ * @jobs: The maximum number of hooks to run at once.
+ *
+ * Sync each of @hooks by running "click hook sync" for it, running up to
+ * @jobs of them at once.  Each hook waits for any hooks named in its
+ * After field that come before it in @hooks.
+ *
+ * The helpers are spawned rather than forked from this process, since
+ * earlier phases may have started threads (see DB.ensure_ownership_full),
+ * and a forked child of a threaded process may only do async-signal-safe
+ * work before it execs.
+ *
+ * Returns: The names of the hooks that failed.
+ */
+private string[]
+sync_hooks_in_parallel (DB db, Gee.List<Hook> hooks, Gee.Set<string>? only,
+			uint jobs)
+{
+	string[] common_args = {};
+	foreach (var single_db in db)
+		common_args += @"--db=$(single_db.root)";
+	if (only != null) {
+		foreach (var package in only)
+			common_args += @"--package=$package";
+	}
+
+	var position = new Gee.HashMap<string, int> ();
+	for (var i = 0; i < hooks.size; ++i)
+		position[hooks[i].name] = i;
+	var waiting = new Gee.ArrayList<Hook> ();
+	waiting.add_all (hooks);
+	var running = new Gee.HashMap<int, Hook> ();
+	var done = new Gee.HashSet<string> ();
+	string[] failed = {};
+
+	while (! waiting.is_empty || ! running.is_empty) {
+		var i = 0;
+		while (i < waiting.size && running.size < jobs) {
+			var hook = waiting[i];
+			var ready = true;
+			foreach (var name in hook.get_after ()) {
+				/* A later After hook only happens if
+				 * order_hooks broke a cycle.
+				 */
+				if (position.has_key (name) &&
+				    position[name] < position[hook.name] &&
+				    ! (name in done)) {
+					ready = false;
+					break;
+				}
+			}
+			if (! ready) {
+				++i;
+				continue;
+			}
+			waiting.remove_at (i);
+			string[] argv = {"click", "hook", "sync", hook.name};
+			foreach (var arg in common_args)
+				argv += arg;
+			Pid pid;
+			try {
+				Process.spawn_async
+					(null, argv, null,
+					 SpawnFlags.SEARCH_PATH |
+					 SpawnFlags.DO_NOT_REAP_CHILD,
+					 null, out pid);
+			} catch (SpawnError e) {
+				warning ("Cannot run hook %s: %s",
+					 hook.name, e.message);
+				failed += hook.name;
+				done.add (hook.name);
+				continue;
+			}
+			running[(int) pid] = hook;
+		}
+		/* Since the first waiting hook's After hooks all come
+		 * before it, something is running unless we are done.
+		 */
+		if (running.is_empty)
+			continue;
+
+		int status;
+		var pid = Posix.waitpid (-1, out status, 0);
+		if (pid < 0) {
+			if (errno == Posix.EINTR)
+				continue;
+			warning ("Cannot wait for hooks: %s",
+				 strerror (errno));
+			foreach (var hook in running.values)
+				failed += hook.name;
+			foreach (var hook in waiting)
+				failed += hook.name;
+			break;
+		}
+		Hook? hook;
+		if (! running.unset ((int) pid, out hook))
+			continue;
+		Process.close_pid ((Pid) pid);
+		done.add (hook.name);
+		try {
+			Process.check_exit_status (status);
+		} catch (Error e) {
+			warning ("System-level hook %s failed", hook.name);
+			failed += hook.name;
+		}
+	}
+	return failed;
+}
+
+/**
+ * get_journal_stamp:
+ * @db: A #Click.DB.
+ *
+ * Returns: A line that changes whenever anything is appended to @db's
+ * journal.
+ */
+private string
+get_journal_stamp (DB db)
+{
+	var path = new Journal (db.overlay).path;
+	Posix.Stat st;
+	if (Posix.stat (path, out st) < 0)
+		return "journal -\n";
+	/* See append_signature_mtime. */
+	if ((int64) st.st_mtime >= get_real_time () / 1000000)
+		return "journal %08x\n".printf (Random.next_int ());
+	return "journal %s %s %s\n".printf
+		(((uint64) st.st_ino).to_string (),
+		 ((int64) st.st_size).to_string (),
+		 ((int64) st.st_mtime).to_string ());
+}
+
+/**
+ * get_user_hooks_generation:
+ * @db: A #Click.DB.
+ * @user_name: A user name.
+ * @journal_stamp: The result of get_journal_stamp.
+ *
+ * Returns: A generation stamp covering everything that user-level hook
+ * synchronisation for @user_name depends on: the database layers, the
+ * user's registrations and those for all users, and the hook and
+ * framework directories.  Only directories are examined, which is
+ * enough because all of these are changed by renaming files into place.
+ */
+private string
+get_user_hooks_generation (DB db, string user_name, string journal_stamp)
+{
+	var now = get_real_time () / 1000000;
+	var builder = new StringBuilder (journal_stamp);
+	for (var i = 0; i < db.size; ++i) {
+		string root;
+		try {
+			root = db.get (i).root;
+		} catch (DatabaseError e) {
+			continue;
+		}
+		append_signature_mtime (builder, root, now);
+		append_signature_mtime (builder, db_top (root), now);
+		append_signature_mtime
+			(builder, db_for_user (root, user_name), now);
+		append_signature_mtime
+			(builder, db_for_user (root, ALL_USERS), now);
+	}
+	append_signature_mtime (builder, get_hooks_dir (), now);
+	append_signature_mtime (builder, get_frameworks_dir (), now);
+	return builder.str;
 }
 
 /**
@@ -1201,28 +2190,151 @@ run_system_hooks (DB db) throws Error
  * This is useful to catch up with packages that may have been preinstalled
  * and registered for all users.  It is suitable for running at session
  * startup.
+ *
+ * This is equivalent to run_user_hooks_full with @force set to false.
  */
 public void
 run_user_hooks (DB db, string? user_name = null) throws Error
+{
+	run_user_hooks_full (db, user_name, false);
+}
+
+/**
+ * run_user_hooks_full:
+ * @db: A #Click.DB.
+ * @user_name: (allow-none): A user name, or null to run hooks for the
+ * current user.
+ * @force: If true, consider all packages even if nothing seems to have
+ * changed.
+ *
+ * Run user-level hooks for all installed packages.
+ *
+ * Unless @force is true, this returns immediately if nothing that the
+ * hooks depend on has changed since the last successful run for this
+ * user.  Otherwise, as with run_system_hooks, only packages that the
+ * journal shows have changed are considered, if possible.  In either
+ * case, any pending triggers of user-level hooks for this user are then
+ * processed.
+ *
+ * Since: 0.5.3
+ */
+public void
+run_user_hooks_full (DB db, string? user_name, bool force) throws Error
 {
 	if (user_name == null)
 		user_name = Environment.get_user_name ();
+	try {
+		sync_user_hooks (db, user_name, force);
+	} finally {
+		run_triggers (db, get_pending_triggers (db, user_name));
+	}
+}
+
+/**
+ * run_user_hooks_for_packages:
+ * @db: A #Click.DB.
+ * @user_name: (allow-none): A user name, or null to run hooks for the
+ * current user.
+ * @packages: (array length=n_packages): Package names.
+ *
+ * Bring user-level hooks up to date with the registrations of @packages
+ * only, leaving links for other packages alone, and then process any
+ * pending triggers of user-level hooks for this user.  This is used to
+ * catch up logged-in users after a change to the registrations for all
+ * users.
+ *
+ * Since: 0.5.3
+ */
+public void
+run_user_hooks_for_packages (DB db, string? user_name, string[] packages)
+	throws Error
+{
+	if (user_name == null)
+		user_name = Environment.get_user_name ();
+	var only = new Gee.HashSet<string> ();
+	foreach (var package in packages)
+		only.add (package);
 	string[] failed = {};
-	foreach (var hook in Hook.open_all (db)) {
-		if (hook.is_user_level) {
+	try {
+		foreach (var hook in db.hook_registry.open_level (db, true)) {
 			try {
-				hook.sync (user_name);
+				hook.sync_packages (user_name, only);
 			} catch (HooksError e) {
 				warning ("User-level hook %s failed: %s",
 					 hook.name, e.message);
 				failed += hook.name;
 			}
 		}
+	} finally {
+		run_triggers (db, get_pending_triggers (db, user_name));
+	}
+	if (failed.length != 0)
+		throw new HooksError.INCOMPLETE
+			("Some user-level hooks failed: %s",
+			 string.joinv (", ", failed));
+}
+
+private void
+sync_user_hooks (DB db, string user_name, bool force) throws Error
+{
+	var checkpoint_path = Path.build_filename
+		(Environment.get_user_cache_dir (), ".click", "checkpoints",
+		 @"user-hooks-$user_name");
+	var generation_path = @"$checkpoint_path.generation";
+	/* Take the generation before we start, so that anything changed
+	 * while we are running is noticed next time.
+	 */
+	var generation = get_user_hooks_generation
+		(db, user_name, get_journal_stamp (db));
+	if (! force) {
+		string old_generation;
+		try {
+			FileUtils.get_contents
+				(generation_path, out old_generation);
+			if (old_generation == generation)
+				return;
+		} catch (FileError e) {
+		}
+	}
+
+	JournalCheckpoint? next;
+	var only = get_journal_packages
+		(db, checkpoint_path, user_name, out next);
+	if (force)
+		only = null;
+	if (only != null && only.is_empty) {
+		/* Nothing has changed. */
+		save_journal_checkpoint (next, checkpoint_path);
+		save_user_hooks_generation (generation, generation_path);
+		return;
+	}
+	string[] failed = {};
+	foreach (var hook in db.hook_registry.open_level (db, true)) {
+		try {
+			hook.sync_packages (user_name, only);
+		} catch (HooksError e) {
+			warning ("User-level hook %s failed: %s",
+				 hook.name, e.message);
+			failed += hook.name;
+		}
 	}
 	if (failed.length != 0)
 		throw new HooksError.INCOMPLETE
 			("Some user-level hooks failed: %s",
 			 string.joinv (", ", failed));
+	save_journal_checkpoint (next, checkpoint_path);
+	save_user_hooks_generation (generation, generation_path);
+}
+
+private void
+save_user_hooks_generation (string generation, string path)
+{
+	try {
+		ensuredir (Path.get_dirname (path));
+		FileUtils.set_contents (path, generation);
+	} catch (FileError e) {
+		warning ("Cannot save %s: %s", path, e.message);
+	}
 }
 
 }
@@ -0,0 +1,292 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Persistent index of the packages unpacked in a single database.
+ *
+ * Scanning a database means opening the root directory, then each package
+ * directory, and then stat-ing each version, which adds up quickly on
+ * systems with many installed versions.  Instead, we keep a small text file
+ * in <root>/.click/index recording each package, its versions, where its
+ * "current" link points, and the modification time of each manifest.
+ *
+ * The index is validated using directory modification times: adding,
+ * removing, or renaming a package changes the mtime of the root directory,
+ * while adding or removing a version or changing the "current" link
+ * changes the mtime of the package directory.  Only those parts of the
+ * tree that have changed are rescanned.  As in git's "racily clean"
+ * handling, a directory whose mtime is not strictly older than the time
+ * we scanned it is never trusted, since it may change again within the
+ * same second without its mtime visibly changing.
+ *
+ * The index is purely a cache.  If it is missing, unreadable, or cannot be
+ * written (for example, because the caller lacks permission), we fall
+ * back to scanning the file system.
+ */
+
+namespace Click {
+
+private const string INDEX_MAGIC = "click-index 1";
+
+/* An mtime value meaning "unknown; always rescan". */
+private const int64 INDEX_UNTRUSTED = -1;
+
+private int64
+get_mtime (string path)
+{
+	Posix.Stat st;
+	if (Posix.stat (path, out st) < 0)
+		return INDEX_UNTRUSTED;
+	return (int64) st.st_mtime;
+}
+
+private class IndexedVersion : Object {
+	public string version;
+	public bool is_current;
+	public int64 manifest_mtime;
+
+	public
+	IndexedVersion (string version, bool is_current, int64 manifest_mtime)
+	{
+		this.version = version;
+		this.is_current = is_current;
+		this.manifest_mtime = manifest_mtime;
+	}
+}
+
+private class IndexedPackage : Object {
+	public string name;
+	public int64 mtime;
+	public string? current;
+	public Gee.TreeMap<string, IndexedVersion> versions;
+
+	public
+	IndexedPackage (string name)
+	{
+		this.name = name;
+		this.mtime = INDEX_UNTRUSTED;
+		this.current = null;
+		this.versions = new Gee.TreeMap<string, IndexedVersion> ();
+	}
+}
+
+private class PackageIndex : Object {
+	public string root { get; construct; }
+	public bool persistent { get; construct; }
+
+	private bool loaded;
+	private int64 root_mtime;
+	private Gee.TreeMap<string, IndexedPackage> packages;
+
+	public
+	PackageIndex (string root, bool persistent)
+	{
+		Object (root: root, persistent: persistent);
+		loaded = false;
+		root_mtime = INDEX_UNTRUSTED;
+		packages = new Gee.TreeMap<string, IndexedPackage> ();
+	}
+
+	private string
+	get_index_path ()
+	{
+		return Path.build_filename (root, ".click", "index");
+	}
+
+	private void
+	reset ()
+	{
+		root_mtime = INDEX_UNTRUSTED;
+		packages.clear ();
+	}
+
+	/**
+	 * load:
+	 *
+	 * Read the on-disk index, if any.  Anything we do not understand
+	 * causes the whole index to be discarded and rebuilt.
+	 */
+	private void
+	load ()
+	{
+		string contents;
+		try {
+			FileUtils.get_contents (get_index_path (), out contents);
+		} catch (FileError e) {
+			return;
+		}
+
+		var lines = contents.split ("\n");
+		if (lines.length < 2 || lines[0] != INDEX_MAGIC)
+			return;
+		IndexedPackage? pkg = null;
+		for (int i = 1; i < lines.length; ++i) {
+			unowned string line = lines[i];
+			if (line == "")
+				continue;
+			var fields = line.split ("\t");
+			if (fields[0] == "R" && fields.length == 2)
+				root_mtime = int64.parse (fields[1]);
+			else if (fields[0] == "P" && fields.length == 4) {
+				pkg = new IndexedPackage (fields[1]);
+				pkg.mtime = int64.parse (fields[2]);
+				if (fields[3] != "")
+					pkg.current = fields[3];
+				packages[pkg.name] = pkg;
+			} else if (fields[0] == "V" && fields.length == 4 &&
+				   pkg != null) {
+				pkg.versions[fields[1]] = new IndexedVersion
+					(fields[1], fields[2] == "1",
+					 int64.parse (fields[3]));
+			} else {
+				reset ();
+				return;
+			}
+		}
+	}
+
+	private void
+	save ()
+	{
+		var click_dir = Path.build_filename (root, ".click");
+		if (! is_dir (click_dir))
+			return;
+
+		var builder = new StringBuilder (INDEX_MAGIC);
+		builder.append_c ('\n');
+		builder.append (@"R\t$root_mtime\n");
+		foreach (var pkg in packages.values) {
+			var current = pkg.current ?? "";
+			builder.append (@"P\t$(pkg.name)\t$(pkg.mtime)\t$current\n");
+			foreach (var version in pkg.versions.values) {
+				var is_current = version.is_current ? "1" : "0";
+				builder.append
+					(@"V\t$(version.version)\t$is_current\t" +
+					 @"$(version.manifest_mtime)\n");
+			}
+		}
+		try {
+			FileUtils.set_contents (get_index_path (), builder.str);
+		} catch (FileError e) {
+			/* Most likely we do not have permission to write to
+			 * this database; carry on with the in-memory copy.
+			 */
+		}
+	}
+
+	private static int64
+	trusted_mtime (int64 mtime, int64 scan_time)
+	{
+		return mtime >= scan_time ? INDEX_UNTRUSTED : mtime;
+	}
+
+	private void
+	rescan_package (IndexedPackage pkg, int64 mtime, int64 scan_time)
+		throws Error
+	{
+		var package_path = Path.build_filename (root, pkg.name);
+		pkg.versions.clear ();
+		pkg.current = null;
+		pkg.mtime = trusted_mtime (mtime, scan_time);
+
+		var current_path = Path.build_filename (package_path, "current");
+		try {
+			pkg.current = FileUtils.read_link (current_path);
+		} catch (FileError e) {
+			/* Missing or not a symlink. */
+		}
+
+		foreach (var entry in DirStream.open (package_path)) {
+			if (entry.file_type != FileType.DIRECTORY)
+				continue;
+			var manifest_path = Path.build_filename
+				(entry.path, ".click", "info",
+				 @"$(pkg.name).manifest");
+			pkg.versions[entry.name] = new IndexedVersion
+				(entry.name, entry.name == pkg.current,
+				 get_mtime (manifest_path));
+		}
+	}
+
+	/**
+	 * refresh:
+	 *
+	 * Bring the index up to date with the file system, rescanning only
+	 * those directories whose modification times have changed.
+	 */
+	public void
+	refresh () throws Error
+	{
+		var dirty = false;
+		if (! loaded) {
+			if (persistent)
+				load ();
+			loaded = true;
+		}
+
+		var scan_time = get_real_time () / 1000000;
+		var new_root_mtime = get_mtime (root);
+		if (new_root_mtime == INDEX_UNTRUSTED ||
+		    new_root_mtime != root_mtime) {
+			var names = new Gee.HashSet<string> ();
+			foreach (var entry in DirStream.open (root)) {
+				if (entry.name == ".click" || ! entry.is_dir ())
+					continue;
+				names.add (entry.name);
+				if (! packages.has_key (entry.name))
+					packages[entry.name] = new IndexedPackage
+						(entry.name);
+			}
+			var stale_it = packages.map_iterator ();
+			while (stale_it.next ()) {
+				if (! (stale_it.get_key () in names))
+					stale_it.unset ();
+			}
+			root_mtime = trusted_mtime (new_root_mtime, scan_time);
+			dirty = true;
+		}
+
+		var it = packages.map_iterator ();
+		while (it.next ()) {
+			var pkg = it.get_value ();
+			var mtime = get_mtime (Path.build_filename
+				(root, pkg.name));
+			if (mtime == INDEX_UNTRUSTED) {
+				it.unset ();
+				dirty = true;
+			} else if (pkg.mtime == INDEX_UNTRUSTED ||
+				   mtime != pkg.mtime) {
+				rescan_package (pkg, mtime, scan_time);
+				dirty = true;
+			}
+		}
+
+		if (dirty && persistent && new_root_mtime != INDEX_UNTRUSTED)
+			save ();
+	}
+
+	/**
+	 * get_packages:
+	 *
+	 * Returns: The indexed packages, sorted by name.  Call refresh
+	 * first to make sure that these are up to date.
+	 */
+	public Gee.Collection<IndexedPackage>
+	get_packages ()
+	{
+		return packages.values;
+	}
+}
+
+}
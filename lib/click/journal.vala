@@ -0,0 +1,410 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* A journal of changes to the overlay database.
+ *
+ * Every registration, unregistration, unpack, and removal of a package
+ * version in the overlay database appends a line to
+ * <overlay>/.click/journal:
+ *
+ *   <seq> <op> <user or -> <package> <version or ->
+ *
+ * The first line of the file is a header naming a random epoch, and <seq>
+ * is the byte offset at which the entry starts.  gc and hook
+ * synchronisation save a checkpoint (epoch, seq) when they finish, and
+ * next time only look at the packages named by entries after it.
+ *
+ * A checkpoint is only trusted if the journal still has the same epoch
+ * and is at least as long as it was, and if nothing the journal does not
+ * cover has changed: the database layers below the overlay, which a
+ * system image update may replace wholesale, the set of users whose
+ * registrations count, which shrinks when a user is deleted, and the hook
+ * and framework directories.  Otherwise callers fall back to a full scan.  The journal
+ * starts again with a new epoch when it grows too large, which costs one
+ * full scan.
+ *
+ * Since a checkpoint lets gc and hook synchronisation skip work, only
+ * root and clickpkg may write to the journal, and readers ignore a
+ * journal that anyone else could have written.  Registrations are
+ * journalled after privileges have been regained.  A user changing their
+ * own registrations without privileges cannot append to the journal, so
+ * they touch a marker file in their registration directory instead;
+ * journal_signature covers these markers, so every checkpoint then falls
+ * back to a full scan.
+ */
+
+namespace Click {
+
+private const string JOURNAL_MAGIC = "click-journal 1";
+private const int64 JOURNAL_MAX_SIZE = 1024 * 1024;
+
+private const string JOURNAL_REGISTER = "register";
+private const string JOURNAL_UNREGISTER = "unregister";
+private const string JOURNAL_UNPACK = "unpack";
+private const string JOURNAL_REMOVE = "remove";
+/* A package version that gc had to keep because it was running. */
+private const string JOURNAL_RETRY = "retry";
+
+/* Touched in a registration directory by a change that could not be
+ * journalled.
+ */
+private const string UNJOURNALLED_MARKER = ".unjournalled";
+
+internal class JournalEntry : Object {
+	public uint64 seq;
+	public string op;
+	public string? user_name;
+	public string package;
+	public string? version;
+
+	public
+	JournalEntry (uint64 seq, string op, string? user_name,
+		      string package, string? version)
+	{
+		this.seq = seq;
+		this.op = op;
+		this.user_name = user_name;
+		this.package = package;
+		this.version = version;
+	}
+}
+
+internal class JournalCheckpoint : Object {
+	public string epoch;
+	public uint64 seq;
+	/* See journal_signature. */
+	public string signature;
+
+	public
+	JournalCheckpoint (string epoch, uint64 seq, string signature)
+	{
+		this.epoch = epoch;
+		this.seq = seq;
+		this.signature = signature;
+	}
+
+	public static JournalCheckpoint?
+	load (string path)
+	{
+		string contents;
+		try {
+			FileUtils.get_contents (path, out contents);
+		} catch (FileError e) {
+			return null;
+		}
+		var fields = contents.strip ().split (" ");
+		if (fields.length != 3)
+			return null;
+		return new JournalCheckpoint
+			(fields[0], uint64.parse (fields[1]), fields[2]);
+	}
+
+	public void
+	save (string path) throws FileError
+	{
+		ensuredir (Path.get_dirname (path));
+		FileUtils.set_contents (path, @"$epoch $seq $signature\n");
+	}
+}
+
+internal class Journal : Object {
+	public string path;
+
+	public
+	Journal (string root)
+	{
+		path = Path.build_filename (root, ".click", "journal");
+	}
+
+	/**
+	 * is_trusted:
+	 * @st: The result of stat on the journal.
+	 *
+	 * Returns: True if the journal can only have been written by root,
+	 * clickpkg, or the current user.
+	 */
+	private static bool
+	is_trusted (Posix.Stat st)
+	{
+		return Posix.S_ISREG (st.st_mode) &&
+			(st.st_mode & (Posix.S_IWGRP | Posix.S_IWOTH)) == 0 &&
+			is_trusted_uid (st.st_uid);
+	}
+
+	/**
+	 * append:
+	 * @op: One of the JOURNAL_* operations.
+	 * @user_name: (allow-none): The user whose registration changed.
+	 * @package: A package name.
+	 * @version: (allow-none): A version string.
+	 *
+	 * Append an entry to the journal.  Only root and clickpkg can do
+	 * this.  If the entry cannot be written, we can only warn about it.
+	 *
+	 * Returns: True if readers will take the change into account, or
+	 * false if the caller must mark it as unjournalled.
+	 */
+	public bool
+	append (string op, string? user_name, string package,
+		string? version)
+	{
+		var fd = Posix.open (path,
+				     Posix.O_WRONLY | Posix.O_APPEND |
+				     Posix.O_CREAT | PosixExtra.O_NOFOLLOW |
+				     PosixExtra.O_CLOEXEC,
+				     0644);
+		if (fd < 0) {
+			/* No .click directory yet; readers will see that
+			 * there is no journal.
+			 */
+			if (errno == Posix.ENOENT)
+				return true;
+			if (errno != Posix.EACCES)
+				warning ("Cannot open %s: %s",
+					 path, strerror (errno));
+			return false;
+		}
+		try {
+			PosixExtra.flock (fd, PosixExtra.LOCK_EX);
+			Posix.Stat st;
+			if (Posix.fstat (fd, out st) < 0)
+				return false;
+			var size = (int64) st.st_size;
+			/* Start again with a journal that nobody else can
+			 * write to if we can.
+			 */
+			var trusted = is_trusted (st);
+			if (! trusted && Posix.geteuid () == 0)
+				size = -1;
+			if (size <= 0 || size > JOURNAL_MAX_SIZE) {
+				if (size != 0 && Posix.ftruncate (fd, 0) < 0)
+					return false;
+				if (Posix.geteuid () == 0) {
+					var pw = lookup_passwd ("clickpkg");
+					if (pw != null)
+						Posix.fchown
+							(fd, pw.uid, pw.gid);
+				}
+				Posix.fchmod (fd, 0644);
+				trusted = true;
+				var epoch = "%08x%08x".printf
+					(Random.next_int (), Random.next_int ());
+				var header = @"$JOURNAL_MAGIC $epoch\n";
+				write_all (fd, header);
+				size = header.length;
+			}
+			write_all (fd, "%s %s %s %s %s\n".printf
+				(size.to_string (), op, user_name ?? "-",
+				 package, version ?? "-"));
+			return trusted;
+		} catch (FileError e) {
+			warning ("Cannot append to %s: %s", path, e.message);
+			return false;
+		} finally {
+			/* This also releases the lock. */
+			Posix.close (fd);
+		}
+	}
+
+	/**
+	 * read_since:
+	 * @checkpoint: (allow-none): A checkpoint saved earlier, or null.
+	 * @epoch: (out): The current epoch of the journal, or null if there
+	 * is no valid journal.
+	 * @end: (out): The sequence number just past the last complete
+	 * entry.
+	 *
+	 * Returns: The entries after @checkpoint, or null if they cannot be
+	 * determined and the caller must do a full scan.
+	 */
+	public Gee.List<JournalEntry>?
+	read_since (JournalCheckpoint? checkpoint, out string? epoch,
+		    out uint64 end)
+	{
+		epoch = null;
+		end = 0;
+		Posix.Stat st;
+		if (Posix.lstat (path, out st) < 0 || ! is_trusted (st))
+			return null;
+		string contents;
+		try {
+			FileUtils.get_contents (path, out contents);
+		} catch (FileError e) {
+			return null;
+		}
+		var header_end = contents.index_of_char ('\n');
+		if (header_end < 0 ||
+		    ! contents.has_prefix (JOURNAL_MAGIC + " "))
+			return null;
+		epoch = contents.substring
+			(JOURNAL_MAGIC.length + 1,
+			 header_end - JOURNAL_MAGIC.length - 1);
+		/* Ignore a partly-written last entry. */
+		var last = contents.last_index_of_char ('\n');
+		end = (uint64) (last + 1);
+
+		if (checkpoint == null || checkpoint.epoch != epoch ||
+		    checkpoint.seq <= (uint64) header_end || checkpoint.seq > end ||
+		    contents[(long) checkpoint.seq - 1] != '\n')
+			return null;
+
+		var entries = new Gee.ArrayList<JournalEntry> ();
+		var pos = (int) checkpoint.seq;
+		while (pos <= last) {
+			var eol = contents.index_of_char ('\n', pos);
+			var fields = contents.substring (pos, eol - pos)
+				.split (" ");
+			if (fields.length == 5)
+				entries.add (new JournalEntry
+					(uint64.parse (fields[0]), fields[1],
+					 fields[2] == "-" ? null : fields[2],
+					 fields[3],
+					 fields[4] == "-" ? null : fields[4]));
+			pos = eol + 1;
+		}
+		return entries;
+	}
+}
+
+private void
+append_signature_mtime (StringBuilder builder, string path, int64 now)
+{
+	var mtime = get_mtime (path);
+	/* As with PackageIndex, a directory modified at or after the time
+	 * we look at it may change again without its mtime changing, so
+	 * make sure that the signature will never match.
+	 */
+	if (mtime >= now)
+		builder.append ("%08x".printf (Random.next_int ()));
+	builder.append (@"$path $mtime\n");
+}
+
+/**
+ * journal_signature:
+ * @db: A #DB.
+ * @hooks: True if hook synchronisation depends on this signature.
+ *
+ * Returns: A digest of the state not covered by the journal of @db's
+ * overlay: the package and registration directories of the layers below
+ * the overlay, the markers of unjournalled registration changes in the
+ * overlay, the users whose registrations count, and, if @hooks is true,
+ * the hook and framework files.
+ */
+private string
+journal_signature (DB db, bool hooks)
+{
+	var now = get_real_time () / 1000000;
+	var builder = new StringBuilder ();
+	for (var i = 0; i < db.size - 1; ++i) {
+		string root;
+		try {
+			root = db.get (i).root;
+		} catch (DatabaseError e) {
+			continue;
+		}
+		foreach (var dir in new string[] { root, db_top (root) }) {
+			append_signature_mtime (builder, dir, now);
+			try {
+				foreach (var entry in DirStream.open (dir, true)) {
+					if (entry.is_dir ())
+						append_signature_mtime
+							(builder, entry.path,
+							 now);
+				}
+			} catch (FileError e) {
+			}
+		}
+	}
+	try {
+		foreach (var entry in DirStream.open
+				(db_top (db.overlay), true)) {
+			var marker = Path.build_filename
+				(entry.path, UNJOURNALLED_MARKER);
+			if (entry.is_dir () && exists (marker))
+				append_signature_mtime (builder, marker, now);
+		}
+	} catch (FileError e) {
+	}
+	/* Registrations of users who no longer exist are ignored without
+	 * any journal entry.
+	 */
+	try {
+		builder.append ("users");
+		foreach (var user_name in new Users (db).get_user_names ())
+			builder.append (@" $user_name");
+		builder.append ("\n");
+	} catch (Error e) {
+		builder.append (" -\n");
+	}
+	if (hooks) {
+		/* Hooks only apply to packages whose framework is still
+		 * available.
+		 */
+		foreach (var dir in new string[] {
+				get_hooks_dir (), get_frameworks_dir () }) {
+			append_signature_mtime (builder, dir, now);
+			try {
+				foreach (var entry in DirStream.open (dir, true))
+					append_signature_mtime
+						(builder, entry.path, now);
+			} catch (FileError e) {
+			}
+		}
+	}
+	return Checksum.compute_for_string (ChecksumType.SHA1, builder.str);
+}
+
+/**
+ * read_journal_since_checkpoint:
+ * @db: A #DB.
+ * @checkpoint_path: Where the caller keeps its checkpoint.
+ * @hooks: As for journal_signature.
+ * @next: (out): The checkpoint to save once the caller has finished, or
+ * null if there is no journal to checkpoint against.
+ *
+ * Returns: The journal entries since the caller's last checkpoint, or
+ * null if the caller must do a full scan.
+ */
+private Gee.List<JournalEntry>?
+read_journal_since_checkpoint (DB db, string checkpoint_path, bool hooks,
+			       out JournalCheckpoint? next)
+{
+	next = null;
+	var signature = journal_signature (db, hooks);
+	var checkpoint = JournalCheckpoint.load (checkpoint_path);
+	if (checkpoint != null && checkpoint.signature != signature)
+		checkpoint = null;
+	string? epoch;
+	uint64 end;
+	var entries = new Journal (db.overlay).read_since
+		(checkpoint, out epoch, out end);
+	if (epoch != null)
+		next = new JournalCheckpoint (epoch, end, signature);
+	return entries;
+}
+
+private void
+save_journal_checkpoint (JournalCheckpoint? checkpoint, string path)
+{
+	if (checkpoint == null)
+		return;
+	try {
+		checkpoint.save (path);
+	} catch (FileError e) {
+		warning ("Cannot save checkpoint %s: %s", path, e.message);
+	}
+}
+
+}
@@ -0,0 +1,139 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Finding the layers of a database that contain a package.
+ *
+ * DB.get_path and DB.get_manifest need the first layer in which a given
+ * version of a package is unpacked.  Rather than probing each layer in
+ * turn and using exceptions to move on to the next one, each #DB keeps an
+ * in-memory map from package names to the layers containing them and the
+ * versions unpacked in each.
+ *
+ * Entries are validated using the modification time of the package's
+ * directory in each layer, which changes whenever a version is added or
+ * removed.  (The mtime of a layer's root directory only changes when a
+ * whole package comes or goes, so it is not enough on its own.)  A lookup
+ * therefore costs one stat per layer, and the set of versions is only
+ * read again when it has changed.  As with PackageIndex, a directory
+ * modified at or after the time we read it is never trusted.
+ */
+
+namespace Click {
+
+/* The versions of one package unpacked in one layer of a #DB. */
+internal class PackageLayer : Object {
+	public int layer;
+	public string root;
+	public int64 mtime;
+	public Gee.Set<string> versions;
+
+	public
+	PackageLayer (int layer, string root)
+	{
+		this.layer = layer;
+		this.root = root;
+		mtime = INDEX_UNTRUSTED;
+		versions = new Gee.HashSet<string> ();
+	}
+
+	public void
+	scan (string package_path, int64 mtime)
+	{
+		var scan_time = get_real_time () / 1000000;
+		versions.clear ();
+		this.mtime = INDEX_UNTRUSTED;
+		try {
+			foreach (var entry in DirStream.open (package_path)) {
+				/* Match exists: dangling links do not count. */
+				if (entry.is_symlink () && ! exists (entry.path))
+					continue;
+				versions.add (entry.name);
+			}
+		} catch (FileError e) {
+			return;
+		}
+		if (mtime < scan_time)
+			this.mtime = mtime;
+	}
+}
+
+internal class PackageLocator : Object {
+	private Gee.List<SingleDB> layers;
+	private Gee.HashMap<string, Gee.ArrayList<PackageLayer>> packages;
+
+	public
+	PackageLocator (Gee.List<SingleDB> layers)
+	{
+		this.layers = layers;
+		packages = new Gee.HashMap<string, Gee.ArrayList<PackageLayer>> ();
+	}
+
+	/**
+	 * find_layers:
+	 * @package: A package name.
+	 *
+	 * Returns: The layers that contain @package, in database order, each
+	 * with the set of versions of @package unpacked there.
+	 */
+	public Gee.List<PackageLayer>
+	find_layers (string package)
+	{
+		var entries = packages[package];
+		if (entries == null) {
+			entries = new Gee.ArrayList<PackageLayer> ();
+			packages[package] = entries;
+		}
+		/* Layers may have been added since we last looked. */
+		while (entries.size < layers.size)
+			entries.add (new PackageLayer
+				(entries.size, layers[entries.size].root));
+
+		var ret = new Gee.ArrayList<PackageLayer> ();
+		foreach (var entry in entries) {
+			var package_path = Path.build_filename
+				(entry.root, package);
+			var mtime = get_mtime (package_path);
+			if (mtime == INDEX_UNTRUSTED) {
+				entry.versions.clear ();
+				entry.mtime = INDEX_UNTRUSTED;
+				continue;
+			}
+			if (entry.mtime == INDEX_UNTRUSTED || entry.mtime != mtime)
+				entry.scan (package_path, mtime);
+			ret.add (entry);
+		}
+		return ret;
+	}
+
+	/**
+	 * find:
+	 * @package: A package name.
+	 * @version: A version string.
+	 *
+	 * Returns: The first layer in which @version of @package is
+	 * unpacked, or null if there is none.
+	 */
+	public PackageLayer?
+	find (string package, string version)
+	{
+		foreach (var entry in find_layers (package)) {
+			if (version in entry.versions)
+				return entry;
+		}
+		return null;
+	}
+}
+
+}
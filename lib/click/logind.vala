@@ -0,0 +1,161 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Finding the users who are currently logged in.
+ *
+ * Registering a package for all users runs user-level hooks for each user
+ * who is logged in at the time.  We ask logind for the list of users, and
+ * then AccountsService whether each of them is a system account.  The
+ * AccountsService queries are made concurrently on a private main
+ * context, and the result is kept for a few seconds so that a batch of
+ * registrations does not ask again for every package.
+ *
+ * Both services are found on the system bus, so tests may substitute fake
+ * ones by pointing DBUS_SYSTEM_BUS_ADDRESS at a private bus.
+ */
+
+namespace Click {
+
+	struct LogindUser {
+		uint32 uid;
+		string name;
+		string ObjectPath;
+	}
+
+	/* the logind dbus interface */
+	[DBus (name = "org.freedesktop.login1.Manager")]
+	interface LogindManager : Object {
+		public abstract async LogindUser[] ListUsers () throws IOError;
+	}
+
+	[DBus (name = "org.freedesktop.Accounts.User")]
+	interface ASUser : Object {
+		public abstract bool system_account { get; }
+	}
+
+private const uint LOGGED_IN_USERS_CACHE_TTL = 5;
+
+private Mutex logged_in_users_mutex;
+private string[]? logged_in_users = null;
+private int64 logged_in_users_expires = 0;
+
+private async bool
+is_system_account (uint32 uid) throws IOError
+{
+	ASUser as_user = yield Bus.get_proxy
+		(BusType.SYSTEM, "org.freedesktop.Accounts",
+		 @"/org/freedesktop/Accounts/User$(uid)");
+	return as_user.system_account;
+}
+
+private async string[]
+discover_logged_in_users () throws IOError
+{
+	LogindManager logind = yield Bus.get_proxy
+		(BusType.SYSTEM, "org.freedesktop.login1",
+		 "/org/freedesktop/login1");
+	var users = yield logind.ListUsers ();
+
+	/* Ask about all the users at once, and wait for every answer. */
+	var system_users = new Gee.HashSet<string> ();
+	var pending = users.length;
+	foreach (var user in users) {
+		var name = user.name;
+		is_system_account.begin (user.uid, (obj, res) => {
+			try {
+				if (is_system_account.end (res))
+					system_users.add (name);
+			} catch (IOError e) {
+				warning ("Cannot query AccountsService for %s: %s",
+					 name, e.message);
+			}
+			if (--pending == 0)
+				discover_logged_in_users.callback ();
+		});
+	}
+	if (pending > 0)
+		yield;
+
+	string[] ret = {};
+	foreach (var user in users) {
+		if (! (user.name in system_users))
+			ret += user.name;
+	}
+	return ret;
+}
+
+/**
+ * get_logged_in_users:
+ *
+ * Returns: The names of the non-system users who are currently logged
+ * in, as reported by logind and AccountsService.
+ */
+private string[]
+get_logged_in_users ()
+{
+	var now = get_monotonic_time ();
+	logged_in_users_mutex.lock ();
+	if (logged_in_users != null && logged_in_users_expires > now) {
+		var cached = logged_in_users;
+		logged_in_users_mutex.unlock ();
+		return cached;
+	}
+	logged_in_users_mutex.unlock ();
+
+	var context = new MainContext ();
+	var loop = new MainLoop (context);
+	string[] ret = {};
+	var ok = false;
+	context.push_thread_default ();
+	discover_logged_in_users.begin ((obj, res) => {
+		try {
+			ret = discover_logged_in_users.end (res);
+			ok = true;
+		} catch (IOError e) {
+			warning (@"Can not connect to logind or AccountsService: $(e.message)");
+		}
+		loop.quit ();
+	});
+	loop.run ();
+	context.pop_thread_default ();
+
+	/* Failures are not cached, so that we try again next time. */
+	if (ok) {
+		logged_in_users_mutex.lock ();
+		logged_in_users = ret;
+		logged_in_users_expires =
+			now + (int64) LOGGED_IN_USERS_CACHE_TTL * 1000000;
+		logged_in_users_mutex.unlock ();
+	}
+	return ret;
+}
+
+/**
+ * invalidate_logged_in_users_cache:
+ *
+ * Forget the cached list of logged-in users, for example after a user
+ * logs in.
+ *
+ * Since: 0.5.3
+ */
+public void
+invalidate_logged_in_users_cache ()
+{
+	logged_in_users_mutex.lock ();
+	logged_in_users = null;
+	logged_in_users_mutex.unlock ();
+}
+
+}
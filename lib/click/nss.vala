@@ -0,0 +1,191 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Cached password and group database lookups.
+ *
+ * Listing users, expanding hook patterns, and dropping privileges all
+ * need password file entries, often for the same few users over and over
+ * again.  With a network-backed name service each lookup may be slow, so
+ * we keep a process-wide cache of the results, including negative ones.
+ * Entries expire after a short time, and the cache can be cleared
+ * explicitly when the caller knows that the databases have changed.
+ */
+
+namespace Click {
+
+private class CachedPasswd : Object {
+	public string name;
+	public Posix.uid_t uid;
+	public Posix.gid_t gid;
+	public string? dir;
+	/* Supplementary groups, looked up on demand. */
+	public Posix.gid_t[]? groups;
+
+	public
+	CachedPasswd (string name, Posix.uid_t uid, Posix.gid_t gid,
+		      string? dir)
+	{
+		this.name = name;
+		this.uid = uid;
+		this.gid = gid;
+		this.dir = dir;
+		this.groups = null;
+	}
+}
+
+private class NssCacheEntry : Object {
+	/* Null if there is no such user. */
+	public CachedPasswd? pw;
+	/* The value of errno after a failed lookup. */
+	public int error;
+	public int64 expires;
+
+	public
+	NssCacheEntry (CachedPasswd? pw, int error, int64 expires)
+	{
+		this.pw = pw;
+		this.error = error;
+		this.expires = expires;
+	}
+}
+
+private const uint NSS_CACHE_DEFAULT_TTL = 60;
+
+private Mutex nss_cache_mutex;
+private Gee.HashMap<string, NssCacheEntry>? nss_cache = null;
+private uint nss_cache_ttl = NSS_CACHE_DEFAULT_TTL;
+
+private NssCacheEntry
+nss_cache_lookup (string name)
+{
+	var now = get_monotonic_time ();
+	nss_cache_mutex.lock ();
+	if (nss_cache == null)
+		nss_cache = new Gee.HashMap<string, NssCacheEntry> ();
+	var entry = nss_cache[name];
+	if (entry == null || entry.expires <= now) {
+		errno = 0;
+		unowned Posix.Passwd? pw = Posix.getpwnam (name);
+		CachedPasswd? cached = null;
+		if (pw != null)
+			cached = new CachedPasswd
+				(name, pw.pw_uid, pw.pw_gid, pw.pw_dir);
+		entry = new NssCacheEntry
+			(cached, errno, now + (int64) nss_cache_ttl * 1000000);
+		if (nss_cache_ttl > 0)
+			nss_cache[name] = entry;
+	}
+	nss_cache_mutex.unlock ();
+	return entry;
+}
+
+/**
+ * lookup_passwd:
+ * @name: A user name.
+ *
+ * Returns: The cached password file entry for @name, or null if there is
+ * no such user, in which case errno is set as getpwnam left it.
+ */
+private CachedPasswd?
+lookup_passwd (string name)
+{
+	var entry = nss_cache_lookup (name);
+	errno = entry.error;
+	return entry.pw;
+}
+
+/**
+ * get_supplementary_groups:
+ * @pw: A cached password file entry.
+ *
+ * Returns: The groups of which @pw is listed as a member in the group
+ * database.
+ */
+private Posix.gid_t[]
+get_supplementary_groups (CachedPasswd pw)
+{
+	nss_cache_mutex.lock ();
+	if (pw.groups == null) {
+		Posix.gid_t[] groups = {};
+		Posix.setgrent ();
+		unowned PosixExtra.Group? gr;
+		while ((gr = PosixExtra.getgrent ()) != null) {
+			foreach (unowned string member in gr.gr_mem) {
+				if (member == pw.name) {
+					groups += gr.gr_gid;
+					break;
+				}
+			}
+		}
+		Posix.endgrent ();
+		pw.groups = groups;
+	}
+	var ret = pw.groups;
+	nss_cache_mutex.unlock ();
+	return ret;
+}
+
+/**
+ * is_trusted_uid:
+ * @uid: The owner of a file in the overlay database.
+ *
+ * Returns: True if @uid is root, clickpkg, or the current effective
+ * user, whose files we can rely on not to have been tampered with.
+ */
+private bool
+is_trusted_uid (Posix.uid_t uid)
+{
+	if (uid == 0 || uid == Posix.geteuid ())
+		return true;
+	var pw = lookup_passwd ("clickpkg");
+	return pw != null && uid == pw.uid;
+}
+
+/**
+ * invalidate_nss_cache:
+ *
+ * Forget all cached password and group database lookups, for example
+ * after adding or removing users.
+ *
+ * Since: 0.5.3
+ */
+public void
+invalidate_nss_cache ()
+{
+	nss_cache_mutex.lock ();
+	nss_cache = null;
+	nss_cache_mutex.unlock ();
+}
+
+/**
+ * set_nss_cache_ttl:
+ * @seconds: How long to keep password and group database lookups, or 0
+ * to disable caching.
+ *
+ * Set how long cached password and group database lookups remain valid.
+ * This also clears the cache.
+ *
+ * Since: 0.5.3
+ */
+public void
+set_nss_cache_ttl (uint seconds)
+{
+	nss_cache_mutex.lock ();
+	nss_cache_ttl = seconds;
+	nss_cache = null;
+	nss_cache_mutex.unlock ();
+}
+
+}
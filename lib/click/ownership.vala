@@ -0,0 +1,244 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Fixing the ownership of files in a database.
+ *
+ * After an upgrade that changes the clickpkg UID, every file in the
+ * overlay database needs to be handed over to the new UID, and there may
+ * be a great many of them.  We therefore work relative to directory file
+ * descriptors rather than re-resolving full paths, take entry types from
+ * readdir rather than stat-ing each entry, and only change the ownership
+ * of entries that are not already owned correctly.  Each top-level package
+ * may optionally be handled by a separate worker thread.
+ */
+
+namespace Click {
+
+private class OwnershipJob : Object {
+	public string name;
+	public string path;
+
+	public
+	OwnershipJob (string name, string path)
+	{
+		this.name = name;
+		this.path = path;
+	}
+}
+
+private class OwnershipWalker : Object {
+	private Posix.uid_t uid;
+	private Posix.gid_t gid;
+
+	/* These are updated atomically, since packages may be walked in
+	 * parallel.
+	 */
+	public int visited;
+	public int changed;
+
+	private Mutex error_mutex;
+	private Error? error;
+
+	public
+	OwnershipWalker (Posix.uid_t uid, Posix.gid_t gid)
+	{
+		this.uid = uid;
+		this.gid = gid;
+		visited = 0;
+		changed = 0;
+		error_mutex = Mutex ();
+		error = null;
+	}
+
+	/**
+	 * fix:
+	 * @dirfd: A file descriptor for the directory containing @name.
+	 * @name: The name of an entry, relative to @dirfd.
+	 * @path: The full path to the entry, for use in error messages.
+	 *
+	 * Give @name to clickpkg, unless it already belongs to clickpkg.
+	 * As with chown, symbolic links are followed.
+	 */
+	private void
+	fix (int dirfd, string name, string path) throws DatabaseError
+	{
+		AtomicInt.inc (ref visited);
+		Posix.Stat st;
+		if (PosixExtra.fstatat (dirfd, name, out st, 0) == 0) {
+			if (st.st_uid == uid && st.st_gid == gid)
+				return;
+		} else if (errno == Posix.ENOENT)
+			return;
+		if (PosixExtra.fchownat (dirfd, name, uid, gid, 0) < 0)
+			throw new DatabaseError.ENSURE_OWNERSHIP
+				("Cannot set ownership of %s: %s",
+				 path, strerror (errno));
+		AtomicInt.inc (ref changed);
+	}
+
+	private Posix.Dir
+	open_dir (int dirfd, string name, string path) throws DatabaseError
+	{
+		var fd = PosixExtra.openat
+			(dirfd, name,
+			 Posix.O_RDONLY | PosixExtra.O_DIRECTORY |
+			 PosixExtra.O_NOFOLLOW | PosixExtra.O_CLOEXEC);
+		if (fd < 0)
+			throw new DatabaseError.ENSURE_OWNERSHIP
+				("Cannot open %s: %s", path, strerror (errno));
+		var dir = PosixExtra.fdopendir (fd);
+		if (dir == null) {
+			var saved_errno = errno;
+			Posix.close (fd);
+			throw new DatabaseError.ENSURE_OWNERSHIP
+				("Cannot open %s: %s",
+				 path, strerror (saved_errno));
+		}
+		return dir;
+	}
+
+	/**
+	 * get_entry_type:
+	 * @dirfd: A file descriptor for the directory containing @entry.
+	 * @entry: A directory entry.
+	 *
+	 * Returns: The type of @entry, falling back to lstat if the file
+	 * system does not report it.
+	 */
+	private static uchar
+	get_entry_type (int dirfd, Posix.DirEnt entry)
+	{
+		if (entry.d_type != PosixExtra.DT_UNKNOWN)
+			return entry.d_type;
+		Posix.Stat st;
+		if (PosixExtra.fstatat (dirfd, (string) entry.d_name, out st,
+					PosixExtra.AT_SYMLINK_NOFOLLOW) < 0)
+			return PosixExtra.DT_UNKNOWN;
+		if (Posix.S_ISDIR (st.st_mode))
+			return PosixExtra.DT_DIR;
+		else if (Posix.S_ISLNK (st.st_mode))
+			return PosixExtra.DT_LNK;
+		else
+			return PosixExtra.DT_REG;
+	}
+
+	/**
+	 * walk:
+	 * @dirfd: A file descriptor for the directory containing @name.
+	 * @name: The name of a directory, relative to @dirfd.
+	 * @path: The full path to the directory.
+	 *
+	 * Fix the ownership of a directory and everything beneath it.
+	 * Symbolic links to directories are fixed but not descended into.
+	 */
+	private void
+	walk (int dirfd, string name, string path) throws DatabaseError
+	{
+		fix (dirfd, name, path);
+		var dir = open_dir (dirfd, name, path);
+		var fd = PosixExtra.dirfd (dir);
+		unowned Posix.DirEnt? entry;
+		while ((entry = Posix.readdir (dir)) != null) {
+			var child = (string) entry.d_name;
+			if (child == "." || child == "..")
+				continue;
+			var child_path = Path.build_filename (path, child);
+			if (get_entry_type (fd, entry) == PosixExtra.DT_DIR)
+				walk (fd, child, child_path);
+			else
+				fix (fd, child, child_path);
+		}
+	}
+
+	private void
+	record_error (Error e)
+	{
+		error_mutex.lock ();
+		if (error == null)
+			error = e.copy ();
+		error_mutex.unlock ();
+	}
+
+	private void
+	walk_parallel (int dirfd, Gee.List<OwnershipJob> jobs,
+		       uint max_workers) throws ThreadError
+	{
+		var pool = new ThreadPool<OwnershipJob>.with_owned_data
+			((job) => {
+				try {
+					walk (dirfd, job.name, job.path);
+				} catch (Error e) {
+					record_error (e);
+				}
+			}, (int) max_workers, true);
+		foreach (var job in jobs)
+			pool.add (job);
+		/* Freeing the pool on return waits for all queued jobs to
+		 * finish.
+		 */
+	}
+
+	/**
+	 * run:
+	 * @root: The root directory of a database.
+	 * @max_workers: The maximum number of packages to handle at once,
+	 * or 0 to use one worker per processor.
+	 *
+	 * Fix the ownership of the database root, the top-level database
+	 * metadata, and every package.
+	 */
+	public void
+	run (string root, uint max_workers) throws Error
+	{
+		fix (PosixExtra.AT_FDCWD, root, root);
+		var dir = open_dir (PosixExtra.AT_FDCWD, root, root);
+		var fd = PosixExtra.dirfd (dir);
+
+		var jobs = new Gee.ArrayList<OwnershipJob> ();
+		unowned Posix.DirEnt? entry;
+		while ((entry = Posix.readdir (dir)) != null) {
+			var name = (string) entry.d_name;
+			if (name == "." || name == "..")
+				continue;
+			var path = Path.build_filename (root, name);
+			if (name == ".click") {
+				/* Only the top of the user registration tree
+				 * belongs to clickpkg.
+				 */
+				fix (fd, name, path);
+				fix (fd, ".click/log",
+				     Path.build_filename (path, "log"));
+				fix (fd, ".click/users",
+				     Path.build_filename (path, "users"));
+			} else if (get_entry_type (fd, entry) == PosixExtra.DT_DIR)
+				jobs.add (new OwnershipJob (name, path));
+			else
+				fix (fd, name, path);
+		}
+
+		if (max_workers == 0)
+			max_workers = get_num_processors ();
+		if (max_workers > 1 && jobs.size > 1) {
+			walk_parallel (fd, jobs, max_workers);
+			if (error != null)
+				throw error.copy ();
+		} else {
+			foreach (var job in jobs)
+				walk (fd, job.name, job.path);
+		}
+	}
+}
+
+}
@@ -0,0 +1,221 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Deferred deletion of large directory trees.
+ *
+ * Removing an unpacked package version or a user's cache for a package
+ * can mean deleting a great many files.  Rather than making the caller
+ * wait, we rename the tree into a trash directory on the same file
+ * system, which is atomic and immediate, and leave the real work to a
+ * #TrashReaper run later by gc or by a low-priority service.
+ *
+ * Each tree is moved into its own freshly-created subdirectory of the
+ * trash directory, so that trees with the same name never collide.
+ */
+
+namespace Click {
+
+/**
+ * get_user_cache_trash_dir:
+ *
+ * Returns: The trash directory used when removing the current user's
+ * cached data for packages.
+ *
+ * Since: 0.5.3
+ */
+public string
+get_user_cache_trash_dir ()
+{
+	return Path.build_filename
+		(Environment.get_user_cache_dir (), ".click", "trash");
+}
+
+/**
+ * move_to_trash:
+ * @path: A path to remove.
+ * @trash_dir: The trash directory, which must be on the same file system
+ * as @path.
+ *
+ * Move @path out of the way into @trash_dir, to be deleted later by a
+ * #TrashReaper.
+ *
+ * Returns: True if @path was moved, or false if it could not be, in which
+ * case the caller should delete it directly.
+ */
+private bool
+move_to_trash (string path, string trash_dir)
+{
+	if (! exists (path) && ! is_symlink (path))
+		return false;
+	try {
+		ensuredir (trash_dir);
+	} catch (FileError e) {
+		return false;
+	}
+	var holder = DirUtils.mkdtemp
+		(Path.build_filename (trash_dir, "XXXXXX"));
+	if (holder == null)
+		return false;
+	var target = Path.build_filename (holder, Path.get_basename (path));
+	if (FileUtils.rename (path, target) < 0) {
+		/* Most likely EXDEV, or ENOENT if there was nothing to
+		 * remove.
+		 */
+		DirUtils.remove (holder);
+		return false;
+	}
+	return true;
+}
+
+public class TrashReaper : Object {
+	public string trash_dir { get; construct; }
+
+	/**
+	 * The number of bytes of disk space freed so far.
+	 *
+	 * Since: 0.5.3
+	 */
+	public uint64 bytes_freed { get { return _bytes_freed; } }
+
+	/**
+	 * The number of files and directories deleted so far.
+	 *
+	 * Since: 0.5.3
+	 */
+	public uint64 files_removed { get { return _files_removed; } }
+
+	/* Plain fields, so that deleting each file does not emit notify. */
+	private uint64 _bytes_freed = 0;
+	private uint64 _files_removed = 0;
+
+	/**
+	 * progress:
+	 * @name: The name of the tree in the trash directory that has just
+	 * been deleted.
+	 *
+	 * Emitted after each tree in the trash directory has been deleted.
+	 *
+	 * Since: 0.5.3
+	 */
+	public signal void progress (string name);
+
+	/**
+	 * TrashReaper:
+	 * @trash_dir: A trash directory.
+	 *
+	 * Since: 0.5.3
+	 */
+	public
+	TrashReaper (string trash_dir)
+	{
+		Object (trash_dir: trash_dir);
+	}
+
+	/**
+	 * reap:
+	 *
+	 * Delete everything in the trash directory.  Failures to delete
+	 * individual files are reported as warnings, and the rest of the
+	 * trash is still deleted.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	reap () throws FileError
+	{
+		var fd = PosixExtra.openat
+			(PosixExtra.AT_FDCWD, trash_dir,
+			 Posix.O_RDONLY | PosixExtra.O_DIRECTORY |
+			 PosixExtra.O_CLOEXEC);
+		if (fd < 0) {
+			if (errno == Posix.ENOENT)
+				return;
+			var code = FileUtils.error_from_errno (errno);
+			var quark = Quark.from_string ("g-file-error-quark");
+			var err = new Error (quark, code,
+					     "open %s failed: %s",
+					     trash_dir, strerror (errno));
+			throw (FileError) err;
+		}
+		try {
+			foreach (var name in read_names (fd)) {
+				remove_at (fd, name);
+				progress (name);
+			}
+		} finally {
+			Posix.close (fd);
+		}
+	}
+
+	/* The names in the directory open as @fd, which is left open. */
+	private string[]
+	read_names (int fd)
+	{
+		string[] names = {};
+		var dup_fd = Posix.dup (fd);
+		if (dup_fd < 0)
+			return names;
+		var dir = PosixExtra.fdopendir (dup_fd);
+		if (dir == null) {
+			Posix.close (dup_fd);
+			return names;
+		}
+		unowned Posix.DirEnt? ent;
+		while ((ent = Posix.readdir (dir)) != null) {
+			var name = (string) ent.d_name;
+			if (name != "." && name != "..")
+				names += name;
+		}
+		/* Closing the stream closes dup_fd. */
+		return names;
+	}
+
+	/* Delete @name, relative to @parent_fd, and everything beneath it,
+	 * without following symbolic links.
+	 */
+	private void
+	remove_at (int parent_fd, string name)
+	{
+		Posix.Stat st;
+		if (PosixExtra.fstatat (parent_fd, name, out st,
+					PosixExtra.AT_SYMLINK_NOFOLLOW) < 0)
+			return;
+		var flags = 0;
+		if (Posix.S_ISDIR (st.st_mode)) {
+			var fd = PosixExtra.openat
+				(parent_fd, name,
+				 Posix.O_RDONLY | PosixExtra.O_DIRECTORY |
+				 PosixExtra.O_NOFOLLOW | PosixExtra.O_CLOEXEC);
+			if (fd < 0) {
+				warning ("Cannot open %s in %s: %s",
+					 name, trash_dir, strerror (errno));
+				return;
+			}
+			foreach (var child in read_names (fd))
+				remove_at (fd, child);
+			Posix.close (fd);
+			flags = PosixExtra.AT_REMOVEDIR;
+		}
+		if (PosixExtra.unlinkat (parent_fd, name, flags) < 0) {
+			warning ("Cannot remove %s in %s: %s",
+				 name, trash_dir, strerror (errno));
+			return;
+		}
+		_bytes_freed += (uint64) st.st_blocks * 512;
+		++_files_removed;
+	}
+}
+
+}
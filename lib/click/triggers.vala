@@ -0,0 +1,293 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Pending triggers.
+ *
+ * Rather than running the command of a hook with "Trigger: yes" every
+ * time its links change, we record a pending trigger by creating an empty
+ * file named after the hook.  However many times a trigger is recorded,
+ * its command runs once when pending triggers are processed: at the end
+ * of each HookTransaction, and by run_system_hooks and run_user_hooks.
+ *
+ * Triggers of system-level hooks live in <overlay>/.click/triggers, which
+ * only root (or whoever owns the database) may write to.  Triggers of
+ * user-level hooks live in .triggers in the user's own registration
+ * directory, and are only ever recorded or claimed with that user's
+ * privileges, so that nobody can suppress or force another user's
+ * triggers.  We ignore trigger files and directories that could have
+ * been written by anyone we do not trust.
+ *
+ * A trigger is claimed by deleting its file before running its command,
+ * so a trigger recorded while the command is running stays pending.  A
+ * trigger that cannot be claimed stays pending and is not run.  If the
+ * command fails, the trigger is recorded again so that it will be
+ * retried later; failures never stop the operation that processed them.
+ */
+
+namespace Click {
+
+private string
+get_triggers_dir (DB db, User? user_db)
+{
+	if (user_db == null)
+		return Path.build_filename (db.overlay, ".click", "triggers");
+	return Path.build_filename (user_db.get_overlay_db (), ".triggers");
+}
+
+/* The name by which a pending trigger is known in memory, as returned by
+ * get_pending_triggers.
+ */
+private string
+get_trigger_name (Hook hook, string? user_name)
+{
+	if (user_name == null)
+		return hook.name;
+	return @"$(hook.name)@$user_name";
+}
+
+/**
+ * is_trusted_trigger_path:
+ * @path: A trigger file or directory.
+ * @is_dir: True if @path should be a directory.
+ *
+ * Returns: True if @path is of the expected type and can only have been
+ * written by root, clickpkg, or the current effective user (who is the
+ * owning user when handling user-level triggers).
+ */
+private bool
+is_trusted_trigger_path (string path, bool is_dir)
+{
+	Posix.Stat st;
+	if (Posix.lstat (path, out st) < 0)
+		return false;
+	if (is_dir) {
+		if (! Posix.S_ISDIR (st.st_mode) ||
+		    (st.st_mode & (Posix.S_IWGRP | Posix.S_IWOTH)) != 0)
+			return false;
+	} else if (! Posix.S_ISREG (st.st_mode))
+		return false;
+	return is_trusted_uid (st.st_uid);
+}
+
+/**
+ * open_user_triggers:
+ * @db: A #DB.
+ * @user_name: (allow-none): A user name for user-level triggers, or null.
+ * @create: True if the user's registration directory should be created.
+ *
+ * Drop privileges to those of @user_name, if it is not null, for the
+ * duration of work on its triggers.  The caller must pass the result to
+ * close_user_triggers.
+ *
+ * Returns: (allow-none): A #User to pass to get_triggers_dir, or null
+ * for system-level triggers.
+ */
+private User?
+open_user_triggers (DB db, string? user_name, bool create) throws Error
+{
+	if (user_name == null)
+		return null;
+	var user_db = new User.for_user (db, user_name);
+	if (create)
+		user_db.ensure_db ();
+	user_db.drop_privileges ();
+	return user_db;
+}
+
+private void
+close_user_triggers (User? user_db)
+{
+	if (user_db != null)
+		user_db.regain_privileges ();
+}
+
+/**
+ * record_trigger:
+ * @db: A #DB.
+ * @hook: A hook with "Trigger: yes".
+ * @user_name: (allow-none): A user name for a user-level hook, or null.
+ *
+ * Record that @hook needs to run its command for @user_name.
+ *
+ * Returns: True if the trigger is now pending, or false if it could not
+ * be recorded, in which case the caller should run the command itself.
+ */
+private bool
+record_trigger (DB db, Hook hook, string? user_name)
+{
+	User? user_db;
+	try {
+		user_db = open_user_triggers (db, user_name, true);
+	} catch (Error e) {
+		return false;
+	}
+	try {
+		var dir = get_triggers_dir (db, user_db);
+		if (! is_dir (dir)) {
+			try {
+				ensuredir (dir);
+			} catch (FileError e) {
+				return false;
+			}
+		}
+		/* Earlier versions made the system directory world-writable;
+		 * take that back if we can.
+		 */
+		Posix.Stat st;
+		if (Posix.lstat (dir, out st) == 0 &&
+		    Posix.S_ISDIR (st.st_mode) &&
+		    st.st_uid == Posix.geteuid () &&
+		    (st.st_mode & (Posix.S_IWGRP | Posix.S_IWOTH)) != 0)
+			Posix.chmod (dir, 0755);
+		if (! is_trusted_trigger_path (dir, true))
+			return false;
+
+		/* The directory is already per-user, so the file is just
+		 * named after the hook.
+		 */
+		var path = Path.build_filename (dir, hook.name);
+		/* Never follow a link that someone else has put in our way. */
+		var fd = Posix.open (path,
+				     Posix.O_WRONLY | Posix.O_CREAT |
+				     Posix.O_EXCL | PosixExtra.O_NOFOLLOW |
+				     PosixExtra.O_CLOEXEC,
+				     0644);
+		if (fd < 0)
+			return errno == Posix.EEXIST &&
+				is_trusted_trigger_path (path, false);
+		Posix.close (fd);
+		return true;
+	} finally {
+		close_user_triggers (user_db);
+	}
+}
+
+/**
+ * get_pending_triggers:
+ * @db: A #DB.
+ * @user_name: (allow-none): A user name, or null.
+ *
+ * Returns: The names of the pending triggers of user-level hooks for
+ * @user_name, or of system-level hooks if @user_name is null.
+ */
+private Gee.List<string>
+get_pending_triggers (DB db, string? user_name)
+{
+	var ret = new Gee.ArrayList<string> ();
+	User? user_db;
+	try {
+		user_db = open_user_triggers (db, user_name, false);
+	} catch (Error e) {
+		return ret;
+	}
+	try {
+		var dir = get_triggers_dir (db, user_db);
+		if (! is_trusted_trigger_path (dir, true))
+			return ret;
+		foreach (var entry in DirStream.open (dir, true)) {
+			if (entry.name.index_of_char ('@') >= 0 ||
+			    ! is_trusted_trigger_path
+				(Path.build_filename (dir, entry.name), false))
+				continue;
+			if (user_name == null)
+				ret.add (entry.name);
+			else
+				ret.add (@"$(entry.name)@$user_name");
+		}
+	} catch (FileError e) {
+	} finally {
+		close_user_triggers (user_db);
+	}
+	return ret;
+}
+
+/**
+ * claim_trigger:
+ * @db: A #DB.
+ * @hook_name: The name of a hook.
+ * @user_name: (allow-none): A user name for a user-level hook, or null.
+ *
+ * Take a pending trigger so that nobody else runs it as well.
+ *
+ * Returns: True if the caller should now run the trigger's command.
+ */
+private bool
+claim_trigger (DB db, string hook_name, string? user_name)
+{
+	User? user_db;
+	try {
+		user_db = open_user_triggers (db, user_name, false);
+	} catch (Error e) {
+		warning ("Cannot claim trigger %s: %s", hook_name, e.message);
+		return false;
+	}
+	try {
+		var dir = get_triggers_dir (db, user_db);
+		var path = Path.build_filename (dir, hook_name);
+		if (! is_trusted_trigger_path (dir, true) ||
+		    ! is_trusted_trigger_path (path, false))
+			return false;
+		if (FileUtils.unlink (path) < 0) {
+			/* Someone else may have claimed it already; if not,
+			 * leave it pending rather than risk running it
+			 * twice.
+			 */
+			if (errno != Posix.ENOENT)
+				warning ("Cannot claim trigger %s: %s",
+					 hook_name, strerror (errno));
+			return false;
+		}
+		return true;
+	} finally {
+		close_user_triggers (user_db);
+	}
+}
+
+/**
+ * run_triggers:
+ * @db: A #DB.
+ * @names: Names of triggers, as returned by get_pending_triggers.
+ *
+ * Run the command of each of @names that is pending, in order.  Failures
+ * are only logged, and leave the trigger pending.
+ */
+private void
+run_triggers (DB db, Gee.Iterable<string> names)
+{
+	foreach (var name in names) {
+		var at = name.index_of_char ('@');
+		var hook_name = at < 0 ? name : name.substring (0, at);
+		string? user_name = at < 0 ? null : name.substring (at + 1);
+		if (! claim_trigger (db, hook_name, user_name))
+			continue;
+		Hook? hook;
+		try {
+			hook = db.hook_registry.open (db, hook_name);
+		} catch (FileError e) {
+			hook = null;
+		}
+		if (hook == null || ! hook.is_trigger ||
+		    hook.is_user_level != (user_name != null))
+			continue;
+		try {
+			hook.run_exec (user_name);
+		} catch (Error e) {
+			warning ("Trigger %s failed: %s", name, e.message);
+			record_trigger (db, hook, user_name);
+		}
+	}
+}
+
+}
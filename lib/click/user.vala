@@ -36,23 +36,6 @@
 
 namespace Click {
 
-	struct LogindUser {
-		uint32 uid;
-		string name;
-		string ObjectPath;
-	}
-
-	/* the logind dbus interface */
-	[DBus (name = "org.freedesktop.login1.Manager")]
-	interface LogindManager : Object {
-		public abstract LogindUser[] ListUsers () throws IOError;
-	}
-
-	[DBus (name = "org.freedesktop.Accounts.User")]
-	interface ASUser : Object {
-		public abstract bool system_account { get; }
-	}
-
 /* Pseudo-usernames selected to be invalid as a real username, and alluding
  * to group syntaxes used in other systems.
  */
@@ -65,6 +48,9 @@ private const string GC_IN_USE_USER = "@gcinuse";
  */
 private const string HIDDEN_VERSION = "@hidden";
 
+/* How long to wait for running apps to stop before removing a package. */
+private const uint APP_STOP_TIMEOUT = 10;
+
 public errordomain UserError {
 	/**
 	 * Failure to get password file entry.
@@ -128,18 +114,6 @@ try_create (string path) throws UserError
 			 path, strerror (errno));
 }
 
-private class CachedPasswd : Object {
-	public Posix.uid_t uid;
-	public Posix.gid_t gid;
-
-	public
-	CachedPasswd (Posix.uid_t uid, Posix.gid_t gid)
-	{
-		this.uid = uid;
-		this.gid = gid;
-	}
-}
-
 private void
 try_chown (string path, CachedPasswd pw) throws UserError
 {
@@ -168,13 +142,11 @@ public class Users : Object {
 	get_click_pw () throws UserError
 	{
 		if (click_pw == null) {
-			errno = 0;
-			unowned Posix.Passwd pw = Posix.getpwnam ("clickpkg");
-			if (pw == null)
+			click_pw = lookup_passwd ("clickpkg");
+			if (click_pw == null)
 				throw new UserError.GETPWNAM
 					("Cannot get password file entry " +
 					 "for clickpkg: %s", strerror (errno));
-			click_pw = new CachedPasswd (pw.pw_uid, pw.pw_gid);
 		}
 		return click_pw;
 	}
@@ -210,18 +182,16 @@ public class Users : Object {
 		var seen = new Gee.HashSet<string> ();
 		foreach (var single_db in db) {
 			var users_db = db_top (single_db.root);
-			foreach (var entry in Click.Dir.open (users_db)) {
-				if (entry in seen)
+			foreach (var entry in DirStream.open (users_db, true)) {
+				if (entry.name in seen)
 					continue;
 				// the user is not a pseudo user and does not/no-longer exist
-				if (!entry.has_prefix ("@") &&
-					Posix.getpwnam (entry) == null)
+				if (!entry.name.has_prefix ("@") &&
+					lookup_passwd (entry.name) == null)
 					continue;
-				var path = Path.build_filename (users_db,
-								entry);
-				if (is_dir (path)) {
-					seen.add (entry.dup ());
-					entries.prepend (entry.dup ());
+				if (entry.is_dir ()) {
+					seen.add (entry.name);
+					entries.prepend (entry.name);
 				}
 			}
 		}
@@ -251,6 +221,33 @@ public class Users : Object {
 	}
 }
 
+/**
+ * Registration:
+ *
+ * A single package registration as seen by a #User: the registration
+ * that takes effect for that package, taking all databases and the
+ * all-users registrations into account.
+ *
+ * Since: 0.5.3
+ */
+public class Registration : Object {
+	public string package { get; construct; }
+	/* The registered version, or null if the package is hidden. */
+	public string? version { get; construct; }
+	/* The index of the database containing the registration. */
+	public int layer { get; construct; }
+	public bool hidden { get; construct; }
+	/* The path to the registration link. */
+	public string path { get; construct; }
+
+	internal Registration (string package, string? version, int layer,
+			       bool hidden, string path)
+	{
+		Object (package: package, version: version, layer: layer,
+			hidden: hidden, path: path);
+	}
+}
+
 public class User : Object {
 	public DB db { private get; construct; }
 	public string name { private get; construct; }
@@ -259,6 +256,11 @@ public class User : Object {
 	private CachedPasswd? user_pw;
 	private int dropped_privileges_count;
 	private Posix.mode_t? old_umask;
+	/* Registration directories opened during a dropped session. */
+	private Gee.HashMap<string, int>? registry_fds;
+	/* The user's D-Bus session environment, read on first use. */
+	private string? session_env;
+	private bool session_env_read;
 
 	private User (DB? db, string? name = null) throws FileError {
 		DB real_db;
@@ -278,6 +280,9 @@ public class User : Object {
 		user_pw = null;
 		dropped_privileges_count = 0;
 		old_umask = null;
+		registry_fds = null;
+		session_env = null;
+		session_env_read = false;
 	}
 
 	public User.for_user (DB? db, string? name = null) throws FileError {
@@ -314,13 +319,11 @@ public class User : Object {
 		assert (! is_pseudo_user);
 
 		if (user_pw == null) {
-			errno = 0;
-			unowned Posix.Passwd pw = Posix.getpwnam (name);
-			if (pw == null)
+			user_pw = lookup_passwd (name);
+			if (user_pw == null)
 				throw new UserError.GETPWNAM
 				     ("Cannot get password file entry for " +
 				      "%s: %s", name, strerror (errno));
-			user_pw = new CachedPasswd (pw.pw_uid, pw.pw_gid);
 		}
 		return user_pw;
 	}
@@ -337,7 +340,7 @@ public class User : Object {
 		return db_for_user (db.overlay, name);
 	}
 
-	private void
+	internal void
 	ensure_db () throws UserError
 	{
 		if (users == null)
@@ -384,6 +387,8 @@ public class User : Object {
 			old_umask = Posix.umask (get_umask () | Posix.S_IWOTH);
 		}
 
+		if (dropped_privileges_count == 0)
+			registry_fds = new Gee.HashMap<string, int> ();
 		++dropped_privileges_count;
 	}
 
@@ -402,6 +407,12 @@ public class User : Object {
 	{
 		--dropped_privileges_count;
 
+		if (dropped_privileges_count == 0 && registry_fds != null) {
+			foreach (var fd in registry_fds.values)
+				Posix.close (fd);
+			registry_fds = null;
+		}
+
 		if (dropped_privileges_count == 0 &&
 		    Posix.getuid () == 0 && ! is_pseudo_user) {
 			if (old_umask != null)
@@ -413,6 +424,117 @@ public class User : Object {
 		}
 	}
 
+	/**
+	 * begin_dropped_session:
+	 *
+	 * Drop privileges to those of this user, if necessary, until the
+	 * matching call to end_dropped_session.  Registry reads made in
+	 * between, such as get_version and get_path, neither switch
+	 * privileges again nor re-resolve the registration directories.
+	 * Sessions may be nested.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	begin_dropped_session () throws UserError
+	{
+		drop_privileges ();
+	}
+
+	/**
+	 * end_dropped_session:
+	 *
+	 * End a session started by begin_dropped_session.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	end_dropped_session ()
+	{
+		regain_privileges ();
+	}
+
+	/**
+	 * read_registration:
+	 * @user_db: A registration directory.
+	 * @package: A package name.
+	 *
+	 * Returns: The target of the registration of @package in @user_db,
+	 * or null if there is none.  During a dropped session, this reads
+	 * the link relative to a descriptor for @user_db that is opened only
+	 * once per session.
+	 */
+	private string?
+	read_registration (string user_db, string package)
+	{
+		if (registry_fds != null) {
+			int fd;
+			if (registry_fds.has_key (user_db))
+				fd = registry_fds[user_db];
+			else {
+				fd = PosixExtra.openat
+					(PosixExtra.AT_FDCWD, user_db,
+					 Posix.O_RDONLY | PosixExtra.O_DIRECTORY |
+					 PosixExtra.O_CLOEXEC);
+				/* Do not remember missing directories, since
+				 * they may be created later in the session.
+				 */
+				if (fd < 0)
+					return null;
+				registry_fds[user_db] = fd;
+			}
+			return read_link_at (fd, package);
+		}
+
+		try {
+			return FileUtils.read_link
+				(Path.build_filename (user_db, package));
+		} catch (FileError e) {
+			return null;
+		}
+	}
+
+	/**
+	 * find_registration:
+	 * @package: A package name.
+	 * @path: The path to the registration of @package.
+	 *
+	 * Returns: The target of the registration of @package that applies
+	 * to this user.
+	 */
+	private string
+	find_registration (string package, out string path) throws UserError
+	{
+		for (int i = db.size - 1; i >= 0; --i) {
+			var user_db = db_for_user (db[i].root, name);
+			var target = read_registration (user_db, package);
+			if (target != null) {
+				if (target.has_prefix ("@"))
+					throw new UserError.HIDDEN_PACKAGE
+						("%s is hidden for user %s",
+						 package, name);
+				path = Path.build_filename (user_db, package);
+				return target;
+			}
+
+			var all_users_db = db_for_user (db[i].root, ALL_USERS);
+			target = read_registration (all_users_db, package);
+			if (target != null) {
+				if (target.has_prefix ("@"))
+					throw new UserError.HIDDEN_PACKAGE
+						("%s is hidden for all users",
+						 package);
+				path = Path.build_filename
+					(all_users_db, package);
+				return target;
+			}
+		}
+
+		throw new UserError.NO_SUCH_PACKAGE
+			("%s does not exist in any database for user %s",
+			 package, name);
+	}
+
 	private bool
 	is_valid_link (string path)
 	{
@@ -431,38 +553,9 @@ public class User : Object {
 	get_package_names_dropped () throws Error
 	{
 		var entries = new List<string> ();
-		var hidden = new Gee.HashSet<string> ();
-		for (int i = db.size - 1; i >= 0; --i) {
-			var user_db = db_for_user (db[i].root, name);
-			foreach (var entry in Click.Dir.open (user_db)) {
-				if (entries.find_custom (entry, strcmp)
-					!= null ||
-				    entry in hidden)
-					continue;
-				var path = Path.build_filename (user_db, entry);
-				if (is_valid_link (path))
-					entries.prepend (entry.dup ());
-				else if (is_symlink (path))
-					hidden.add (entry.dup ());
-			}
-
-			if (name != ALL_USERS) {
-				var all_users_db = db_for_user (db[i].root,
-								ALL_USERS);
-				foreach (var entry in Click.Dir.open
-						(all_users_db)) {
-					if (entries.find_custom (entry, strcmp)
-						!= null ||
-					    entry in hidden)
-						continue;
-					var path = Path.build_filename
-						(all_users_db, entry);
-					if (is_valid_link (path))
-						entries.prepend (entry.dup ());
-					else if (is_symlink (path))
-						hidden.add (entry.dup ());
-				}
-			}
+		foreach (var reg in get_registrations_dropped ()) {
+			if (! reg.hidden)
+				entries.prepend (reg.package);
 		}
 		entries.reverse ();
 		return entries;
@@ -512,46 +605,134 @@ public class User : Object {
 	public string
 	get_version (string package) throws UserError
 	{
-		for (int i = db.size - 1; i >= 0; --i) {
-			var user_db = db_for_user (db[i].root, name);
-			var path = Path.build_filename (user_db, package);
-			drop_privileges ();
+		string path;
+		drop_privileges ();
+		try {
+			return Path.get_basename
+				(find_registration (package, out path));
+		} finally {
+			regain_privileges ();
+		}
+	}
+
+	/**
+	 * read_registrations:
+	 * @user_db: A registration directory.
+	 * @layer: The index of the database containing @user_db.
+	 * @seen: Packages whose registrations have already been read.
+	 * @registrations: A list to append new registrations to.
+	 *
+	 * Read the registrations in @user_db, in sorted order, skipping
+	 * packages already registered (or hidden) in a higher-priority
+	 * directory.
+	 */
+	private void
+	read_registrations (string user_db, int layer, Gee.Set<string> seen,
+			    Gee.List<Registration> registrations) throws Error
+	{
+		foreach (var entry in DirStream.open (user_db, true)) {
+			if (! entry.is_symlink () || entry.name in seen)
+				continue;
+			seen.add (entry.name);
+			string? target = null;
 			try {
-				if (is_valid_link (path)) {
-					try {
-						var target =
-							FileUtils.read_link
-							(path);
-						return Path.get_basename
-							(target);
-					} catch (FileError e) {
-					}
-				} else if (is_symlink (path))
-					throw new UserError.HIDDEN_PACKAGE
-						("%s is hidden for user %s",
-						 package, name);
-			} finally {
-				regain_privileges ();
+				target = FileUtils.read_link (entry.path);
+			} catch (FileError e) {
 			}
+			if (target == null || target.has_prefix ("@"))
+				registrations.add (new Registration
+					(entry.name, null, layer, true,
+					 entry.path));
+			else
+				registrations.add (new Registration
+					(entry.name, Path.get_basename (target),
+					 layer, false, entry.path));
+		}
+	}
 
-			var all_users_db = db_for_user (db[i].root, ALL_USERS);
-			path = Path.build_filename (all_users_db, package);
-			if (is_valid_link (path)) {
-				try {
-					var target = FileUtils.read_link
-						(path);
-					return Path.get_basename (target);
-				} catch (FileError e) {
-				}
-			} else if (is_symlink (path))
-				throw new UserError.HIDDEN_PACKAGE
-					("%s is hidden for all users",
-					 package);
+	private Gee.List<Registration>
+	get_registrations_dropped () throws Error
+	{
+		var registrations = new Gee.ArrayList<Registration> ();
+		var seen = new Gee.HashSet<string> ();
+		for (int i = db.size - 1; i >= 0; --i) {
+			read_registrations (db_for_user (db[i].root, name), i,
+					    seen, registrations);
+			if (name != ALL_USERS)
+				read_registrations
+					(db_for_user (db[i].root, ALL_USERS),
+					 i, seen, registrations);
 		}
+		return registrations;
+	}
 
-		throw new UserError.NO_SUCH_PACKAGE
-			("%s does not exist in any database for user %s",
-			 package, name);
+	/**
+	 * get_registrations:
+	 *
+	 * Read all the registrations for this user in a single pass over
+	 * each database, dropping privileges only once.  This is much
+	 * cheaper than calling get_version and get_path for each of
+	 * get_package_names.
+	 *
+	 * Returns: (transfer full): A list of #Registration objects, one
+	 * for each package registered or hidden for this user, in the same
+	 * order as get_package_names.
+	 *
+	 * Since: 0.5.3
+	 */
+	public List<Registration>
+	get_registrations () throws Error
+	{
+		var ret = new List<Registration> ();
+		drop_privileges ();
+		try {
+			foreach (var reg in get_registrations_dropped ())
+				ret.prepend (reg);
+		} finally {
+			regain_privileges ();
+		}
+		ret.reverse ();
+		return ret;
+	}
+
+	/**
+	 * get_registered_versions:
+	 * @names: (allow-none): A list to append package names to.
+	 *
+	 * Read all the registrations for this user in a single pass over
+	 * each database, dropping privileges only once.  This is equivalent
+	 * to calling get_version for each of get_package_names, but much
+	 * cheaper.
+	 *
+	 * Returns: A map from package names registered for this user to
+	 * their registered versions.  If @names is not null, the package
+	 * names are also appended to it in the order that
+	 * get_package_names returns them.
+	 */
+	internal Gee.Map<string, string>
+	get_registered_versions (Gee.List<string>? names = null) throws Error
+	{
+		drop_privileges ();
+		try {
+			return get_registered_versions_dropped (names);
+		} finally {
+			regain_privileges ();
+		}
+	}
+
+	private Gee.Map<string, string>
+	get_registered_versions_dropped (Gee.List<string>? names = null)
+		throws Error
+	{
+		var versions = new Gee.TreeMap<string, string> ();
+		foreach (var reg in get_registrations_dropped ()) {
+			if (reg.hidden)
+				continue;
+			versions[reg.package] = reg.version;
+			if (names != null)
+				names.add (reg.package);
+		}
+		return versions;
 	}
 
 	/**
@@ -560,7 +741,8 @@ public class User : Object {
 	 * @version: A version string.
 	 *
 	 * Set the version of @package to @version, without running any
-	 * hooks.  Must be run with dropped privileges.
+	 * hooks or journalling the change (see record_change).  Must be run
+	 * with dropped privileges.
 	 */
 	internal void
 	raw_set_version (string package, string version) throws Error
@@ -579,13 +761,43 @@ public class User : Object {
 			} catch (UserError e) {
 			}
 		}
-		if (done)
+		if (! done) {
+			symlink_force (target, new_path);
+			if (FileUtils.rename (new_path, path) < 0)
+				throw new UserError.RENAME
+					("rename %s -> %s failed: %s",
+					 new_path, path, strerror (errno));
+		}
+	}
+
+	/**
+	 * record_change:
+	 * @op: JOURNAL_REGISTER or JOURNAL_UNREGISTER.
+	 * @package: A package name.
+	 * @version: (allow-none): The version registered or unregistered.
+	 *
+	 * Record a change to this user's registrations in the journal.  This
+	 * should be run with privileges, since the journal is only writable
+	 * by root and clickpkg; without them, mark the change as
+	 * unjournalled instead.
+	 */
+	private void
+	record_change (string op, string package, string? version)
+	{
+		if (new Journal (db.overlay).append (op, name, package, version))
 			return;
-		symlink_force (target, new_path);
-		if (FileUtils.rename (new_path, path) < 0)
-			throw new UserError.RENAME
-				("rename %s -> %s failed: %s",
-				 new_path, path, strerror (errno));
+		var marker = Path.build_filename
+			(get_overlay_db (), UNJOURNALLED_MARKER);
+		try {
+			drop_privileges ();
+			try {
+				FileUtils.set_contents (marker, "");
+			} finally {
+				regain_privileges ();
+			}
+		} catch (Error e) {
+			warning ("Cannot write %s: %s", marker, e.message);
+		}
 	}
 
 	/**
@@ -611,126 +823,399 @@ public class User : Object {
 		} finally {
 			regain_privileges ();
 		}
+		if (old_version != version)
+			record_change (JOURNAL_REGISTER, package, version);
 		if (! is_pseudo_user)
 			package_install_hooks (db, package,
 					       old_version, version, name);
 
 		// run user hooks for all logged in users
 		if (name == ALL_USERS)
-			run_user_install_hooks_for_all_logged_in_users (package, old_version, version);
+			run_user_hooks_for_logged_in_users ({package});
 	}
 
-	private string[]
-	get_logged_in_users()
+	/**
+	 * read_overlay_registration:
+	 * @package: A package name.
+	 *
+	 * Returns: The target of this user's registration of @package in the
+	 * overlay database, or null if there is none.  Must be run with
+	 * dropped privileges.
+	 */
+	private string?
+	read_overlay_registration (string package)
 	{
-		string[] logged_in_users = {};
 		try {
-			LogindManager logind = Bus.get_proxy_sync (
-				BusType.SYSTEM,
-				"org.freedesktop.login1",
-				"/org/freedesktop/login1");
-			var users = logind.ListUsers();
-			foreach (LogindUser user in users)
-			{
-				ASUser asUser = Bus.get_proxy_sync (
-					BusType.SYSTEM,
-					"org.freedesktop.Accounts.User",
-					@"/org/freedesktop/Accounts/User$(user.uid)");
-
-				if(!asUser.system_account)
-				{
-					logged_in_users += user.name;
-				}
+			return FileUtils.read_link (Path.build_filename
+				(get_overlay_db (), package));
+		} catch (FileError e) {
+			return null;
+		}
+	}
+
+	/**
+	 * restore_overlay_registration:
+	 * @package: A package name.
+	 * @old_target: (allow-none): The target of this user's registration
+	 * of @package in the overlay database before it was changed, as
+	 * returned by read_overlay_registration, or null if there was none.
+	 *
+	 * Put back a registration changed by raw_set_version.  Must be run
+	 * with dropped privileges.
+	 *
+	 * Returns: True if the registration was put back.
+	 */
+	private bool
+	restore_overlay_registration (string package, string? old_target)
+	{
+		var user_db = get_overlay_db ();
+		var path = Path.build_filename (user_db, package);
+		var new_path = Path.build_filename (user_db, @".$package.new");
+		try {
+			if (old_target == null) {
+				unlink_force (path);
+				return true;
 			}
-		} catch (Error e) {
-			warning (@"Can not connect to logind or AccountsService: $(e.message)");
+			symlink_force (old_target, new_path);
+		} catch (FileError e) {
+			warning ("Cannot restore registration of %s: %s",
+				 package, e.message);
+			return false;
+		}
+		if (FileUtils.rename (new_path, path) < 0) {
+			warning ("Cannot restore registration of %s: " +
+				 "rename %s -> %s failed: %s",
+				 package, new_path, path, strerror (errno));
+			return false;
 		}
-		return logged_in_users;
+		return true;
 	}
 
-	private void
-	run_user_install_hooks_for_all_logged_in_users (string package, 
-													string? old_version,
-													string version) throws IOError
+	/**
+	 * set_versions:
+	 * @packages: (array length=n_packages): Package names.
+	 * @versions: (array length=n_versions): Version strings, one for each
+	 * of @packages.
+	 *
+	 * Register version @versions[i] of @packages[i] for this user, for
+	 * each i.  All the registrations are changed first, and then the
+	 * commands of each affected hook are run once for the whole batch
+	 * rather than once per package.  If any of the registrations cannot
+	 * be changed, those already changed are restored and no hooks are
+	 * run.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	set_versions (string[] packages, string[] versions) throws Error
+		requires (packages.length == versions.length)
 	{
-		foreach (string username in get_logged_in_users())
-			package_install_hooks (db, package,
-								   old_version, version, username);
+		/* Only modify the last database. */
+		ensure_db ();
+		var old_versions = new string?[packages.length];
+		var old_targets = new string?[packages.length];
+		var restored = new bool[packages.length];
+		var attempted = 0;
+		drop_privileges ();
+		try {
+			/* Catch missing versions before changing anything. */
+			for (var i = 0; i < packages.length; ++i)
+				db.get_path (packages[i], versions[i]);
+			try {
+				for (var i = 0; i < packages.length; ++i) {
+					try {
+						old_versions[i] = get_version
+							(packages[i]);
+					} catch (UserError e) {
+						old_versions[i] = null;
+					}
+					old_targets[i] = read_overlay_registration
+						(packages[i]);
+					++attempted;
+					raw_set_version
+						(packages[i], versions[i]);
+				}
+			} catch (Error e) {
+				for (var i = attempted - 1; i >= 0; --i)
+					restored[i] =
+						restore_overlay_registration
+						(packages[i], old_targets[i]);
+				throw e;
+			}
+		} finally {
+			regain_privileges ();
+			/* Registrations that were put back have not
+			 * changed; one that could not be put back may
+			 * still point at the new version.
+			 */
+			for (var i = 0; i < attempted; ++i) {
+				if (! restored[i] &&
+				    old_versions[i] != versions[i])
+					record_change (JOURNAL_REGISTER,
+						       packages[i],
+						       versions[i]);
+			}
+		}
+
+		if (! is_pseudo_user)
+			HookTransaction.run (db, (transaction) => {
+				for (var i = 0; i < packages.length; ++i)
+					package_install_hooks_queued
+						(db, packages[i],
+						 old_versions[i], versions[i],
+						 name, transaction);
+			});
+
+		// run user hooks for all logged in users
+		if (name == ALL_USERS)
+			run_user_hooks_for_logged_in_users (packages);
 	}
 
+	/**
+	 * run_user_hooks_for_logged_in_users:
+	 * @packages: The packages whose registrations for all users have
+	 * just changed.
+	 *
+	 * Bring user-level hooks for @packages up to date for all the users
+	 * who are logged in, concurrently, by running "click hook run-user
+	 * --package=..." for each of them.
+	 *
+	 * Each helper is a fresh process, with privileges permanently
+	 * dropped to its user if we are running as root, rather than a fork
+	 * of this one: the D-Bus queries may have left a GDBus worker thread
+	 * behind, and only async-signal-safe work is safe between fork and
+	 * exec in a threaded process.  If a helper cannot be started, for
+	 * instance because the click command is not installed, that user's
+	 * hooks are run in this process instead.
+	 */
 	private void
-	run_user_remove_hooks_for_all_logged_in_users (string package, 
-												   string old_version) throws IOError
+	run_user_hooks_for_logged_in_users (string[] packages) throws Error
 	{
-		foreach (string username in get_logged_in_users())
-			package_remove_hooks (db, package,
-								  old_version, username);
+		string[] argv = {"click", "hook", "run-user", ""};
+		foreach (var single_db in db)
+			argv += @"--db=$(single_db.root)";
+		foreach (var package in packages)
+			argv += @"--package=$package";
+		var children = new Gee.HashMap<int, string> ();
+		string[] failed = {};
+		foreach (var user_name in get_logged_in_users ()) {
+			/* Look up the user before spawning; NSS is not safe
+			 * to use in the child.
+			 */
+			CachedPasswd? pw = null;
+			Posix.gid_t[] supp = {};
+			var envp = Environ.get ();
+			if (Posix.geteuid () == 0) {
+				pw = lookup_passwd (user_name);
+				if (pw == null) {
+					warning ("Cannot get password file entry " +
+						 "for user '%s': %s",
+						 user_name, strerror (errno));
+					failed += user_name;
+					continue;
+				}
+				supp = get_supplementary_groups (pw);
+				envp = Hook.get_dropped_envp (pw);
+				envp = Environ.set_variable
+					(envp, "USER", pw.name, true);
+				envp = Environ.set_variable
+					(envp, "LOGNAME", pw.name, true);
+			}
+			argv[3] = @"--user=$user_name";
+			SpawnChildSetupFunc drop = () => {
+				if (pw != null)
+					Hook.drop_privileges (pw, supp);
+			};
+			Pid pid;
+			try {
+				Process.spawn_async
+					(null, argv, envp,
+					 SpawnFlags.SEARCH_PATH |
+					 SpawnFlags.DO_NOT_REAP_CHILD,
+					 drop, out pid);
+			} catch (SpawnError e) {
+				try {
+					run_user_hooks_for_packages
+						(db, user_name, packages);
+				} catch (Error hooks_error) {
+					warning ("Cannot run hooks for %s: %s",
+						 user_name,
+						 hooks_error.message);
+					failed += user_name;
+				}
+				continue;
+			}
+			children[(int) pid] = user_name;
+		}
+		foreach (var child in children.entries) {
+			int status;
+			while (Posix.waitpid ((Posix.pid_t) child.key,
+					      out status, 0) < 0) {
+				if (errno != Posix.EINTR) {
+					status = -1;
+					break;
+				}
+			}
+			Process.close_pid ((Pid) child.key);
+			try {
+				Process.check_exit_status (status);
+			} catch (Error e) {
+				failed += child.value;
+			}
+		}
+		if (failed.length != 0)
+			throw new HooksError.INCOMPLETE
+				("Hooks failed for some logged-in users: %s",
+				 string.joinv (", ", failed));
 	}
 
-	private string
+	private string?
 	get_dbus_session_bus_env_for_current_user()
 	{
+		if (session_env_read)
+			return session_env;
+		session_env_read = true;
 		string euid = "%i".printf((int)(Posix.geteuid ()));
 		var dbus_session_file = Path.build_filename(
 			"/run", "user", euid, "dbus-session");
-		string session_env;
 		try {
 			FileUtils.get_contents(dbus_session_file, out session_env);
 			session_env = session_env.strip();
 		} catch (Error e) {
 			warning("Can not get the dbus session to stop app (%s)", e.message);
+			session_env = null;
 		}
 		return session_env;
 	}
 
+	/**
+	 * stop_apps:
+	 * @app_ids: Application IDs.
+	 *
+	 * Ask lomiri-app-stop to stop all of @app_ids at once, and wait up to
+	 * APP_STOP_TIMEOUT seconds for them all.  Any stop commands still
+	 * running after that are killed.
+	 *
+	 * Returns: True if all of @app_ids were stopped.
+	 */
 	private bool
-	stop_single_app (string app_id)
+	stop_apps (string[] app_ids)
 	{
+		if (app_ids.length == 0)
+			return true;
+
 		// get the users dbus session when we run as root first as this
 		// is where lomiri-app-stop listens
 		string[] envp = Environ.get();
-		envp += get_dbus_session_bus_env_for_current_user();
+		var session = get_dbus_session_bus_env_for_current_user();
+		if (session != null)
+			envp += session;
 
-		string[] command = {
-			"lomiri-app-stop", app_id
-		};
-		bool res = false;
-		try {
-			int exit_status;
-			Process.spawn_sync
-			(null, command, envp,
-			 SpawnFlags.SEARCH_PATH,
-			 null, null, null, out exit_status);
-			res = Process.check_exit_status (exit_status);
-		} catch (Error e) {
+		var context = new MainContext ();
+		var loop = new MainLoop (context);
+		var running = new Gee.HashMap<int, Source> ();
+		var res = true;
+		foreach (var app_id in app_ids) {
+			string[] command = {
+				"lomiri-app-stop", app_id
+			};
+			Pid pid;
+			try {
+				Process.spawn_async
+				(null, command, envp,
+				 SpawnFlags.SEARCH_PATH |
+				 SpawnFlags.DO_NOT_REAP_CHILD,
+				 null, out pid);
+			} catch (SpawnError e) {
+				res = false;
+				continue;
+			}
+			var watch = new ChildWatchSource (pid);
+			watch.set_callback ((child_pid, status) => {
+				try {
+					if (! Process.check_exit_status (status))
+						res = false;
+				} catch (Error e) {
+					res = false;
+				}
+				Process.close_pid (child_pid);
+				running.unset ((int) child_pid);
+				if (running.is_empty)
+					loop.quit ();
+			});
+			watch.attach (context);
+			running[(int) pid] = watch;
+		}
+
+		if (! running.is_empty) {
+			var timeout = new TimeoutSource.seconds (APP_STOP_TIMEOUT);
+			timeout.set_callback (() => {
+				loop.quit ();
+				return false;
+			});
+			timeout.attach (context);
+			loop.run ();
+			timeout.destroy ();
+		}
+
+		if (! running.is_empty) {
+			warning ("Timed out waiting for lomiri-app-stop");
 			res = false;
 		}
+		foreach (var entry in running.entries) {
+			entry.value.destroy ();
+			Posix.kill ((Posix.pid_t) entry.key, Posix.SIGKILL);
+			int status;
+			Posix.waitpid ((Posix.pid_t) entry.key, out status, 0);
+		}
 		return res;
 	}
 
+	/**
+	 * stop_running_apps_for_packages:
+	 * @packages: Package names.
+	 * @versions: The version of each of @packages to stop.
+	 *
+	 * Stop all the apps in all of @packages in one sweep.
+	 *
+	 * Returns: True if all the apps were stopped.
+	 */
 	private bool
-	stop_running_apps_for_package (string package, string version)
+	stop_running_apps_for_packages (string[] packages, string[] versions)
 	{
-		var res = true;
 		if (! find_on_path ("lomiri-app-stop"))
 			return false;
 
-		Json.Object manifest;
-		try {
-			manifest = get_manifest (package);
-		} catch (Error e) {
-			warning ("Can not get manifest for %s", package);
-			return false;
-		}
-		
-		if (! manifest.has_member ("hooks")) {
-			warning ("No hooks in manifest %s", package);
-			return false;
+		var res = true;
+		string[] app_ids = {};
+		for (var i = 0; i < packages.length; ++i) {
+			var package = packages[i];
+			var version = versions[i];
+			Json.Object manifest;
+			try {
+				manifest = db.get_manifest (package, version);
+			} catch (Error e) {
+				warning ("Can not get manifest for %s", package);
+				res = false;
+				continue;
+			}
+
+			if (! manifest.has_member ("hooks")) {
+				warning ("No hooks in manifest %s", package);
+				res = false;
+				continue;
+			}
+			var hooks = manifest.get_object_member ("hooks");
+			foreach (unowned string app_name in hooks.get_members ())
+				app_ids += @"$(package)_$(app_name)_$(version)";
 		}
-		var hooks = manifest.get_object_member ("hooks");
-		foreach (unowned string app_name in hooks.get_members ())
-			res &= stop_single_app (@"$(package)_$(app_name)_$(version)");
-		return res;
+		return stop_apps (app_ids) && res;
+	}
+
+	private bool
+	stop_running_apps_for_package (string package, string version)
+	{
+		return stop_running_apps_for_packages ({package}, {version});
 	}
 
 	private void
@@ -740,8 +1225,11 @@ public class User : Object {
 		try {
 			string path = Path.build_filename (
 				Environment.get_user_cache_dir (), package);
-			File file = File.new_for_path (path);
-			rmtree (file, null);
+			/* Deleting the tree itself is left to click reap. */
+			if (! move_to_trash (path, get_user_cache_trash_dir ())) {
+				File file = File.new_for_path (path);
+				rmtree (file, null);
+			}
 		} catch (Error e) {
 			warning ("Error removing cache for '%s': %s", package, e.message);
 		} finally {
@@ -757,6 +1245,87 @@ public class User : Object {
 	 */
 	public void
 	remove (string package) throws Error
+	{
+		var old_version = raw_remove (package);
+
+		if (! is_pseudo_user) {
+			package_remove_hooks (db, package, old_version, name);
+			package_remove_user_cache (package);
+		}
+
+		// run user hooks for all logged in users
+		if (name == ALL_USERS)
+			run_user_hooks_for_logged_in_users ({package});
+	}
+
+	/**
+	 * remove_many:
+	 * @packages: (array length=n_packages): Package names.
+	 *
+	 * Remove this user's registrations of all of @packages.  As with
+	 * set_versions, the commands of each affected hook are run once for
+	 * the whole batch.  If any of @packages is not registered, nothing is
+	 * changed.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	remove_many (string[] packages) throws Error
+	{
+		var old_versions = new string[packages.length];
+		for (var i = 0; i < packages.length; ++i) {
+			try {
+				old_versions[i] = get_version (packages[i]);
+			} catch (UserError e) {
+				throw new UserError.NO_SUCH_PACKAGE
+					("%s does not exist in any database " +
+					 "for user %s", packages[i], name);
+			}
+		}
+
+		// stop before removing the paths to the manifests
+		drop_privileges ();
+		try {
+			stop_running_apps_for_packages (packages, old_versions);
+		} finally {
+			regain_privileges ();
+		}
+		for (var i = 0; i < packages.length; ++i)
+			raw_remove (packages[i], false);
+
+		if (! is_pseudo_user) {
+			try {
+				HookTransaction.run (db, (transaction) => {
+					for (var i = 0; i < packages.length;
+					     ++i)
+						package_remove_hooks_queued
+							(db, packages[i],
+							 old_versions[i],
+							 name, transaction);
+				});
+			} finally {
+				foreach (var package in packages)
+					package_remove_user_cache (package);
+			}
+		}
+
+		// run user hooks for all logged in users
+		if (name == ALL_USERS)
+			run_user_hooks_for_logged_in_users (packages);
+	}
+
+	/**
+	 * raw_remove:
+	 * @package: A package name.
+	 * @stop_running: If true, stop the package's running apps first.
+	 *
+	 * Remove this user's registration of @package, without running any
+	 * hooks.
+	 *
+	 * Returns: The version of @package that was registered.
+	 */
+	private string
+	raw_remove (string package, bool stop_running = true) throws Error
 	{
 		/* Only modify the last database. */
 		var user_db = get_overlay_db ();
@@ -768,7 +1337,9 @@ public class User : Object {
 			drop_privileges ();
 			try {
 				// stop before removing the path to the manifest
-				stop_running_apps_for_package (package, old_version);
+				if (stop_running)
+					stop_running_apps_for_package
+						(package, old_version);
 				unlink_force (path);
 			} finally {
 				regain_privileges ();
@@ -785,21 +1356,16 @@ public class User : Object {
 			drop_privileges ();
 			try {
 				// stop before removing the path to the manifest
-				stop_running_apps_for_package (package, old_version);
+				if (stop_running)
+					stop_running_apps_for_package
+						(package, old_version);
 				symlink_force (HIDDEN_VERSION, path);
 			} finally {
 				regain_privileges ();
 			}
 		}
-
-		if (! is_pseudo_user) {
-			package_remove_hooks (db, package, old_version, name);
-			package_remove_user_cache (package);
-		}
-
-		// run user hooks for all logged in users
-		if (name == ALL_USERS)
-			run_user_remove_hooks_for_all_logged_in_users (package, old_version);
+		record_change (JOURNAL_UNREGISTER, package, old_version);
+		return old_version;
 	}
 
 	/**
@@ -811,29 +1377,9 @@ public class User : Object {
 	public string
 	get_path (string package) throws UserError
 	{
-		for (int i = db.size - 1; i >= 0; --i) {
-			var user_db = db_for_user (db[i].root, name);
-			var path = Path.build_filename (user_db, package);
-			if (is_valid_link (path))
-				return path;
-			else if (is_symlink (path))
-				throw new UserError.HIDDEN_PACKAGE
-					("%s is hidden for user %s",
-					 package, name);
-
-			var all_users_db = db_for_user (db[i].root, ALL_USERS);
-			path = Path.build_filename (all_users_db, package);
-			if (is_valid_link (path))
-				return path;
-			else if (is_symlink (path))
-				throw new UserError.HIDDEN_PACKAGE
-					("%s is hidden for all users",
-					 package);
-		}
-
-		throw new UserError.NO_SUCH_PACKAGE
-			("%s does not exist in any database for user %s",
-			 package, name);
+		string path;
+		find_registration (package, out path);
+		return path;
 	}
 
 	/**
@@ -847,9 +1393,16 @@ public class User : Object {
 	public Json.Object
 	get_manifest (string package) throws Error
 	{
-		var obj = db.get_manifest (package, get_version (package));
+		return get_manifest_for_version (package, get_version (package));
+	}
+
+	private Json.Object
+	get_manifest_for_version (string package, string version,
+				  string? path = null) throws Error
+	{
+		var obj = db.get_manifest (package, version);
 		/* Adjust _directory to point to the user registration path. */
-		obj.set_string_member ("_directory", get_path (package));
+		obj.set_string_member ("_directory", path ?? get_path (package));
 		/* This should really be a boolean, but it was mistakenly
 		 * made an int when the "_removable" key was first created.
 		 * We may change this in future.
@@ -896,17 +1449,130 @@ public class User : Object {
 	get_manifests () throws Error /* API-compatibility */
 	{
 		var ret = new Json.Array ();
-		foreach (var package in get_package_names ()) {
+		foreach_manifest ((manifest) => {
+			ret.add_object_element (manifest);
+			return true;
+		});
+		return ret;
+	}
+
+	/**
+	 * foreach_manifest:
+	 * @func: (scope call): A function to call for each manifest.
+	 *
+	 * Call @func for the manifest of each package registered for this
+	 * user in turn, as get_manifests would return them, without
+	 * building them all in memory at once.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	foreach_manifest (ManifestFunc func) throws Error
+	{
+		foreach (var reg in get_registrations ()) {
+			if (reg.hidden)
+				continue;
+			Json.Object manifest;
 			try {
-				ret.add_object_element
-					(get_manifest (package));
+				manifest = get_manifest_for_version
+					(reg.package, reg.version, reg.path);
 			} catch (Error e) {
 				warning ("%s", e.message);
+				continue;
+			}
+			if (! func (manifest))
+				break;
+		}
+	}
+
+	/**
+	 * foreach_manifest_with_fields:
+	 * @fields: (array zero-terminated=1): The manifest keys to return.
+	 * @func: (scope call): A function to call for each package.
+	 *
+	 * Like foreach_manifest, but each object passed to @func contains
+	 * only the requested keys.  Dynamic keys such as "_directory" and
+	 * "_removable" are only computed if requested, and manifests are
+	 * not parsed if only "name" and "version" are requested, since
+	 * those are known from the registrations.  Dangling registrations
+	 * and packages whose manifest is missing are still skipped with a
+	 * warning.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	foreach_manifest_with_fields (string[] fields, ManifestFunc func)
+		throws Error
+	{
+		var need_manifest = fields_need_manifest (fields);
+		foreach (var reg in get_registrations ()) {
+			if (reg.hidden)
+				continue;
+			unowned string package = reg.package;
+			unowned string version = reg.version;
+			Json.Object? manifest = null;
+			try {
+				var path = db.get_path (package, version);
+				if (need_manifest)
+					manifest = db.load_manifest_at
+						(package, path);
+				else
+					db.check_manifest_at (package, path);
+			} catch (DatabaseError e) {
+				warning ("%s", e.message);
+				continue;
 			}
+			var obj = project_manifest
+				(manifest, package, version, fields);
+			if (has_field (fields, "_directory"))
+				obj.set_string_member ("_directory", reg.path);
+			if (has_field (fields, "_removable"))
+				obj.set_int_member
+					("_removable",
+					 is_removable (package) ? 1 : 0);
+			if (! func (obj))
+				break;
 		}
+	}
+
+	/**
+	 * get_manifests_with_fields:
+	 * @fields: (array zero-terminated=1): The manifest keys to return.
+	 *
+	 * Returns: A #Json.Array as returned by get_manifests, but with
+	 * each manifest reduced to the requested keys.  See
+	 * foreach_manifest_with_fields.
+	 *
+	 * Since: 0.5.3
+	 */
+	public Json.Array
+	get_manifests_with_fields (string[] fields) throws Error
+	{
+		var ret = new Json.Array ();
+		foreach_manifest_with_fields (fields, (obj) => {
+			ret.add_object_element (obj);
+			return true;
+		});
 		return ret;
 	}
 
+	/**
+	 * write_manifests:
+	 * @fd: A file descriptor open for writing.
+	 *
+	 * Write the same serialised array as get_manifests_as_string to
+	 * @fd, one manifest at a time.
+	 *
+	 * Since: 0.5.3
+	 */
+	public void
+	write_manifests (int fd) throws Error
+	{
+		var writer = new ManifestWriter (fd);
+		foreach_manifest (writer.add);
+		writer.finish ();
+	}
+
 	/**
 	 * get_manifests_as_string:
 	 *
@@ -923,12 +1589,10 @@ public class User : Object {
 	public string
 	get_manifests_as_string () throws Error /* API-compatibility */
 	{
-		var manifests = get_manifests ();
-		var node = new Json.Node (Json.NodeType.ARRAY);
-		node.set_array (manifests);
-		var generator = new Json.Generator ();
-		generator.set_root (node);
-		return generator.to_data (null);
+		var writer = new ManifestWriter.for_string ();
+		foreach_manifest (writer.add);
+		writer.finish ();
+		return writer.get_string ();
 	}
 
 	/**
@@ -0,0 +1,130 @@
+/* Copyright (C) 2014 Canonical Ltd.
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; version 3 of the License.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/* Debian-style version comparison.
+ *
+ * This follows the algorithm in dpkg's lib/dpkg/version.c, so that we do
+ * not need to spawn "dpkg --compare-versions" for each comparison.
+ */
+
+namespace Click {
+
+private int
+version_order (char c)
+{
+	if (c.isdigit ())
+		return 0;
+	else if (c.isalpha ())
+		return (int) c;
+	else if (c == '~')
+		return -1;
+	else if (c != '\0')
+		return (int) c + 256;
+	else
+		return 0;
+}
+
+private int
+version_compare_part (string a, string b)
+{
+	int i = 0, j = 0;
+
+	while (i < a.length || j < b.length) {
+		int first_diff = 0;
+
+		while ((i < a.length && ! a[i].isdigit ()) ||
+		       (j < b.length && ! b[j].isdigit ())) {
+			int ac = i < a.length ? version_order (a[i]) : 0;
+			int bc = j < b.length ? version_order (b[j]) : 0;
+			if (ac != bc)
+				return ac - bc;
+			++i;
+			++j;
+		}
+		while (i < a.length && a[i] == '0')
+			++i;
+		while (j < b.length && b[j] == '0')
+			++j;
+		while (i < a.length && a[i].isdigit () &&
+		       j < b.length && b[j].isdigit ()) {
+			if (first_diff == 0)
+				first_diff = (int) a[i] - (int) b[j];
+			++i;
+			++j;
+		}
+		if (i < a.length && a[i].isdigit ())
+			return 1;
+		if (j < b.length && b[j].isdigit ())
+			return -1;
+		if (first_diff != 0)
+			return first_diff;
+	}
+
+	return 0;
+}
+
+private void
+version_split (string version, out uint64 epoch, out string upstream,
+	       out string revision)
+{
+	var rest = version.strip ();
+	epoch = 0;
+	var colon = rest.index_of_char (':');
+	if (colon >= 0) {
+		epoch = uint64.parse (rest[0:colon]);
+		rest = rest.substring (colon + 1);
+	}
+	var hyphen = rest.last_index_of_char ('-');
+	if (hyphen >= 0) {
+		upstream = rest[0:hyphen];
+		revision = rest.substring (hyphen + 1);
+	} else {
+		upstream = rest;
+		revision = "";
+	}
+}
+
+/**
+ * version_compare:
+ * @a: A version string.
+ * @b: A version string.
+ *
+ * Compare two version strings using the same rules as dpkg.
+ *
+ * Returns: An integer less than, equal to, or greater than zero if @a is
+ * respectively older than, the same as, or newer than @b.
+ *
+ * Since: 0.5.3
+ */
+public int
+version_compare (string a, string b)
+{
+	uint64 a_epoch, b_epoch;
+	string a_upstream, b_upstream, a_revision, b_revision;
+
+	version_split (a, out a_epoch, out a_upstream, out a_revision);
+	version_split (b, out b_epoch, out b_upstream, out b_revision);
+
+	if (a_epoch > b_epoch)
+		return 1;
+	if (a_epoch < b_epoch)
+		return -1;
+	var ret = version_compare_part (a_upstream, b_upstream);
+	if (ret != 0)
+		return ret;
+	return version_compare_part (a_revision, b_revision);
+}
+
+}